@@ -7,17 +7,36 @@ import discord
 import aiohttp
 import requests
 from discord.ext import commands
+from discord import app_commands
 from flask import Flask, request
 from dotenv import load_dotenv
 from urllib.parse import urlparse
 import time
 from PIL import Image, ImageDraw
+from local_store import LocalTokenStore
+from job_store import (JobStore, JOB_RUNNING, JOB_PAUSED, JOB_CANCELLED, JOB_DONE,
+                       ITEM_DONE, ITEM_FAILED, ITEM_SKIPPED)
+from channel_index import channel_index, normalize_name, name_trigrams, channel_name_key
+from channel_layout import (parse_layout, plan_layout, current_layout, category_key, ALL_GUILDS, OP_CREATE_CATEGORY,
+                            OP_CREATE_CHANNEL, OP_UPDATE_CHANNEL, OP_REORDER)
 import io
-import aiohttp
+import csv
+from collections import OrderedDict, defaultdict, namedtuple
+from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor
+import functools
+import atexit
+import zlib
+import heapq
+import bisect
+import itertools
+import re
+import sqlite3
 
 # Try to import psycopg2, fallback to JSONBin if not available
 try:
     import psycopg2
+    import psycopg2.extras
     HAS_PSYCOPG2 = True
     print("✅ psycopg2 imported successfully")
 except ImportError:
@@ -46,17 +65,193 @@ if not CLIENT_SECRET:
 if not JSONBIN_API_KEY or not JSONBIN_BIN_ID:
     print("⚠️ WARNING: JSONBin.io config not found, will create new bin if needed")
 
+# Token cache configuration
+TOKEN_CACHE_TTL = int(os.getenv('TOKEN_CACHE_TTL', 3600))          # giây
+TOKEN_CACHE_MAX_SIZE = int(os.getenv('TOKEN_CACHE_MAX_SIZE', 10000))
+TOKEN_CACHE_NEGATIVE_TTL = int(os.getenv('TOKEN_CACHE_NEGATIVE_TTL', 300))  # giây, cho user chưa ủy quyền
+
+# Circuit breaker: ngắt một tầng storage sau N lỗi liên tiếp, probe lại mỗi khoảng này
+BREAKER_FAILURE_THRESHOLD = int(os.getenv('BREAKER_FAILURE_THRESHOLD', 3))
+BREAKER_PROBE_INTERVAL = float(os.getenv('BREAKER_PROBE_INTERVAL', 30))   # giây
+
+# JSONBin write-behind: gộp các thay đổi và ghi bin tối đa một lần mỗi khoảng này
+JSONBIN_FLUSH_INTERVAL = float(os.getenv('JSONBIN_FLUSH_INTERVAL', 5))   # giây
+
+# Thông tin đi kèm access token trong mọi tầng lưu trữ (None = giữ giá trị đã lưu)
+TOKEN_METADATA_FIELDS = ('username', 'avatar_hash', 'refresh_token', 'expires_at', 'scope')
+
 # --- RENDER CONFIGURATION ---
 PORT = int(os.getenv('PORT', 5000))
 RENDER_URL = os.getenv('RENDER_EXTERNAL_URL', f'http://127.0.0.1:{PORT}')
 REDIRECT_URI = f'{RENDER_URL}/callback'
 
+# --- CIRCUIT BREAKERS ---
+class CircuitBreaker:
+    """
+    Ngắt một tầng storage sau nhiều lỗi liên tiếp để các lệnh gọi bỏ qua nó ngay thay vì chờ timeout.
+    Khi đang ngắt, một thread nền gọi `probe()` định kỳ và đóng mạch lại khi tầng đó hồi phục.
+    """
+    def __init__(self, name, failure_threshold=BREAKER_FAILURE_THRESHOLD, probe_interval=BREAKER_PROBE_INTERVAL):
+        self.name = name
+        self.failure_threshold = failure_threshold
+        self.probe_interval = probe_interval
+        self.probe = None  # gán sau khi tầng storage được khởi tạo
+        self._lock = threading.Lock()
+        self.consecutive_failures = 0
+        self.total_failures = 0
+        self.trips = 0
+        self.probes = 0
+        self.opened_at = None
+
+    @property
+    def is_open(self):
+        return self.opened_at is not None
+
+    def allow(self):
+        """True nếu được phép gọi tầng này."""
+        return self.opened_at is None
+
+    def record_success(self):
+        if self.consecutive_failures:
+            with self._lock:
+                self.consecutive_failures = 0
+
+    def record_failure(self):
+        with self._lock:
+            self.total_failures += 1
+            self.consecutive_failures += 1
+            if self.opened_at is not None or self.probe is None:
+                return
+            if self.consecutive_failures < self.failure_threshold:
+                return
+            self.opened_at = time.time()
+            self.trips += 1
+        print(f"[Breaker] ⛔ Tầng {self.name} bị ngắt sau {self.consecutive_failures} lỗi liên tiếp, sẽ probe lại mỗi {self.probe_interval:.0f}s")
+        threading.Thread(target=self._probe_loop, name=f'breaker-{self.name}', daemon=True).start()
+
+    def _probe_loop(self):
+        while True:
+            time.sleep(self.probe_interval)
+            with self._lock:
+                self.probes += 1
+            try:
+                healthy = self.probe()
+            except Exception as e:
+                print(f"[Breaker] Probe {self.name} lỗi: {e}")
+                healthy = False
+            if healthy:
+                with self._lock:
+                    self.opened_at = None
+                    self.consecutive_failures = 0
+                print(f"[Breaker] ✅ Tầng {self.name} đã hồi phục, mở lại lưu lượng")
+                return
+
+    def state(self):
+        with self._lock:
+            return {
+                "state": "open" if self.opened_at is not None else "closed",
+                "open_for": round(time.time() - self.opened_at, 1) if self.opened_at is not None else 0,
+                "consecutive_failures": self.consecutive_failures,
+                "total_failures": self.total_failures,
+                "trips": self.trips,
+                "probes": self.probes,
+            }
+
+db_breaker = CircuitBreaker("db")
+jsonbin_breaker = CircuitBreaker("jsonbin")
+local_breaker = CircuitBreaker("local")
+storage_breakers = {"db": db_breaker, "jsonbin": jsonbin_breaker, "local": local_breaker}
+
+def breaker_snapshot():
+    """Trạng thái (đang ngắt?, tổng lỗi) của mọi tầng, dùng để biết một lượt tra cứu có đầy đủ không."""
+    return tuple((breaker.is_open, breaker.total_failures) for breaker in storage_breakers.values())
+
+def lookup_was_complete(before):
+    """True nếu mọi tầng đều được hỏi và trả lời không lỗi kể từ snapshot `before`."""
+    after = breaker_snapshot()
+    return after == before and not any(is_open for is_open, _ in after)
+
+# --- ROSTER ORDER ---
+# Thứ tự roster dùng khóa phân số: mỗi điệp viên có một roster_position (số thực), chèn vào giữa
+# hai hàng xóm bằng trung điểm nên một lần di chuyển chỉ ghi đúng một hồ sơ.
+ROSTER_POSITION_GAP = 1024.0
+
+def roster_position_between(before, after):
+    """Khóa vị trí nằm giữa hai hàng xóm (None = đầu/cuối danh sách). None nếu đã hết độ chính xác."""
+    if before is None and after is None:
+        return ROSTER_POSITION_GAP
+    if before is None:
+        return after - ROSTER_POSITION_GAP
+    if after is None:
+        return before + ROSTER_POSITION_GAP
+    middle = (before + after) / 2
+    return middle if before < middle < after else None
+
+def order_roster_from_jsonbin(full_data):
+    """
+    Dựng danh sách điệp viên theo thứ tự roster từ dữ liệu JSONBin (dùng khi không có PostgreSQL):
+    theo 'roster_position' của từng hồ sơ; hồ sơ chưa có vị trí xếp sau, theo '_roster_order' cũ.
+    """
+    roster_order = full_data.get('_roster_order') or []
+    agent_data = {uid: data for uid, data in full_data.items() if uid.isdigit() and isinstance(data, dict)}
+    # Điệp viên theo thứ tự đã lưu trước, điệp viên mới (chưa có trong danh sách thứ tự) ở cuối
+    ordered_ids = [uid for uid in dict.fromkeys(roster_order) if uid in agent_data]
+    ordered_set = set(ordered_ids)
+    ordered_ids += [uid for uid in agent_data if uid not in ordered_set]
+    positions = {uid: agent_data[uid].get('roster_position') for uid in ordered_ids}
+    ordered_ids.sort(key=lambda uid: (positions[uid] is None, positions[uid] or 0))
+    return [
+        {
+            'id': uid,
+            'username': agent_data[uid].get('username', 'N/A'),
+            'avatar_hash': agent_data[uid].get('avatar_hash'),
+            'roster_position': positions[uid]
+        }
+        for uid in ordered_ids
+    ]
+
 # --- JSONBIN.IO FUNCTIONS ---
+def jsonbin_shard_index(user_id, shard_count):
+    """Chọn shard cho một user theo hash ổn định của user_id."""
+    return zlib.crc32(str(user_id).encode()) % shard_count
+
 class JSONBinStorage:
-    def __init__(self):
+    """
+    Lưu trữ JSONBin với lớp ghi trễ (write-behind):
+    - save_user_token/delete_user chỉ ghi vào danh sách thay đổi chờ (dirty set) trong bộ nhớ.
+    - Các thay đổi được gộp lại và flush thành MỘT lần đọc + ghi mỗi bin bị ảnh hưởng, mỗi
+      `flush_interval` giây hoặc khi gọi flush() trực tiếp.
+    - Mọi thao tác đọc-sửa-ghi đều đi qua một writer duy nhất (self._writer_lock) nên
+      Flask thread và các lệnh của bot không ghi đè lên thay đổi của nhau.
+
+    Hai kiểu bố trí dữ liệu:
+    - Legacy: toàn bộ token, '_roster_order' và 'tracked_channels' nằm trong JSONBIN_BIN_ID.
+    - Sharded: JSONBIN_BIN_ID là manifest nhỏ {'_layout': {...}} trỏ tới N bin shard chứa hồ sơ
+      user (chia theo hash user_id), một bin cho '_roster_order' và một bin cho channel tracker.
+      Tra cứu một user chỉ đọc đúng shard của user đó.
+
+    Thứ tự roster nằm trong khóa 'roster_position' (số thực) của từng hồ sơ, nên di chuyển một
+    điệp viên chỉ ghi đúng hồ sơ đó. '_roster_order' chỉ còn trong dữ liệu cũ chưa chuyển đổi.
+    """
+    def __init__(self, flush_interval=JSONBIN_FLUSH_INTERVAL):
         self.api_key = JSONBIN_API_KEY
         self.bin_id = JSONBIN_BIN_ID
         self.base_url = "https://api.jsonbin.io/v3"
+        self.flush_interval = flush_interval
+        self.layout = None             # manifest '_layout' khi dùng bố trí sharded
+        self._layout_loaded = False
+        self._pending = {}             # user_id -> bản vá hồ sơ (dict, gộp vào hồ sơ hiện có) hoặc None (xóa)
+        # Bản sao thứ tự roster trong bộ nhớ {'_roster_order': [...], user_id: roster_position}: dựng bằng
+        # một lần đọc toàn bộ, sau đó cập nhật theo từng thay đổi được xếp hàng (_enqueue)
+        self._roster = None
+        self._roster_loading = None    # thay đổi xảy ra trong lúc đang dựng bản sao
+        self._state_lock = threading.Lock()
+        self._writer_lock = threading.RLock()
+        self._wake = threading.Event()
+        self._flusher = None
+        self.flush_count = 0
+        self.last_flush_at = None
+        self.io_stats = {'read': [0, 0], 'write': [0, 0]}  # op -> [số lần, tổng bytes]
         
     def _get_headers(self):
         """Tạo headers cho requests"""
@@ -65,12 +260,9 @@ class JSONBinStorage:
             "X-Master-Key": self.api_key,
             "X-Access-Key": self.api_key
         }
-    
-    def create_bin(self, data=None):
-        """Tạo bin mới nếu chưa có"""
-        if data is None:
-            data = {}
-        
+
+    def _create_bin(self, data):
+        """Tạo một bin mới với dữ liệu ban đầu, trả về bin ID (None nếu lỗi)."""
         try:
             response = requests.post(
                 f"{self.base_url}/b",
@@ -79,11 +271,8 @@ class JSONBinStorage:
             )
             
             if response.status_code == 200:
-                result = response.json()
-                self.bin_id = result['metadata']['id']
-                print(f"✅ Created new JSONBin: {self.bin_id}")
-                print(f"🔑 Add this to your .env: JSONBIN_BIN_ID={self.bin_id}")
-                return self.bin_id
+                self._record_io('write', len(json.dumps(data)))
+                return response.json()['metadata']['id']
             else:
                 print(f"❌ Failed to create bin: {response.text}")
                 return None
@@ -91,350 +280,3093 @@ class JSONBinStorage:
             print(f"❌ JSONBin create error: {e}")
             return None
     
-    def read_data(self):
-        """Đọc dữ liệu từ JSONBin"""
-        if not self.bin_id:
-            print("⚠️ No bin ID, creating new bin...")
-            self.create_bin()
-            return {}
-            
+    def create_bin(self, data=None):
+        """Tạo bin mới nếu chưa có"""
+        if data is None:
+            data = {}
+        
+        bin_id = self._create_bin(data)
+        if bin_id:
+            self.bin_id = bin_id
+            self._layout_loaded = True
+            print(f"✅ Created new JSONBin: {self.bin_id}")
+            print(f"🔑 Add this to your .env: JSONBIN_BIN_ID={self.bin_id}")
+        return bin_id
+
+    def _record_io(self, op, size):
+        self.io_stats[op][0] += 1
+        self.io_stats[op][1] += size
+
+    def _read_bin(self, bin_id, strict=False):
+        """
+        Đọc nội dung một bin (không gồm các thay đổi đang chờ).
+        Khi lỗi trả về {} — hoặc None nếu `strict` (dùng trước khi ghi đè để không làm mất dữ liệu).
+        """
+        failed = None if strict else {}
+        if not jsonbin_breaker.allow():
+            return failed
         try:
             response = requests.get(
-                f"{self.base_url}/b/{self.bin_id}/latest",
+                f"{self.base_url}/b/{bin_id}/latest",
                 headers=self._get_headers()
             )
             
             if response.status_code == 200:
+                jsonbin_breaker.record_success()
+                self._record_io('read', len(response.content))
                 data = response.json()
                 return data.get('record', {})
-            elif response.status_code == 404:
+            elif response.status_code == 404 and bin_id == self.bin_id and not self.layout:
                 print("⚠️ Bin not found, creating new one...")
                 self.create_bin()
                 return {}
             else:
                 print(f"❌ Failed to read from JSONBin: {response.status_code}")
-                return {}
+                if response.status_code >= 500 or response.status_code == 429:
+                    jsonbin_breaker.record_failure()
+                return failed
         except Exception as e:
             print(f"❌ JSONBin read error: {e}")
-            return {}
-    
-    def write_data(self, data):
-        """Ghi dữ liệu vào JSONBin"""
-        if not self.bin_id:
-            print("⚠️ No bin ID, creating new bin...")
-            if not self.create_bin(data):
-                return False
-        
+            jsonbin_breaker.record_failure()
+            return failed
+
+    def _write_bin(self, bin_id, data):
+        """Ghi đè toàn bộ một bin (gọi khi đang giữ self._writer_lock)."""
+        if not jsonbin_breaker.allow():
+            return False
         try:
             response = requests.put(
-                f"{self.base_url}/b/{self.bin_id}",
+                f"{self.base_url}/b/{bin_id}",
                 json=data,
                 headers=self._get_headers()
             )
             
             if response.status_code == 200:
+                jsonbin_breaker.record_success()
+                self._record_io('write', len(json.dumps(data)))
                 print("✅ Data saved to JSONBin successfully")
                 return True
             else:
                 print(f"❌ Failed to save to JSONBin: {response.status_code} - {response.text}")
+                if response.status_code >= 500 or response.status_code == 429:
+                    jsonbin_breaker.record_failure()
                 return False
         except Exception as e:
             print(f"❌ JSONBin write error: {e}")
+            jsonbin_breaker.record_failure()
             return False
+
+    def ping(self):
+        """Probe cho circuit breaker: gọi thẳng API, không qua breaker."""
+        if not self.bin_id:
+            return True
+        response = requests.get(f"{self.base_url}/b/{self.bin_id}/latest", headers=self._get_headers(), timeout=10)
+        return response.status_code == 200
+
+    def _ensure_layout(self):
+        """Đọc manifest một lần để biết bin đang dùng bố trí legacy hay sharded."""
+        if self._layout_loaded:
+            return self.layout
+        with self._writer_lock:
+            if self._layout_loaded:
+                return self.layout
+            if not self.bin_id:
+                print("⚠️ No bin ID, creating new bin...")
+                self.create_bin()
+            else:
+                record = self._read_bin(self.bin_id)
+                if isinstance(record.get('_layout'), dict):
+                    self.layout = record['_layout']
+                    print(f"🗂️ JSONBin sharded layout: {len(self.layout['shards'])} shards")
+            self._layout_loaded = True
+        return self.layout
+
+    def _bin_for_key(self, key):
+        """Bin chứa một khóa của dữ liệu logic."""
+        if not self.layout:
+            return self.bin_id
+        if key == '_roster_order':
+            return self.layout['roster_bin']
+        if key == 'tracked_channels':
+            return self.layout['tracker_bin']
+        shards = self.layout['shards']
+        return shards[jsonbin_shard_index(key, len(shards))]
+
+    def _token_bins(self):
+        """Các bin tạo nên sổ token logic (shard + roster; không gồm tracker)."""
+        if not self.layout:
+            return [self.bin_id]
+        return list(self.layout['shards']) + [self.layout['roster_bin']]
+
+    def _read_bins(self, bin_ids, strict=False):
+        return {bin_id: self._read_bin(bin_id, strict) for bin_id in dict.fromkeys(bin_ids)}
+
+    def _split(self, data, bin_ids):
+        """Chia dữ liệu logic về từng bin (chỉ các bin trong bin_ids)."""
+        parts = {bin_id: {} for bin_id in bin_ids}
+        for key, value in data.items():
+            bin_id = self._bin_for_key(key)
+            if bin_id in parts:
+                parts[bin_id][key] = value
+        return parts
+
+    @staticmethod
+    def _merge(older, newer):
+        """Gộp hai thay đổi liên tiếp của cùng một khóa (bản vá sau không hồi sinh hồ sơ đã xóa)."""
+        if newer is None or not isinstance(newer, dict):
+            return newer
+        if older is None:
+            return newer if newer.get('access_token') else None
+        if isinstance(older, dict):
+            return {**older, **newer}
+        return newer
+
+    @staticmethod
+    def _apply_pending(data, pending):
+        """Áp các thay đổi đang chờ lên một bản dữ liệu của bin."""
+        for user_id, record in pending.items():
+            existing = data.get(user_id)
+            if record is None:
+                data.pop(user_id, None)
+            elif isinstance(record, dict) and isinstance(existing, dict):
+                data[user_id] = {**existing, **record}
+            elif not isinstance(record, dict) or record.get('access_token'):
+                data[user_id] = record
+            # Bản vá (vd: chỉ roster_position) cho hồ sơ không tồn tại thì bỏ qua
+        return data
+
+    def _read_overlay(self, bin_ids):
+        """Đọc các bin, gộp thành dữ liệu logic và áp các thay đổi chưa flush."""
+        data = {}
+        for part in self._read_bins(bin_ids).values():
+            data.update(part)
+        with self._state_lock:
+            pending = {uid: rec for uid, rec in self._pending.items() if self._bin_for_key(uid) in bin_ids}
+            return self._apply_pending(data, pending)
+
+    def read_data(self):
+        """Đọc toàn bộ sổ token (mọi shard + roster), đã bao gồm các thay đổi chưa flush."""
+        self._ensure_layout()
+        if not self.bin_id:
+            return {}
+        return self._read_overlay(self._token_bins())
+
+    def write_data(self, data):
+        """Ghi đè toàn bộ sổ token qua writer duy nhất (các thay đổi đang chờ vẫn được giữ lại)."""
+        self._ensure_layout()
+        with self._writer_lock:
+            with self._state_lock:
+                self._apply_pending(data, dict(self._pending))
+                # Ghi đè toàn bộ: dựng lại bản sao thứ tự roster ở lần dùng tới
+                self._roster = self._roster_loading = None
+            bin_ids = self._token_bins() if self.bin_id else []
+            if not bin_ids:
+                return bool(self.create_bin(data))
+            return all(self._write_bin(bin_id, part) for bin_id, part in self._split(data, bin_ids).items())
+
+    def read_tracked_channels(self):
+        """Dữ liệu của channel tracker ('tracked_channels'), đọc từ bin chứa nó."""
+        self._ensure_layout()
+        if not self.bin_id:
+            return {}
+        tracked = self._read_bin(self._bin_for_key('tracked_channels')).get('tracked_channels')
+        return tracked if isinstance(tracked, dict) else {}
+
+    def update_tracked_channels(self, mutate):
+        """
+        Đọc-sửa-ghi 'tracked_channels' qua writer duy nhất, trong cùng lượt flush với các thay đổi
+        token đang chờ (bố trí legacy dùng chung một bin nên hai bên không ghi đè lên nhau).
+        `mutate(tracked)` sửa dict tại chỗ.
+        """
+        def mutator(data):
+            tracked = data.get('tracked_channels')
+            if not isinstance(tracked, dict):
+                tracked = {}
+            mutate(tracked)
+            data['tracked_channels'] = tracked
+
+        self._ensure_layout()
+        return self.flush(mutator, bins=[self._bin_for_key('tracked_channels')])
+
+    @staticmethod
+    def _roster_apply(roster, user_id, record):
+        """Áp một thay đổi hồ sơ lên bản sao thứ tự roster (cùng quy tắc với _apply_pending)."""
+        if user_id == '_roster_order':
+            roster['_roster_order'] = record if isinstance(record, list) else []
+        elif not user_id.isdigit():
+            return
+        elif record is None:
+            roster.pop(user_id, None)
+        elif isinstance(record, dict):
+            if user_id in roster:
+                if 'roster_position' in record:
+                    roster[user_id] = record['roster_position']
+            elif record.get('access_token'):
+                roster[user_id] = record.get('roster_position')
+
+    def _roster_snapshot(self):
+        """
+        Thứ tự roster hiện tại dạng dữ liệu JSONBin rút gọn (chỉ roster_position), dùng cho
+        order_roster_from_jsonbin. Chỉ lần đầu phải đọc toàn bộ sổ token.
+        """
+        with self._state_lock:
+            loading = self._roster is None and self._roster_loading is None
+            if loading:
+                changes = self._roster_loading = []
+        if loading:
+            try:
+                data = self.read_data()
+            except Exception:
+                with self._state_lock:
+                    if self._roster_loading is changes:
+                        self._roster_loading = None
+                raise
+            roster = {'_roster_order': data.get('_roster_order') or []}
+            for user_id, record in data.items():
+                if user_id.isdigit() and isinstance(record, dict):
+                    roster[user_id] = record.get('roster_position')
+            with self._state_lock:
+                # Bỏ kết quả nếu sổ token bị ghi đè toàn bộ trong lúc đọc
+                if self._roster_loading is changes:
+                    for user_id, record in changes:
+                        self._roster_apply(roster, user_id, record)
+                    self._roster, self._roster_loading = roster, None
+        with self._state_lock:
+            if self._roster is not None:
+                return {key: (value if key == '_roster_order' else {'roster_position': value})
+                        for key, value in self._roster.items()}
+        # Thread khác đang dựng bản sao (hoặc vừa ghi đè toàn bộ): đọc trực tiếp lần này
+        return self.read_data()
+
+    def _enqueue(self, user_id, record):
+        with self._state_lock:
+            user_id = str(user_id)
+            if self._roster is not None:
+                self._roster_apply(self._roster, user_id, record)
+            elif self._roster_loading is not None:
+                self._roster_loading.append((user_id, record))
+            if user_id in self._pending:
+                record = self._merge(self._pending[user_id], record)
+            self._pending[user_id] = record
+            if self._flusher is None or not self._flusher.is_alive():
+                self._flusher = threading.Thread(target=self._flush_loop, name='jsonbin-flusher', daemon=True)
+                self._flusher.start()
+
+    def _flush_loop(self):
+        while True:
+            self._wake.wait(self.flush_interval)
+            self._wake.clear()
+            self.flush()
+
+    def pending_count(self):
+        with self._state_lock:
+            return len(self._pending)
+
+    def flush(self, mutator=None, bins=None):
+        """
+        Gộp mọi thay đổi đang chờ thành một lần đọc + một lần ghi cho mỗi bin bị ảnh hưởng.
+        `mutator(data)` (tùy chọn) được áp thêm trong cùng lượt ghi trên các bin `bins` (mặc định
+        toàn bộ sổ token), dùng cho các thao tác đọc-sửa-ghi khác (vd: sắp xếp roster, tracker).
+        """
+        with self._writer_lock:
+            with self._state_lock:
+                batch, self._pending = self._pending, {}
+            if not batch and mutator is None:
+                return True
+            self._ensure_layout()
+            if not self.bin_id and not self.create_bin():
+                success = False
+            else:
+                # Chỉ đọc/ghi các bin thật sự bị ảnh hưởng
+                base = (bins or self._token_bins()) if mutator is not None else []
+                bin_ids = list(dict.fromkeys([*base, *(self._bin_for_key(uid) for uid in batch)]))
+
+                # Đọc thất bại (hoặc breaker đang ngắt) thì không ghi đè bin bằng dữ liệu thiếu
+                parts = self._read_bins(bin_ids, strict=True)
+                if any(part is None for part in parts.values()):
+                    success = False
+                else:
+                    before = {bin_id: json.dumps(part, sort_keys=True) for bin_id, part in parts.items()}
+                    data = {}
+                    for part in parts.values():
+                        data.update(part)
+                    self._apply_pending(data, batch)
+                    if mutator is not None:
+                        mutator(data)
+
+                    success = True
+                    for bin_id, part in self._split(data, bin_ids).items():
+                        if json.dumps(part, sort_keys=True) != before[bin_id]:
+                            success = self._write_bin(bin_id, part) and success
+
+            if success:
+                self.flush_count += 1
+                self.last_flush_at = time.time()
+                if batch:
+                    print(f"[Storage] Flushed {len(batch)} JSONBin mutations in one write.")
+            else:
+                # Trả lại các thay đổi chưa ghi được; thay đổi mới hơn (nếu có) được ưu tiên
+                with self._state_lock:
+                    for user_id, record in batch.items():
+                        if user_id in self._pending:
+                            record = self._merge(record, self._pending[user_id])
+                        self._pending[user_id] = record
+            return success
+
+    def update_data(self, mutator):
+        """Đọc-sửa-ghi toàn bộ sổ token qua writer duy nhất (kèm flush các thay đổi đang chờ)."""
+        return self.flush(mutator)
     
     def get_user_token(self, user_id):
-        """Lấy token của user từ JSONBin"""
-        data = self.read_data()
+        """Lấy token của user từ JSONBin (chỉ đọc shard của user)"""
+        self._ensure_layout()
+        if not self.bin_id:
+            return None
+        data = self._read_overlay([self._bin_for_key(str(user_id))])
         user_data = data.get(str(user_id))
         
         if isinstance(user_data, dict):
             return user_data.get('access_token')
         return user_data
     
-    def save_user_token(self, user_id, access_token, username=None, avatar_hash=None):
-        """Lưu token của user vào JSONBin"""
-        data = self.read_data()
-        
-        data[str(user_id)] = {
-            'access_token': access_token,
-            'username': username,
-            'avatar_hash': avatar_hash,
-            'updated_at': str(time.time())
+    def get_user_tokens(self, user_ids):
+        """Lấy token của nhiều user, mỗi shard liên quan chỉ đọc một lần. Trả về {user_id: access_token}."""
+        self._ensure_layout()
+        if not self.bin_id:
+            return {}
+        data = self._read_overlay(list(dict.fromkeys(self._bin_for_key(str(uid)) for uid in user_ids)))
+        tokens = {}
+        for user_id in user_ids:
+            user_data = data.get(str(user_id))
+            access_token = user_data.get('access_token') if isinstance(user_data, dict) else user_data
+            if access_token:
+                tokens[str(user_id)] = access_token
+        return tokens
+
+    def save_user_token(self, user_id, access_token, username=None, avatar_hash=None, **metadata):
+        """Lưu token của user vào JSONBin (ghi trễ, flush theo lô)"""
+        return self.save_user_tokens([(user_id, dict(metadata, access_token=access_token, username=username, avatar_hash=avatar_hash))]) == 1
+
+    def save_user_tokens(self, records):
+        """
+        Xếp hàng ghi nhiều [(user_id, data)] cùng lúc; caller gọi flush() một lần sau cùng.
+        Trường None không được ghi nên giá trị đã lưu (vd: refresh_token) được giữ nguyên. Trả về số bản ghi.
+        """
+        now = str(time.time())
+        queued = 0
+        for user_id, data in records:
+            if not isinstance(data, dict):
+                data = {'access_token': data}
+            if not data.get('access_token'):
+                continue
+            record = {field: data[field] for field in TOKEN_METADATA_FIELDS if data.get(field) is not None}
+            record.update(access_token=data['access_token'], updated_at=now)
+            self._enqueue(user_id, record)
+            queued += 1
+        return queued
+
+    def iter_user_records(self):
+        """Duyệt (user_id, data) theo từng shard, mỗi shard chỉ đọc một lần (đã gồm thay đổi chưa flush)."""
+        self._ensure_layout()
+        if not self.bin_id:
+            return
+        for bin_id in (self.layout['shards'] if self.layout else [self.bin_id]):
+            for key, value in self._read_overlay([bin_id]).items():
+                if key.isdigit():
+                    yield key, value
+
+    def get_roster_order(self):
+        """Danh sách '_roster_order' (chỉ đọc bin chứa nó)."""
+        self._ensure_layout()
+        if not self.bin_id:
+            return []
+        roster_order = self._read_overlay([self._bin_for_key('_roster_order')]).get('_roster_order')
+        return roster_order if isinstance(roster_order, list) else []
+
+    def set_roster_positions(self, positions, drop_legacy_order=False):
+        """Xếp hàng ghi roster_position cho {user_id: position}; mỗi hồ sơ là một bản vá nhỏ."""
+        for user_id, position in positions.items():
+            self._enqueue(user_id, {'roster_position': position})
+        if drop_legacy_order:
+            self._enqueue('_roster_order', None)
+
+    def move_roster_position(self, user_id, position):
+        """
+        Di chuyển một điệp viên đến vị trí `position` (bắt đầu từ 1): chỉ hồ sơ của user đó được ghi.
+        Dữ liệu cũ (chỉ có '_roster_order') được gán vị trí cho mọi hồ sơ một lần duy nhất.
+        Trả về None nếu user không có trong roster, ngược lại là kết quả flush.
+        Vị trí hàng xóm lấy từ bản sao thứ tự roster trong bộ nhớ, không đọc lại mọi shard.
+        """
+        agents = order_roster_from_jsonbin(self._roster_snapshot())
+        if not any(agent['id'] == user_id for agent in agents):
+            return None
+        if any(agent['roster_position'] is None for agent in agents):
+            for index, agent in enumerate(agents):
+                agent['roster_position'] = (index + 1) * ROSTER_POSITION_GAP
+            self.set_roster_positions({agent['id']: agent['roster_position'] for agent in agents}, drop_legacy_order=True)
+
+        others = [agent for agent in agents if agent['id'] != user_id]
+        index = min(position - 1, len(others))
+        before = others[index - 1]['roster_position'] if index > 0 else None
+        after = others[index]['roster_position'] if index < len(others) else None
+        new_position = roster_position_between(before, after)
+        if new_position is None:
+            # Hết độ chính xác giữa hai hàng xóm: đánh số lại toàn bộ (rất hiếm)
+            order = [agent['id'] for agent in others]
+            order.insert(index, user_id)
+            self.set_roster_positions({uid: (i + 1) * ROSTER_POSITION_GAP for i, uid in enumerate(order)})
+        else:
+            self.set_roster_positions({user_id: new_position})
+        return self.flush()
+
+    def reorder_roster(self, user_ids):
+        """
+        Đặt lại toàn bộ thứ tự: `user_ids` đứng đầu theo đúng thứ tự, phần còn lại giữ thứ tự cũ.
+        Chỉ hồ sơ đổi vị trí mới được ghi. Trả về {user_id: position} (None nếu ghi thất bại).
+        """
+        snapshot = self._roster_snapshot()
+        agents = order_roster_from_jsonbin(snapshot)
+        known = {agent['id']: agent for agent in agents}
+        listed = [uid for uid in dict.fromkeys(user_ids) if uid in known]
+        listed_set = set(listed)
+        order = listed + [agent['id'] for agent in agents if agent['id'] not in listed_set]
+        positions = {uid: (i + 1) * ROSTER_POSITION_GAP for i, uid in enumerate(order)}
+        self.set_roster_positions(
+            {uid: pos for uid, pos in positions.items() if known[uid]['roster_position'] != pos},
+            drop_legacy_order=bool(snapshot.get('_roster_order'))
+        )
+        return positions if self.flush() else None
+
+    def delete_user(self, user_id, flush_now=False):
+        """Xóa một user khỏi JSONBin (thứ tự roster nằm trong hồ sơ nên không phải sửa danh sách nào)."""
+        self._enqueue(user_id, None)
+        print(f"[Storage] Đã xếp lịch xóa user {user_id} khỏi JSONBin.")
+        if flush_now:
+            return self.flush()
+        return True
+
+    def delete_users(self, user_ids):
+        """Xóa nhiều user khỏi JSONBin bằng một lượt flush."""
+        for user_id in user_ids:
+            self._enqueue(user_id, None)
+        print(f"[Storage] Đã xếp lịch xóa {len(user_ids)} user khỏi JSONBin.")
+        return self.flush()
+
+    def payload_stats(self):
+        """Số bytes trung bình mỗi lần đọc/ghi bin kể từ khi khởi động."""
+        stats = {}
+        for op, (count, total) in self.io_stats.items():
+            stats[op] = {"ops": count, "avg_bytes": total // count if count else 0}
+        return stats
+
+    def migrate_to_sharded(self, shard_count):
+        """
+        Chuyển bin legacy sang bố trí sharded. Trả về báo cáo kích thước (bytes JSON) trước/sau.
+        Bin legacy được sao lưu sang một bin riêng trước khi bị thay bằng manifest. Mỗi bin mới được
+        đọc lại sau khi ghi: kích thước báo cáo là kích thước thật đã lưu trên JSONBin, và bin legacy
+        chỉ bị thay khi mọi bin mới đọc lại khớp với dữ liệu đã ghi.
+        """
+        self._ensure_layout()
+        with self._writer_lock:
+            if self.layout:
+                return {"error": "Bin đã ở bố trí sharded."}
+            self.flush()
+            legacy = self._read_bin(self.bin_id)
+            legacy_bytes = len(json.dumps(legacy))
+
+            backup_bin = self._create_bin(legacy)
+            if not backup_bin:
+                return {"error": "Không tạo được bin sao lưu."}
+
+            shard_parts = [{} for _ in range(shard_count)]
+            roster_part = {'_roster_order': legacy.get('_roster_order', [])}
+            tracker_part = {'tracked_channels': legacy.get('tracked_channels', {})}
+            for key, value in legacy.items():
+                if key in ('_roster_order', 'tracked_channels'):
+                    continue
+                shard_parts[jsonbin_shard_index(key, shard_count)][key] = value
+
+            shard_bins = [self._create_bin(part) for part in shard_parts]
+            roster_bin = self._create_bin(roster_part)
+            tracker_bin = self._create_bin(tracker_part)
+            if not all(shard_bins) or not roster_bin or not tracker_bin:
+                return {"error": "Không tạo được đủ bin mới, bin legacy được giữ nguyên."}
+
+            sizes = {}
+            written = list(zip(shard_bins, shard_parts)) + [(roster_bin, roster_part), (tracker_bin, tracker_part)]
+            for bin_id, part in written:
+                stored = self._read_bin(bin_id, strict=True)
+                if stored != part:
+                    return {"error": f"Bin mới `{bin_id}` đọc lại không khớp dữ liệu đã ghi, bin legacy được giữ nguyên."}
+                sizes[bin_id] = len(json.dumps(stored))
+
+            layout = {
+                'version': 2,
+                'shards': shard_bins,
+                'roster_bin': roster_bin,
+                'tracker_bin': tracker_bin,
+                'backup_bin': backup_bin,
+                'migrated_at': str(time.time()),
+            }
+            manifest = {'_layout': layout}
+            if not self._write_bin(self.bin_id, manifest):
+                return {"error": "Không ghi được manifest, bin legacy được giữ nguyên."}
+            self.layout = layout
+
+            return {
+                "shards": shard_count,
+                "tracker_bin": tracker_bin,
+                "backup_bin": backup_bin,
+                "before": {"legacy": legacy_bytes},
+                "after": {
+                    "shards": [sizes[bin_id] for bin_id in shard_bins],
+                    "roster": sizes[roster_bin],
+                    "tracker": sizes[tracker_bin],
+                    "manifest": len(json.dumps(self._read_bin(self.bin_id))),
+                },
+            }
+
+# Khởi tạo JSONBin storage
+jsonbin_storage = JSONBinStorage()
+jsonbin_breaker.probe = jsonbin_storage.ping
+atexit.register(jsonbin_storage.flush)  # Không để mất thay đổi đang chờ khi tắt bot
+
+# --- DATABASE CONNECTION POOL ---
+class PostgresPool:
+    """
+    Pool connection PostgreSQL có giới hạn, dùng chung cho bot và Flask thread.
+    - Tối đa `max_size` connection mở cùng lúc, chờ tối đa `max_wait` giây khi pool đầy.
+    - Connection nhàn rỗi quá `max_idle` giây sẽ bị đóng (idle recycling).
+    - Connection nhàn rỗi quá `health_check_after` giây được kiểm tra bằng `SELECT 1` trước khi dùng lại.
+    """
+    def __init__(self, dsn, max_size=10, max_wait=5.0, max_idle=300.0, health_check_after=30.0):
+        self.dsn = dsn
+        self.max_size = max_size
+        self.max_wait = max_wait
+        self.max_idle = max_idle
+        self.health_check_after = health_check_after
+        self._idle = []   # [(conn, last_used)]
+        self._cond = threading.Condition()
+        self.in_use = 0
+        self.waiting = 0
+        self.created = 0
+        self.recycled = 0
+        self.timeouts = 0
+        self.connect_errors = 0
+
+    def _connect(self):
+        conn = psycopg2.connect(self.dsn, sslmode='require', connect_timeout=10)
+        with self._cond:
+            self.created += 1
+        return conn
+
+    @staticmethod
+    def _discard(conn):
+        try:
+            conn.close()
+        except Exception:
+            pass
+
+    def _prune_idle(self):
+        """Đóng các connection nhàn rỗi quá lâu (phải giữ self._cond)."""
+        now = time.monotonic()
+        keep = []
+        for conn, last_used in self._idle:
+            if conn.closed or now - last_used > self.max_idle:
+                self._discard(conn)
+                self.recycled += 1
+            else:
+                keep.append((conn, last_used))
+        self._idle = keep
+
+    def _is_healthy(self, conn, last_used):
+        if conn.closed:
+            return False
+        if time.monotonic() - last_used < self.health_check_after:
+            return True
+        try:
+            cursor = conn.cursor()
+            cursor.execute("SELECT 1")
+            cursor.fetchone()
+            cursor.close()
+            conn.rollback()
+            return True
+        except Exception:
+            return False
+
+    def acquire(self):
+        """Mượn một connection; trả về None nếu hết thời gian chờ hoặc không kết nối được."""
+        deadline = time.monotonic() + self.max_wait
+        while True:
+            with self._cond:
+                self._prune_idle()
+                reused = None
+                while not self._idle and self.in_use >= self.max_size:
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        self.timeouts += 1
+                        print(f"Database pool timeout: {self.in_use}/{self.max_size} connections in use")
+                        return None
+                    self.waiting += 1
+                    try:
+                        self._cond.wait(remaining)
+                    finally:
+                        self.waiting -= 1
+                if self._idle:
+                    reused = self._idle.pop()
+                self.in_use += 1
+
+            if reused is not None:
+                conn, last_used = reused
+                if self._is_healthy(conn, last_used):
+                    return conn
+                self._discard(conn)
+                with self._cond:
+                    self.recycled += 1
+
+            try:
+                return self._connect()
+            except Exception as e:
+                print(f"Database connection error: {e}")
+                with self._cond:
+                    self.connect_errors += 1
+                    self.in_use -= 1
+                    self._cond.notify()
+                return None
+
+    def release(self, conn):
+        """Trả connection về pool (rollback nếu còn transaction dở)."""
+        healthy = not conn.closed
+        if healthy and conn.get_transaction_status() != psycopg2.extensions.TRANSACTION_STATUS_IDLE:
+            try:
+                conn.rollback()
+            except Exception:
+                healthy = False
+        with self._cond:
+            self.in_use -= 1
+            if healthy:
+                self._idle.append((conn, time.monotonic()))
+            else:
+                self._discard(conn)
+            self._cond.notify()
+
+    def stats(self):
+        with self._cond:
+            return {
+                "in_use": self.in_use,
+                "idle": len(self._idle),
+                "waiting": self.waiting,
+                "created": self.created,
+                "recycled": self.recycled,
+                "timeouts": self.timeouts,
+                "connect_errors": self.connect_errors,
+                "max_size": self.max_size,
+            }
+
+db_pool = PostgresPool(
+    DATABASE_URL,
+    max_size=int(os.getenv('DB_POOL_MAX_SIZE', 10)),
+    max_wait=float(os.getenv('DB_POOL_MAX_WAIT', 5)),
+    max_idle=float(os.getenv('DB_POOL_MAX_IDLE', 300)),
+) if DATABASE_URL and HAS_PSYCOPG2 else None
+
+@contextmanager
+def db_connection():
+    """Mượn connection từ pool trong khối `with` (None nếu database không khả dụng hoặc breaker đang ngắt)."""
+    conn = None
+    if db_pool and db_breaker.allow():
+        connect_errors = db_pool.connect_errors
+        conn = db_pool.acquire()
+        if conn is not None:
+            db_breaker.record_success()
+        elif db_pool.connect_errors > connect_errors:
+            # Hết lượt chờ trong pool không phải lỗi database, chỉ tính lỗi kết nối
+            db_breaker.record_failure()
+    try:
+        yield conn
+    finally:
+        if conn is not None:
+            if conn.closed:
+                db_breaker.record_failure()
+            db_pool.release(conn)
+
+def probe_database():
+    """Probe cho circuit breaker: mở connection trực tiếp qua pool, không qua breaker."""
+    conn = db_pool.acquire()
+    if conn is None:
+        return False
+    db_pool.release(conn)
+    return True
+
+if db_pool:
+    db_breaker.probe = probe_database
+
+def is_database_available():
+    """Kiểm tra nhanh database qua pool (không mở connection mới nếu còn connection nhàn rỗi)."""
+    with db_connection() as conn:
+        return conn is not None
+
+# --- DATABASE SETUP ---
+
+def _renumber_roster_positions(cursor, roster_order):
+    """
+    Đánh số lại roster_position: các user trong `roster_order` đứng đầu theo đúng thứ tự đó,
+    phần còn lại giữ thứ tự hiện có (chưa có vị trí thì theo thời gian tạo).
+    """
+    roster_order = [int(uid) for uid in roster_order if str(uid).isdigit()]
+    cursor.execute('''
+        UPDATE user_tokens AS t
+        SET roster_position = ordered.rn * %s
+        FROM (
+            SELECT user_id, ROW_NUMBER() OVER (
+                ORDER BY array_position(%s::BIGINT[], user_id) NULLS LAST, roster_position, created_at, user_id
+            ) AS rn
+            FROM user_tokens
+        ) AS ordered
+        WHERE t.user_id = ordered.user_id
+        RETURNING t.user_id, t.roster_position
+    ''', (ROSTER_POSITION_GAP, roster_order))
+    return {str(user_id): position for user_id, position in cursor.fetchall()}
+
+def _backfill_roster_positions(cursor):
+    """Gán roster_position theo '_roster_order' trên JSONBin (nếu có), phần còn lại theo thời gian tạo."""
+    roster_order = jsonbin_storage.get_roster_order() if JSONBIN_API_KEY else []
+    _renumber_roster_positions(cursor, roster_order)
+    print(f"✅ Backfilled roster positions ({len(roster_order)} from JSONBin order)")
+
+def _drop_non_numeric_user_ids(cursor):
+    """
+    Trước khi đổi user_id sang BIGINT: chép các hàng có user_id không phải số sang bảng sao lưu
+    user_tokens_invalid_ids, ghi log số lượng và ID, rồi mới xóa khỏi user_tokens.
+    """
+    cursor.execute("SELECT user_id FROM user_tokens WHERE user_id::TEXT !~ '^[0-9]+$'")
+    invalid_ids = [str(row[0]) for row in cursor.fetchall()]
+    if not invalid_ids:
+        return
+    cursor.execute("CREATE TABLE IF NOT EXISTS user_tokens_invalid_ids AS SELECT * FROM user_tokens WITH NO DATA")
+    cursor.execute("INSERT INTO user_tokens_invalid_ids SELECT * FROM user_tokens WHERE user_id::TEXT !~ '^[0-9]+$'")
+    cursor.execute("DELETE FROM user_tokens WHERE user_id::TEXT !~ '^[0-9]+$'")
+    print(f"⚠️ Removed {len(invalid_ids)} token(s) with non-numeric user_id "
+          f"(backed up to user_tokens_invalid_ids): {', '.join(invalid_ids)}")
+
+# Mỗi migration: (version, mô tả, [câu SQL hoặc hàm nhận cursor]). Chỉ thêm mới, không sửa bản đã phát hành.
+SCHEMA_MIGRATIONS = [
+    (1, "create user_tokens", ['''
+        CREATE TABLE IF NOT EXISTS user_tokens (
+            user_id VARCHAR(50) PRIMARY KEY,
+            access_token TEXT NOT NULL,
+            username VARCHAR(100),
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+    ''']),
+    (2, "add avatar_hash", [
+        "ALTER TABLE user_tokens ADD COLUMN IF NOT EXISTS avatar_hash VARCHAR(100)",
+    ]),
+    (3, "store user_id as BIGINT", [
+        _drop_non_numeric_user_ids,
+        "ALTER TABLE user_tokens ALTER COLUMN user_id TYPE BIGINT USING user_id::BIGINT",
+    ]),
+    (4, "add indexed roster_position", [
+        "ALTER TABLE user_tokens ADD COLUMN IF NOT EXISTS roster_position DOUBLE PRECISION",
+        _backfill_roster_positions,
+        "CREATE INDEX IF NOT EXISTS idx_user_tokens_roster ON user_tokens (roster_position, user_id)",
+    ]),
+    (5, "add token metadata", [
+        "ALTER TABLE user_tokens ADD COLUMN IF NOT EXISTS refresh_token TEXT",
+        "ALTER TABLE user_tokens ADD COLUMN IF NOT EXISTS scope TEXT",
+        "ALTER TABLE user_tokens ADD COLUMN IF NOT EXISTS expires_at TIMESTAMP",
+    ]),
+    (6, "index token expiry for the refresh scheduler", [
+        "CREATE INDEX IF NOT EXISTS idx_user_tokens_expires ON user_tokens (expires_at) WHERE refresh_token IS NOT NULL",
+    ]),
+    (7, "add token health status", [
+        "ALTER TABLE user_tokens ADD COLUMN IF NOT EXISTS token_status VARCHAR(16)",
+        "ALTER TABLE user_tokens ADD COLUMN IF NOT EXISTS token_checked_at TIMESTAMP",
+    ]),
+]
+
+def apply_schema_migrations(conn):
+    """Áp các migration chưa chạy theo thứ tự version, mỗi migration trong một transaction riêng."""
+    cursor = conn.cursor()
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS schema_migrations (
+            version INTEGER PRIMARY KEY,
+            description TEXT,
+            applied_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+    ''')
+    conn.commit()
+
+    applied = []
+    for version, description, steps in SCHEMA_MIGRATIONS:
+        # Khóa advisory để nhiều instance khởi động cùng lúc không chạy trùng migration
+        cursor.execute("SELECT pg_advisory_xact_lock(%s)", (0x1A7E1,))
+        cursor.execute("SELECT 1 FROM schema_migrations WHERE version = %s", (version,))
+        if cursor.fetchone():
+            conn.commit()
+            continue
+        try:
+            for step in steps:
+                if callable(step):
+                    step(cursor)
+                else:
+                    cursor.execute(step)
+            cursor.execute(
+                "INSERT INTO schema_migrations (version, description) VALUES (%s, %s)",
+                (version, description)
+            )
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            cursor.close()
+            raise
+        applied.append(version)
+        print(f"✅ Applied schema migration {version}: {description}")
+    cursor.close()
+    return applied
+
+def init_database():
+    """Khởi tạo database và áp các schema migration còn thiếu"""
+    if not DATABASE_URL or not HAS_PSYCOPG2:
+        print("⚠️ WARNING: Không có DATABASE_URL hoặc psycopg2, sử dụng JSONBin.io")
+        return False
+    
+    with db_connection() as conn:
+        if not conn:
+            print("🔄 Falling back to JSONBin.io storage")
+            return False
+        try:
+            apply_schema_migrations(conn)
+            print(f"✅ Database initialized successfully (schema v{SCHEMA_MIGRATIONS[-1][0]})")
+            return True
+            
+        except Exception as e:
+            print(f"❌ Database migration failed: {e}")
+            print("🔄 Falling back to JSONBin.io storage")
+            return False
+
+# --- DATABASE FUNCTIONS ---
+def get_user_access_token_db(user_id: str):
+    """Lấy access token từ database"""
+    with db_connection() as conn:
+        if conn:
+            try:
+                cursor = conn.cursor()
+                cursor.execute("SELECT access_token FROM user_tokens WHERE user_id = %s", (user_id,))
+                result = cursor.fetchone()
+                cursor.close()
+                return result[0] if result else None
+            except Exception as e:
+                print(f"Database error: {e}")
+                db_breaker.record_failure()
+    return None
+
+def get_user_access_tokens_db(user_ids: list):
+    """Lấy access token của nhiều user bằng một truy vấn. Trả về {user_id: access_token}."""
+    with db_connection() as conn:
+        if conn:
+            try:
+                cursor = conn.cursor()
+                cursor.execute(
+                    "SELECT user_id, access_token FROM user_tokens WHERE user_id = ANY(%s::BIGINT[])",
+                    ([int(uid) for uid in user_ids if str(uid).isdigit()],)
+                )
+                rows = cursor.fetchall()
+                cursor.close()
+                return {str(uid): access_token for uid, access_token in rows if access_token}
+            except Exception as e:
+                print(f"Database error: {e}")
+                db_breaker.record_failure()
+    return {}
+
+def save_user_token_db(user_id: str, access_token: str, username: str = None, avatar_hash: str = None, **metadata):
+    """Lưu access token (kèm refresh_token/expires_at/scope nếu có) vào database"""
+    record = dict(metadata, access_token=access_token, username=username, avatar_hash=avatar_hash)
+    if save_user_tokens_db([(user_id, record)]) == 1:
+        print(f"✅ Saved token for user {user_id} to database")
+        return True
+    return False
+
+# --- LOCAL STORE FUNCTIONS (SQLite, thay thế tokens.json) ---
+local_store = LocalTokenStore()
+
+local_breaker.probe = lambda: local_store.count() is not None
+
+def _call_local(func, *args, default=None):
+    """Gọi kho SQLite qua circuit breaker; lỗi sqlite3 trả về `default`."""
+    if not local_breaker.allow():
+        return default
+    try:
+        result = func(*args)
+    except sqlite3.Error as e:
+        print(f"Local store error: {e}")
+        local_breaker.record_failure()
+        return default
+    local_breaker.record_success()
+    return result
+
+def get_user_access_token_local(user_id: str):
+    """Backup: Lấy token từ kho SQLite cục bộ"""
+    return _call_local(local_store.get_token, user_id)
+
+def get_user_access_tokens_local(user_ids: list):
+    """Backup: Lấy token của nhiều user từ kho SQLite cục bộ"""
+    return _call_local(local_store.get_tokens, user_ids, default={})
+
+def save_user_token_local(user_id: str, access_token: str, username: str = None, avatar_hash: str = None, **metadata):
+    """Backup: Lưu token vào kho SQLite cục bộ"""
+    save = functools.partial(local_store.save_token, **metadata)
+    if _call_local(save, user_id, access_token, username, avatar_hash, default=False):
+        print(f"✅ Saved token for user {user_id} to local store")
+        return True
+    return False
+
+def save_user_tokens_local(records):
+    """Backup: Ghi nhiều [(user_id, data)] vào kho SQLite trong một transaction"""
+    return _call_local(local_store.bulk_upsert, records, default=0)
+
+# --- TOKEN CACHE ---
+class _CacheFlight:
+    """Một lượt tải token đang chạy, các luồng khác chờ kết quả thay vì tải lại."""
+    def __init__(self):
+        self.event = threading.Event()
+        self.result = None
+
+class TokenCache:
+    """
+    Cache token trong bộ nhớ với TTL + LRU, dùng chung cho bot và Flask thread.
+    User chưa ủy quyền được nhớ riêng (negative cache, TTL ngắn hơn) để không phải hỏi lại mọi tầng.
+    """
+    def __init__(self, ttl=TOKEN_CACHE_TTL, max_size=TOKEN_CACHE_MAX_SIZE, negative_ttl=TOKEN_CACHE_NEGATIVE_TTL):
+        self.ttl = ttl
+        self.max_size = max_size
+        self.negative_ttl = negative_ttl
+        self._entries = OrderedDict()  # user_id -> (access_token, expires_at)
+        self._negatives = OrderedDict()  # user_id -> expires_at
+        self._flights = {}             # user_id -> _CacheFlight
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.negative_hits = 0
+
+    def _store(self, user_id_str, access_token):
+        """Ghi một entry (phải giữ self._lock)."""
+        self._negatives.pop(user_id_str, None)
+        self._entries[user_id_str] = (access_token, time.monotonic() + self.ttl)
+        self._entries.move_to_end(user_id_str)
+        while len(self._entries) > self.max_size:
+            self._entries.popitem(last=False)
+
+    def _is_negative(self, user_id_str):
+        """True nếu user đang được nhớ là chưa ủy quyền (phải giữ self._lock)."""
+        expires_at = self._negatives.get(user_id_str)
+        if expires_at is None:
+            return False
+        if expires_at <= time.monotonic():
+            del self._negatives[user_id_str]
+            return False
+        return True
+
+    def set_negative(self, user_ids):
+        """Ghi nhớ các user không có token ở bất kỳ tầng nào."""
+        expires_at = time.monotonic() + self.negative_ttl
+        with self._lock:
+            for user_id in user_ids:
+                self._negatives[str(user_id)] = expires_at
+                self._negatives.move_to_end(str(user_id))
+            while len(self._negatives) > self.max_size:
+                self._negatives.popitem(last=False)
+
+    def is_negative(self, user_id):
+        with self._lock:
+            return self._is_negative(str(user_id))
+
+    def _lookup(self, user_id_str):
+        """Đọc một entry còn hạn (phải giữ self._lock)."""
+        entry = self._entries.get(user_id_str)
+        if entry is None:
+            return None
+        access_token, expires_at = entry
+        if expires_at <= time.monotonic():
+            del self._entries[user_id_str]
+            return None
+        self._entries.move_to_end(user_id_str)
+        return access_token
+
+    def get(self, user_id, count_hit=False):
+        with self._lock:
+            access_token = self._lookup(str(user_id))
+            if access_token and count_hit:
+                self.hits += 1
+            return access_token
+
+    def set(self, user_id, access_token):
+        if not access_token:
+            return
+        with self._lock:
+            self._store(str(user_id), access_token)
+
+    def invalidate(self, user_id):
+        with self._lock:
+            self._entries.pop(str(user_id), None)
+            self._negatives.pop(str(user_id), None)
+
+    def load_many(self, tokens: dict):
+        """Nạp hàng loạt {user_id: access_token} vào cache."""
+        with self._lock:
+            for user_id, access_token in tokens.items():
+                if access_token:
+                    self._store(str(user_id), access_token)
+
+    def get_or_load(self, user_id, loader):
+        """
+        Trả về token từ cache; nếu miss thì gọi loader(user_id_str) -> (access_token, complete).
+        Nhiều lượt miss cùng lúc cho một user chỉ chạy loader một lần. Kết quả "không có token"
+        chỉ được nhớ khi `complete` (mọi tầng đều đã trả lời, không tầng nào lỗi).
+        """
+        user_id_str = str(user_id)
+        with self._lock:
+            access_token = self._lookup(user_id_str)
+            if access_token:
+                self.hits += 1
+                return access_token
+            if self._is_negative(user_id_str):
+                self.negative_hits += 1
+                return None
+            self.misses += 1
+            flight = self._flights.get(user_id_str)
+            is_leader = flight is None
+            if is_leader:
+                flight = self._flights[user_id_str] = _CacheFlight()
+
+        if not is_leader:
+            flight.event.wait(timeout=30)
+            return flight.result
+
+        try:
+            flight.result, complete = loader(user_id_str)
+            if flight.result:
+                self.set(user_id_str, flight.result)
+            elif complete:
+                self.set_negative([user_id_str])
+            return flight.result
+        finally:
+            with self._lock:
+                self._flights.pop(user_id_str, None)
+            flight.event.set()
+
+    def stats(self):
+        with self._lock:
+            size = len(self._entries)
+            negatives = len(self._negatives)
+        total = self.hits + self.misses
+        hit_rate = (self.hits / total * 100) if total else 0.0
+        return {
+            "size": size,
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": round(hit_rate, 1),
+            "negatives": negatives,
+            "negative_hits": self.negative_hits,
         }
-        
-        return self.write_data(data)
 
-    def delete_user(self, user_id):
-        """Xóa một user khỏi JSONBin, bao gồm cả trong danh sách thứ tự."""
-        full_data = self.read_data()
-        user_id_str = str(user_id)
-        
-        made_change = False
+token_cache = TokenCache()
+
+def warm_token_cache():
+    """Nạp toàn bộ token vào cache khi khởi động (Local → JSONBin → Database, tầng sau ghi đè tầng trước)."""
+    tokens = {}
+
+    try:
+        for uid, data in local_store.read_all().items():
+            tokens[uid] = data['access_token']
+    except sqlite3.Error as e:
+        print(f"Local store error: {e}")
+
+    if JSONBIN_API_KEY:
+        for uid, data in jsonbin_storage.read_data().items():
+            if uid.startswith('_') or uid == 'tracked_channels':
+                continue
+            tokens[uid] = data.get('access_token') if isinstance(data, dict) else data
+
+    with db_connection() as conn:
+        if conn:
+            try:
+                cursor = conn.cursor()
+                cursor.execute("SELECT user_id, access_token FROM user_tokens")
+                for uid, access_token in cursor.fetchall():
+                    tokens[str(uid)] = access_token
+                cursor.close()
+            except Exception as e:
+                print(f"Database error: {e}")
+
+    token_cache.load_many(tokens)
+    print(f"⚡ Token cache warmed with {token_cache.stats()['size']} tokens")
+
+# --- UNIFIED TOKEN FUNCTIONS ---
+def get_user_access_token(user_id: int):
+    """Lấy access token (Cache > Database > JSONBin.io > Local SQLite)"""
+    return token_cache.get_or_load(user_id, _load_user_access_token)
+
+def _load_user_access_token(user_id_str: str):
+    """Tra token qua các tầng lưu trữ khi cache miss. Trả về (token, complete)."""
+    before = breaker_snapshot()
+    
+    # Try database first
+    token = get_user_access_token_db(user_id_str)
+    if token:
+        return token, True
+    
+    # Try JSONBin.io
+    if JSONBIN_API_KEY:
+        token = jsonbin_storage.get_user_token(user_id_str)
+        if token:
+            return token, True
+    
+    # Fallback to local SQLite store
+    token = get_user_access_token_local(user_id_str)
+    return token, bool(token) or lookup_was_complete(before)
+
+def get_user_access_tokens(user_ids):
+    """
+    Lấy access token cho nhiều user cùng lúc (Cache > Database > JSONBin.io > Local SQLite).
+    Mỗi tầng chỉ tốn tối đa một round-trip cho cả lô.
+    Trả về (tokens, missing_ids) với tokens = {user_id_str: access_token}.
+    """
+    pending = []
+    negatives = []
+    tokens = {}
+    for user_id_str in dict.fromkeys(str(uid) for uid in user_ids):
+        access_token = token_cache.get(user_id_str)
+        if access_token:
+            tokens[user_id_str] = access_token
+        elif token_cache.is_negative(user_id_str):
+            negatives.append(user_id_str)
+        else:
+            pending.append(user_id_str)
+
+    tiers = [get_user_access_tokens_db]
+    if JSONBIN_API_KEY:
+        tiers.append(jsonbin_storage.get_user_tokens)
+    tiers.append(get_user_access_tokens_local)
+
+    before = breaker_snapshot()
+    for load_tier in tiers:
+        if not pending:
+            break
+        found = load_tier(pending)
+        if found:
+            tokens.update(found)
+            token_cache.load_many(found)
+            pending = [uid for uid in pending if uid not in found]
+
+    if pending and lookup_was_complete(before):
+        token_cache.set_negative(pending)
+    return tokens, pending + negatives
+
+def save_user_token(user_id: str, access_token: str, username: str = None, avatar_hash: str = None,
+                    refresh_token: str = None, expires_at: float = None, scope: str = None):
+    """
+    Lưu access token (Database + JSONBin.io + Local SQLite backup).
+    refresh_token/expires_at (epoch giây) được lưu kèm và đưa vào lịch làm mới token.
+    """
+    metadata = {'refresh_token': refresh_token, 'expires_at': expires_at, 'scope': scope}
+    # Xóa kết quả "chưa ủy quyền" đã nhớ của user này trước khi ghi
+    token_cache.invalidate(user_id)
+    success_db = save_user_token_db(user_id, access_token, username, avatar_hash, **metadata)
+    success_jsonbin = False
+    
+    # Try JSONBin.io
+    if JSONBIN_API_KEY:
+        success_jsonbin = jsonbin_storage.save_user_token(user_id, access_token, username, avatar_hash, **metadata)
+    
+    # Local SQLite backup
+    success_local = save_user_token_local(user_id, access_token, username, avatar_hash, **metadata)
+    
+    success = success_db or success_jsonbin or success_local
+    if success:
+        token_cache.set(user_id, access_token)
+        token_refresher.schedule(user_id, refresh_token, expires_at)
+        token_health.forget(user_id)
+    return success
+
+def read_refresh_schedule():
+    """
+    [(user_id, refresh_token, expires_at)] của mọi token làm mới được, gộp từ Local SQLite, Database
+    và JSONBin (kho bền vững chính khi không có DATABASE_URL); hạn muộn nhất thắng.
+    """
+    entries = {}
+
+    def merge(user_id, refresh_token, expires_at):
+        if not refresh_token or not expires_at:
+            return
+        try:
+            expires_at = float(expires_at)
+        except (TypeError, ValueError):
+            return
+        current = entries.get(str(user_id))
+        if current is None or expires_at > current[1]:
+            entries[str(user_id)] = (refresh_token, expires_at)
+
+    for user_id, refresh_token, expires_at in _call_local(local_store.refresh_entries, default=[]):
+        merge(user_id, refresh_token, expires_at)
+    with db_connection() as conn:
+        if conn:
+            try:
+                cursor = conn.cursor()
+                cursor.execute('''
+                    SELECT user_id, refresh_token, EXTRACT(EPOCH FROM expires_at AT TIME ZONE 'UTC')
+                    FROM user_tokens WHERE refresh_token IS NOT NULL AND expires_at IS NOT NULL
+                ''')
+                for user_id, refresh_token, expires_at in cursor.fetchall():
+                    merge(user_id, refresh_token, expires_at)
+                cursor.close()
+            except Exception as e:
+                print(f"Database error: {e}")
+    if JSONBIN_API_KEY:
+        try:
+            for user_id, data in jsonbin_storage.iter_user_records():
+                if isinstance(data, dict):
+                    merge(user_id, data.get('refresh_token'), data.get('expires_at'))
+        except Exception as e:
+            print(f"[Refresh] Lỗi khi đọc lịch làm mới từ JSONBin: {e}")
+    return [(user_id, refresh_token, expires_at) for user_id, (refresh_token, expires_at) in entries.items()]
+
+def iter_token_chunks_db(chunk_size):
+    """Duyệt bảng user_tokens theo từng lô [(user_id, data)] bằng server-side cursor (không nạp hết vào RAM)."""
+    with db_connection() as conn:
+        if not conn:
+            return
+        cursor = conn.cursor(name='migrate_tokens')
+        cursor.itersize = chunk_size
+        try:
+            cursor.execute('''
+                SELECT user_id, access_token, username, avatar_hash, refresh_token,
+                       EXTRACT(EPOCH FROM expires_at AT TIME ZONE 'UTC'), scope
+                FROM user_tokens
+            ''')
+            while True:
+                rows = cursor.fetchmany(chunk_size)
+                if not rows:
+                    break
+                yield [
+                    (str(user_id), {
+                        'access_token': access_token,
+                        'username': username,
+                        'avatar_hash': avatar_hash,
+                        'refresh_token': refresh_token,
+                        'expires_at': float(expires_at) if expires_at is not None else None,
+                        'scope': scope,
+                    })
+                    for user_id, access_token, username, avatar_hash, refresh_token, expires_at, scope in rows
+                ]
+        finally:
+            cursor.close()
+
+def save_user_tokens_db(records):
+    """
+    Upsert nhiều [(user_id, data)] bằng một câu INSERT nhiều dòng. Trường None giữ giá trị đã lưu;
+    user mới được xếp cuối roster. Trả về số bản ghi đã ghi.
+    """
+    rows = []
+    for user_id, data in records:
+        if not isinstance(data, dict):
+            data = {'access_token': data}
+        if data.get('access_token') and str(user_id).isdigit():
+            rows.append((int(user_id), data['access_token'], data.get('username'), data.get('avatar_hash'),
+                         (len(rows) + 1) * ROSTER_POSITION_GAP, data.get('refresh_token'),
+                         data.get('expires_at'), data.get('scope')))
+    if not rows:
+        return 0
+    with db_connection() as conn:
+        if conn:
+            try:
+                cursor = conn.cursor()
+                psycopg2.extras.execute_values(cursor, '''
+                    INSERT INTO user_tokens (user_id, access_token, username, avatar_hash, roster_position,
+                                             refresh_token, expires_at, scope)
+                    VALUES %s
+                    ON CONFLICT (user_id)
+                    DO UPDATE SET
+                        access_token = EXCLUDED.access_token,
+                        username = COALESCE(EXCLUDED.username, user_tokens.username),
+                        avatar_hash = COALESCE(EXCLUDED.avatar_hash, user_tokens.avatar_hash),
+                        refresh_token = COALESCE(EXCLUDED.refresh_token, user_tokens.refresh_token),
+                        expires_at = COALESCE(EXCLUDED.expires_at, user_tokens.expires_at),
+                        scope = COALESCE(EXCLUDED.scope, user_tokens.scope),
+                        token_status = CASE WHEN EXCLUDED.access_token = user_tokens.access_token
+                                            THEN user_tokens.token_status END,
+                        token_checked_at = CASE WHEN EXCLUDED.access_token = user_tokens.access_token
+                                                THEN user_tokens.token_checked_at END,
+                        updated_at = CURRENT_TIMESTAMP
+                ''', rows, page_size=len(rows),
+                    template="(%s, %s, %s, %s, (SELECT COALESCE(MAX(roster_position), 0) FROM user_tokens) + %s, "
+                             "%s, to_timestamp(%s) AT TIME ZONE 'UTC', %s)")
+                conn.commit()
+                cursor.close()
+                return len(rows)
+            except Exception as e:
+                print(f"Database bulk write error: {e}")
+    return 0
+
+def describe_database():
+    """Trạng thái database + pool dùng cho !storage_info."""
+    with db_connection() as conn:
+        if conn:
+            try:
+                cursor = conn.cursor()
+                cursor.execute("SELECT COUNT(*) FROM user_tokens")
+                db_count = cursor.fetchone()[0]
+                cursor.execute("SELECT COALESCE(MAX(version), 0) FROM schema_migrations")
+                version = cursor.fetchone()[0]
+                cursor.close()
+                db_info = f"✅ Connected ({db_count} tokens, schema v{version}/{SCHEMA_MIGRATIONS[-1][0]})"
+            except:
+                db_info = "❌ Connection Error"
+        else:
+            db_info = "❌ Not Available"
+    if db_pool:
+        pool_stats = db_pool.stats()
+        db_info += f"\nPool: {pool_stats['in_use']}/{pool_stats['max_size']} in use, {pool_stats['idle']} idle, {pool_stats['created']} created"
+    return db_info
+
+def delete_user_from_db(user_id: str):
+    """Xóa user khỏi database"""
+    with db_connection() as conn:
+        if conn:
+            try:
+                cursor = conn.cursor()
+                cursor.execute("DELETE FROM user_tokens WHERE user_id = %s", (user_id,))
+                conn.commit()
+                cursor.close()
+                print(f"✅ Deleted user {user_id} from database")
+                return True
+            except Exception as e:
+                print(f"Database delete error: {e}")
+    return False
+
+def delete_users_from_db(user_ids):
+    """Xóa nhiều user bằng một câu DELETE. Trả về số bản ghi đã xóa (None nếu lỗi)."""
+    with db_connection() as conn:
+        if conn:
+            try:
+                cursor = conn.cursor()
+                cursor.execute("DELETE FROM user_tokens WHERE user_id = ANY(%s::BIGINT[])",
+                               ([int(uid) for uid in user_ids if str(uid).isdigit()],))
+                deleted = cursor.rowcount
+                conn.commit()
+                cursor.close()
+                print(f"✅ Deleted {deleted} users from database")
+                return deleted
+            except Exception as e:
+                print(f"Database delete error: {e}")
+    return None
+
+def record_token_health_db(results):
+    """Ghi kết quả kiểm tra [(user_id, status, checked_at)] bằng một câu UPDATE."""
+    rows = [(int(uid), status, checked_at) for uid, status, checked_at in results if str(uid).isdigit()]
+    if not rows:
+        return True
+    with db_connection() as conn:
+        if conn:
+            try:
+                cursor = conn.cursor()
+                psycopg2.extras.execute_values(cursor, '''
+                    UPDATE user_tokens
+                    SET token_status = data.status,
+                        token_checked_at = to_timestamp(data.checked_at) AT TIME ZONE 'UTC'
+                    FROM (VALUES %s) AS data (user_id, status, checked_at)
+                    WHERE user_tokens.user_id = data.user_id
+                ''', rows, page_size=len(rows), template="(%s::BIGINT, %s, %s::DOUBLE PRECISION)")
+                conn.commit()
+                cursor.close()
+                return True
+            except Exception as e:
+                print(f"Database error: {e}")
+    return False
+
+def get_roster_count_db():
+    """Số điệp viên trong bảng user_tokens (0 nếu database không khả dụng)."""
+    with db_connection() as conn:
+        if conn:
+            try:
+                cursor = conn.cursor()
+                cursor.execute("SELECT COUNT(*) FROM user_tokens")
+                count = cursor.fetchone()[0]
+                cursor.close()
+                return count
+            except Exception as e:
+                print(f"Database error: {e}")
+    return 0
+
+def get_roster_page_db(offset: int, limit: int):
+    """Một trang roster theo thứ tự, đọc bằng index (roster_position, user_id). None nếu lỗi."""
+    with db_connection() as conn:
+        if conn:
+            try:
+                cursor = conn.cursor()
+                cursor.execute('''
+                    SELECT user_id, username, avatar_hash FROM user_tokens
+                    ORDER BY roster_position, user_id
+                    LIMIT %s OFFSET %s
+                ''', (limit, offset))
+                rows = cursor.fetchall()
+                cursor.close()
+                return [
+                    {'id': str(user_id), 'username': username or 'N/A', 'avatar_hash': avatar_hash}
+                    for user_id, username, avatar_hash in rows
+                ]
+            except Exception as e:
+                print(f"Database error: {e}")
+    return None
+
+def set_roster_order_db(roster_order: list):
+    """Đặt lại toàn bộ thứ tự roster bằng một câu UPDATE. Trả về {user_id: position} (None nếu lỗi)."""
+    with db_connection() as conn:
+        if conn:
+            try:
+                cursor = conn.cursor()
+                positions = _renumber_roster_positions(cursor, roster_order)
+                conn.commit()
+                cursor.close()
+                return positions
+            except Exception as e:
+                print(f"Database error: {e}")
+    return None
+
+def move_roster_position_db(user_id: str, position: int):
+    """
+    Di chuyển một điệp viên đến vị trí `position` (bắt đầu từ 1) bằng khóa phân số:
+    đọc hai hàng xóm qua index rồi cập nhật đúng một dòng.
+    Trả về {user_id: position} của các dòng đã đổi (None nếu không có user hoặc lỗi).
+    """
+    with db_connection() as conn:
+        if conn:
+            try:
+                cursor = conn.cursor()
+                cursor.execute("SELECT 1 FROM user_tokens WHERE user_id = %s", (user_id,))
+                if not cursor.fetchone():
+                    cursor.close()
+                    return None
+                index = position - 1
+                cursor.execute('''
+                    SELECT roster_position FROM user_tokens WHERE user_id <> %s
+                    ORDER BY roster_position, user_id
+                    LIMIT 2 OFFSET %s
+                ''', (user_id, max(index - 1, 0)))
+                neighbours = [row[0] for row in cursor.fetchall()]
+                if index == 0:
+                    before, after = None, (neighbours[0] if neighbours else None)
+                elif neighbours:
+                    before, after = neighbours[0], (neighbours[1] if len(neighbours) > 1 else None)
+                else:
+                    # Vị trí vượt quá cuối danh sách: xếp sau điệp viên cuối cùng
+                    cursor.execute("SELECT MAX(roster_position) FROM user_tokens WHERE user_id <> %s", (user_id,))
+                    before, after = cursor.fetchone()[0], None
+
+                new_position = roster_position_between(before, after)
+                if new_position is None:
+                    # Hết độ chính xác giữa hai hàng xóm: đánh số lại toàn bộ (rất hiếm)
+                    cursor.execute("SELECT user_id FROM user_tokens WHERE user_id <> %s ORDER BY roster_position, user_id", (user_id,))
+                    order = [str(row[0]) for row in cursor.fetchall()]
+                    order.insert(index, str(user_id))
+                    changed = _renumber_roster_positions(cursor, order)
+                else:
+                    cursor.execute("UPDATE user_tokens SET roster_position = %s WHERE user_id = %s", (new_position, user_id))
+                    changed = {str(user_id): new_position}
+                conn.commit()
+                cursor.close()
+                return changed
+            except Exception as e:
+                print(f"Database error: {e}")
+    return None
+
+def delete_users_from_local(user_ids):
+    """Xóa nhiều user khỏi kho SQLite cục bộ trong một transaction"""
+    deleted = _call_local(local_store.delete_users, user_ids)
+    if deleted:
+        print(f"✅ Deleted {deleted} users from local store")
+    return deleted
+
+def record_token_health(results):
+    """Lưu kết quả kiểm tra token vào Database + Local SQLite."""
+    success_db = record_token_health_db(results)
+    success_local = _call_local(local_store.record_health, results) is not None
+    return success_db or success_local
+
+def read_token_health():
+    """{user_id: (status, checked_at)} từ Database + Local SQLite (lần kiểm tra mới nhất thắng)."""
+    health = {}
+    entries = list(_call_local(local_store.health_entries, default=[]))
+    with db_connection() as conn:
+        if conn:
+            try:
+                cursor = conn.cursor()
+                cursor.execute('''
+                    SELECT user_id, token_status, EXTRACT(EPOCH FROM token_checked_at AT TIME ZONE 'UTC')
+                    FROM user_tokens WHERE token_checked_at IS NOT NULL
+                ''')
+                entries.extend(cursor.fetchall())
+                cursor.close()
+            except Exception as e:
+                print(f"Database error: {e}")
+    for user_id, status, checked_at in entries:
+        current = health.get(str(user_id))
+        if current is None or float(checked_at) > current[1]:
+            health[str(user_id)] = (status, float(checked_at))
+    return health
+
+def delete_user_from_local(user_id: str):
+    """Xóa user khỏi kho SQLite cục bộ"""
+    deleted = _call_local(local_store.delete_user, user_id)
+    if deleted is None:
+        return False
+    if deleted:
+        print(f"✅ Deleted user {user_id} from local store")
+    return True
+
+# --- ASYNC STORAGE INTERFACE ---
+# Bot (event loop) không bao giờ gọi trực tiếp requests/psycopg2/file I/O: mọi thao tác
+# storage chạy trong một thread pool riêng. Flask thread vẫn dùng các hàm sync ở trên.
+STORAGE_WORKERS = int(os.getenv('STORAGE_WORKERS', 8))
+
+class AsyncTokenStore:
+    """Giao diện storage bất đồng bộ mà bot await."""
+    def __init__(self, max_workers=STORAGE_WORKERS):
+        self.executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='storage')
+
+    async def run(self, func, *args, **kwargs):
+        """Chạy một hàm storage blocking trong thread pool riêng."""
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self.executor, functools.partial(func, *args, **kwargs))
+
+    async def get_token(self, user_id):
+        # Cache hit trả về ngay, không cần chuyển sang thread khác
+        access_token = token_cache.get(user_id, count_hit=True)
+        if access_token:
+            return access_token
+        return await self.run(get_user_access_token, user_id)
+
+    async def get_tokens(self, user_ids):
+        return await self.run(get_user_access_tokens, list(user_ids))
+
+    async def save_token(self, user_id, access_token, username=None, avatar_hash=None, **metadata):
+        return await self.run(save_user_token, user_id, access_token, username, avatar_hash, **metadata)
+
+    async def delete_user(self, user_id):
+        """Xóa user khỏi mọi tầng. Trả về (db_success, jsonbin_success, local_success)."""
+        user_id_str = str(user_id)
+        token_cache.invalidate(user_id_str)
+        token_refresher.unschedule(user_id_str)
+        token_health.forget(user_id_str)
+        membership_index.remove_agent(user_id_str)
+        return await asyncio.gather(
+            self.run(delete_user_from_db, user_id_str),
+            self.run(jsonbin_storage.delete_user, user_id_str, flush_now=True),
+            self.run(delete_user_from_local, user_id_str),
+        )
+
+    async def delete_users(self, user_ids):
+        """
+        Xóa nhiều user khỏi mọi tầng, mỗi tầng một lượt ghi.
+        Trả về (db_deleted, jsonbin_success, local_deleted); số đếm là None nếu tầng đó lỗi.
+        """
+        user_ids = [str(uid) for uid in user_ids]
+        for user_id in user_ids:
+            token_cache.invalidate(user_id)
+            token_refresher.unschedule(user_id)
+            token_health.forget(user_id)
+            membership_index.remove_agent(user_id)
+        return await asyncio.gather(
+            self.run(delete_users_from_db, user_ids),
+            self.run(jsonbin_storage.delete_users, user_ids),
+            self.run(delete_users_from_local, user_ids),
+        )
+
+    async def read_jsonbin(self):
+        return await self.run(jsonbin_storage.read_data)
+
+    async def update_jsonbin(self, mutator):
+        return await self.run(jsonbin_storage.update_data, mutator)
+
+    async def flush_jsonbin(self):
+        return await self.run(jsonbin_storage.flush)
+
+    async def is_database_available(self):
+        return await self.run(is_database_available)
+
+token_store = AsyncTokenStore()
+
+class EventLoopLagMonitor:
+    """Đo độ trễ của event loop để phát hiện các lệnh gọi blocking."""
+    def __init__(self, interval=0.5):
+        self.interval = interval
+        self.last_lag_ms = 0.0
+        self.max_lag_ms = 0.0
+        self._task = None
+
+    def start(self):
+        if self._task is None or self._task.done():
+            self._task = asyncio.get_running_loop().create_task(self._run())
+
+    async def _run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            expected = loop.time() + self.interval
+            await asyncio.sleep(self.interval)
+            self.last_lag_ms = max(0.0, (loop.time() - expected) * 1000)
+            self.max_lag_ms = max(self.max_lag_ms, self.last_lag_ms)
+
+    def stats(self):
+        return {"last_ms": round(self.last_lag_ms, 1), "max_ms": round(self.max_lag_ms, 1)}
+
+loop_lag_monitor = EventLoopLagMonitor()
+
+# --- OAUTH TOKEN REFRESH ---
+OAUTH_TOKEN_URL = 'https://discord.com/api/v10/oauth2/token'
+TOKEN_REFRESH_MARGIN = float(os.getenv('TOKEN_REFRESH_MARGIN', 86400))         # làm mới trước hạn (giây)
+TOKEN_REFRESH_CONCURRENCY = int(os.getenv('TOKEN_REFRESH_CONCURRENCY', 4))
+TOKEN_REFRESH_RETRY_DELAY = 300                                                # giây, khi lỗi mạng/5xx
+
+class TokenRefreshScheduler:
+    """
+    Làm mới access token trước khi hết hạn.
+    Lịch là một heap (due_at, user_id): task nền ngủ tới mốc sớm nhất, làm mới các token đến hạn
+    với số request đồng thời giới hạn rồi ghi qua save_user_token (tự xếp lịch cho token mới).
+    schedule() an toàn khi gọi từ Flask thread hoặc thread storage.
+    """
+    def __init__(self, margin=TOKEN_REFRESH_MARGIN, concurrency=TOKEN_REFRESH_CONCURRENCY):
+        self.margin = margin
+        self.concurrency = concurrency
+        self._heap = []
+        self._entries = {}   # user_id -> (due_at, refresh_token, expires_at)
+        self._lock = threading.Lock()
+        self._loop = None
+        self._wake = None
+        self._task = None
+        self.refreshed = 0
+        self.failed = 0
+        self.revoked = 0
+
+    def schedule(self, user_id, refresh_token, expires_at, due_at=None):
+        if not refresh_token or not expires_at:
+            return
+        user_id = str(user_id)
+        if due_at is None:
+            due_at = expires_at - self.margin
+        with self._lock:
+            self._entries[user_id] = (due_at, refresh_token, expires_at)
+            heapq.heappush(self._heap, (due_at, user_id))
+        if self._loop is not None:
+            self._loop.call_soon_threadsafe(self._wake.set)
+
+    def unschedule(self, user_id):
+        with self._lock:
+            self._entries.pop(str(user_id), None)  # mục trong heap bị bỏ qua khi tới lượt
+
+    def _pop_due(self, now):
+        """Lấy các token đến hạn. Trả về (danh sách, số giây tới mốc kế tiếp hoặc None)."""
+        due = []
+        with self._lock:
+            while self._heap:
+                due_at, user_id = self._heap[0]
+                entry = self._entries.get(user_id)
+                if entry is None or entry[0] != due_at:
+                    heapq.heappop(self._heap)  # mục cũ đã được thay thế
+                    continue
+                if due_at > now:
+                    return due, due_at - now
+                heapq.heappop(self._heap)
+                del self._entries[user_id]
+                due.append((user_id, entry[1], entry[2]))
+        return due, None
+
+    def start(self):
+        if self._task is None or self._task.done():
+            self._loop = asyncio.get_running_loop()
+            self._wake = asyncio.Event()
+            self._task = self._loop.create_task(self._run())
+
+    async def _run(self):
+        semaphore = asyncio.Semaphore(self.concurrency)
+        async with aiohttp.ClientSession() as session:
+            while True:
+                self._wake.clear()
+                due, wait = self._pop_due(time.time())
+                if due:
+                    await asyncio.gather(*(self._refresh(session, semaphore, *item) for item in due))
+                    continue
+                try:
+                    await asyncio.wait_for(self._wake.wait(), timeout=min(wait or 3600, 3600))
+                except asyncio.TimeoutError:
+                    pass
+
+    async def _refresh(self, session, semaphore, user_id, refresh_token, expires_at):
+        payload = {
+            'client_id': CLIENT_ID,
+            'client_secret': CLIENT_SECRET,
+            'grant_type': 'refresh_token',
+            'refresh_token': refresh_token,
+        }
+        retry_after = TOKEN_REFRESH_RETRY_DELAY
+        async with semaphore:
+            try:
+                async with session.post(OAUTH_TOKEN_URL, data=payload) as response:
+                    status = response.status
+                    if status == 200:
+                        token_data = await response.json()
+                    elif status == 429:
+                        retry_after = float(response.headers.get('Retry-After', retry_after))
+            except Exception as e:
+                print(f"[Refresh] Lỗi mạng khi làm mới token của {user_id}: {e}")
+                status = None
+
+        if status == 200:
+            saved = await token_store.save_token(
+                user_id, token_data['access_token'],
+                refresh_token=token_data.get('refresh_token', refresh_token),
+                expires_at=time.time() + token_data.get('expires_in', 604800),
+                scope=token_data.get('scope')
+            )
+            if saved:
+                self.refreshed += 1
+                return
+        elif status in (400, 401):
+            # invalid_grant: người dùng đã thu hồi quyền, refresh token không còn dùng được
+            self.revoked += 1
+            print(f"[Refresh] ⚠️ Refresh token của {user_id} đã bị thu hồi")
+            await token_store.run(record_token_health, [token_health.mark(user_id, 'invalid')])
+            return
+
+        self.failed += 1
+        self.schedule(user_id, refresh_token, expires_at, due_at=time.time() + retry_after)
+
+    def stats(self):
+        with self._lock:
+            pending = len(self._entries)
+            next_due = min((entry[0] for entry in self._entries.values()), default=None)
+        return {
+            "scheduled": pending,
+            "next_due_in": round(next_due - time.time()) if next_due is not None else None,
+            "refreshed": self.refreshed,
+            "failed": self.failed,
+            "revoked": self.revoked,
+        }
+
+token_refresher = TokenRefreshScheduler()
+
+# --- TOKEN HEALTH ---
+TOKEN_HEALTH_RATE = float(os.getenv('TOKEN_HEALTH_RATE', 1))             # số lần kiểm tra mỗi giây
+TOKEN_HEALTH_INTERVAL = float(os.getenv('TOKEN_HEALTH_INTERVAL', 86400))  # kiểm tra lại token hợp lệ sau (giây)
+TOKEN_HEALTH_BATCH = 50                                                  # số kết quả mỗi lần ghi xuống storage
+
+def primary_token_source():
+    """Tầng đang giữ danh sách điệp viên đầy đủ nhất: Database, rồi Local SQLite, rồi JSONBin."""
+    if get_roster_count_db():
+        return "db"
+    if _call_local(local_store.count, default=0):
+        return "local"
+    return "jsonbin"
+
+def read_agent_ids():
+    """ID của mọi điệp viên đã ủy quyền, đọc từ tầng chính theo từng lô."""
+    return [user_id for chunk in iter_token_chunks(primary_token_source()) for user_id, _ in chunk]
+
+def collect_tokens_to_check(checked, max_age):
+    """
+    Đọc tầng chính theo từng lô và chỉ giữ (user_id, data) cần kiểm tra: chưa từng kiểm tra, hoặc
+    'valid'/'expired' nhưng đã cũ hơn max_age (token hết hạn mà làm mới chưa thành công sẽ được
+    kiểm tra và xếp lịch làm mới lại). Token đã hỏng ('invalid') không kiểm tra lại.
+    """
+    cutoff = time.time() - max_age
+    due = []
+    for chunk in iter_token_chunks(primary_token_source()):
+        for user_id, data in chunk:
+            status = checked.get(user_id)
+            if status is None or (status[0] in ('valid', 'expired') and status[1] < cutoff):
+                due.append((user_id, data))
+    return due
+
+class TokenHealthValidator:
+    """
+    Chỉ mục sức khỏe token: {user_id: (status, checked_at)}, status là 'valid', 'expired'
+    (401 nhưng còn refresh token, đang chờ làm mới - chưa bị coi là hỏng) hoặc 'invalid'.
+    Task nền gọi GET /users/@me cho từng token với tốc độ giới hạn, ghi kết quả theo lô
+    vào Database + Local SQLite. Token mới được lưu sẽ tự xóa trạng thái cũ (forget).
+    """
+    def __init__(self, rate=TOKEN_HEALTH_RATE, interval=TOKEN_HEALTH_INTERVAL):
+        self.rate = rate
+        self.interval = interval
+        self._health = {}
+        self._lock = threading.Lock()
+        self._task = None
+        self.checks = 0
+        self.last_cycle = None
+
+    def load(self, health):
+        with self._lock:
+            self._health.update(health)
+
+    def forget(self, user_id):
+        with self._lock:
+            self._health.pop(str(user_id), None)
+
+    def mark(self, user_id, status):
+        """Ghi trạng thái cho user_id, trả về (user_id, status, checked_at) để lưu xuống storage."""
+        checked_at = time.time()
+        with self._lock:
+            self._health[str(user_id)] = (status, checked_at)
+        return str(user_id), status, checked_at
+
+    def status(self, user_id):
+        with self._lock:
+            entry = self._health.get(str(user_id))
+        return entry[0] if entry else None
+
+    def is_dead(self, user_id):
+        return self.status(user_id) == 'invalid'
+
+    def dead_agents(self):
+        with self._lock:
+            return sorted(uid for uid, (status, _) in self._health.items() if status == 'invalid')
+
+    def start(self):
+        if self._task is None or self._task.done():
+            self._task = asyncio.get_running_loop().create_task(self._run())
+
+    async def _run(self):
+        async with aiohttp.ClientSession() as session:
+            while True:
+                try:
+                    await self._cycle(session)
+                except asyncio.CancelledError:
+                    raise
+                except Exception as e:
+                    # Lỗi một vòng không được làm dừng hẳn task nền
+                    print(f"[Health] ❌ Lỗi trong vòng kiểm tra token: {e}")
+                await asyncio.sleep(min(self.interval, 3600))
+
+    async def _cycle(self, session):
+        with self._lock:
+            checked = dict(self._health)
+        due = await token_store.run(collect_tokens_to_check, checked, self.interval)
+        results = []
+        for user_id, data in due:
+            status = await self._check(session, data['access_token'])
+            if status is None:
+                continue
+            if status == 'invalid' and data.get('refresh_token'):
+                # Access token hết hạn nhưng còn refresh token: chưa coi là hỏng, thử làm mới ngay
+                status = 'expired'
+                token_refresher.schedule(user_id, data['refresh_token'], data.get('expires_at') or time.time(),
+                                         due_at=time.time())
+            results.append(self.mark(user_id, status))
+            if len(results) >= TOKEN_HEALTH_BATCH:
+                await token_store.run(record_token_health, results)
+                results = []
+            await asyncio.sleep(1 / self.rate)
+        if results:
+            await token_store.run(record_token_health, results)
+        self.last_cycle = time.time()
+        print(f"[Health] Đã kiểm tra {len(due)} token, {len(self.dead_agents())} token hỏng.")
+
+    async def _check(self, session, access_token):
+        """'valid', 'invalid' hoặc None nếu không kết luận được (lỗi mạng/5xx)."""
+        headers = {'Authorization': f'Bearer {access_token}'}
+        while True:
+            try:
+                async with session.get('https://discord.com/api/v10/users/@me', headers=headers) as response:
+                    self.checks += 1
+                    if response.status == 429:
+                        retry_after = float(response.headers.get('Retry-After', 5))
+                        await asyncio.sleep(retry_after)
+                        continue
+                    if response.status == 200:
+                        return 'valid'
+                    if response.status == 401:
+                        return 'invalid'
+                    return None
+            except Exception as e:
+                print(f"[Health] Lỗi mạng khi kiểm tra token: {e}")
+                return None
+
+    def stats(self):
+        with self._lock:
+            statuses = [status for status, _ in self._health.values()]
+        return {
+            "valid": statuses.count('valid'),
+            "expired": statuses.count('expired'),
+            "invalid": statuses.count('invalid'),
+            "checks": self.checks,
+            "last_cycle_ago": round(time.time() - self.last_cycle) if self.last_cycle else None,
+        }
+
+token_health = TokenHealthValidator()
+
+# --- DISCORD BOT SETUP ---
+intents = discord.Intents.default()
+intents.members = True
+intents.message_content = True
+bot = commands.Bot(command_prefix='!', intents=intents, owner_id=1386710352426959011, help_command=None)
+
+# --- FLASK WEB SERVER SETUP ---
+app = Flask(__name__)
+
+# --- UTILITY FUNCTIONS ---
+MEMBER_ADD_CONCURRENCY = int(os.getenv('MEMBER_ADD_CONCURRENCY', 10))
+MEMBER_ADD_MAX_RETRIES = 5
+MEMBER_ADD_ROUTE = "PUT /guilds/{guild_id}/members/{user_id}"
+# Ngân sách giả định (số request, cửa sổ giây) khi chưa quan sát được bucket nào, chỉ dùng cho ETA
+MEMBER_ADD_DEFAULT_BUDGET = (10, 10.0)
+
+# Kết quả một lượt thêm member: status là HTTP status (None nếu lỗi mạng), latency tính bằng giây
+MemberAddResult = namedtuple('MemberAddResult', 'guild_id user_id success status message retry_after latency attempts')
+
+class RateLimitBucket:
+    """
+    Một bucket rate limit của Discord (theo route + guild), cập nhật từ header X-RateLimit-*.
+    Khi chưa biết thời điểm reset (lần đầu, hoặc ngay sau khi cửa sổ cũ hết hạn) chỉ dùng
+    số lượt còn lại đã biết rồi chờ header của response kế tiếp.
+    """
+    def __init__(self):
+        self.bucket_hash = None
+        self.limit = None
+        self.window = None   # độ dài cửa sổ lớn nhất đã quan sát (giây), dùng để ước lượng ETA
+        self.remaining = 1
+        self.reset_at = None
+        self._lock = asyncio.Lock()
+        self._updated = asyncio.Event()
+
+    async def acquire(self):
+        """Chờ tới khi bucket còn lượt rồi giữ chỗ một lượt."""
+        async with self._lock:
+            while True:
+                now = time.monotonic()
+                if self.reset_at is not None and now >= self.reset_at:
+                    # Cửa sổ mới: thời điểm reset tiếp theo sẽ đọc từ header
+                    self.remaining = self.limit
+                    self.reset_at = None
+                if self.remaining > 0:
+                    self.remaining -= 1
+                    return
+                if self.reset_at is None:
+                    self._updated.clear()
+                    await self._updated.wait()
+                else:
+                    await asyncio.sleep(self.reset_at - now)
+
+    def update(self, headers):
+        """Cập nhật từ header của response (headers rỗng khi request lỗi mạng)."""
+        now = time.monotonic()
+        if 'X-RateLimit-Limit' in headers:
+            self.bucket_hash = headers.get('X-RateLimit-Bucket', self.bucket_hash)
+            remaining = int(headers.get('X-RateLimit-Remaining', 0))
+            reset_after = float(headers.get('X-RateLimit-Reset-After', 0))
+            reset_at = now + reset_after
+            self.window = max(self.window or 0.0, reset_after)
+            # Các request khác của bucket có thể vẫn đang chạy: lấy con số thận trọng hơn
+            self.remaining = remaining if self.limit is None else min(self.remaining, remaining)
+            self.limit = int(headers['X-RateLimit-Limit'])
+            if self.reset_at is None or reset_at > self.reset_at:
+                self.reset_at = reset_at
+        elif self.reset_at is None:
+            # Không có header (lỗi mạng): cho request kế tiếp thử để đọc header
+            self.remaining = max(self.remaining, 1)
+        self._updated.set()
+
+    def defer(self, retry_after):
+        """Sau 429: khóa bucket tới đúng thời điểm reset."""
+        self.remaining = 0
+        self.reset_at = max(self.reset_at or 0.0, time.monotonic() + retry_after)
+        if self.limit is None:
+            self.limit = 1
+        self._updated.set()
+
+def parse_rate_limit(headers, text):
+    """
+    (retry_after, is_global) của một phản hồi 429. Body JSON của Discord được ưu tiên; 429 từ Cloudflare
+    là HTML nên khi body không phải JSON object thì dùng header Retry-After / X-RateLimit-Global.
+    """
+    try:
+        body = json.loads(text)
+    except ValueError:
+        body = None
+    if not isinstance(body, dict):
+        body = {}
+    try:
+        retry_after = float(body.get('retry_after', headers.get('Retry-After', 1)))
+    except (TypeError, ValueError):
+        retry_after = 1.0
+    is_global = bool(body.get('global')) or str(headers.get('X-RateLimit-Global', '')).lower() == 'true'
+    return retry_after, is_global
+
+class MemberAddEngine:
+    """
+    Thêm member vào guild qua Discord API (PUT /guilds/{id}/members/{user}).
+    Dùng chung một aiohttp session (connection pool, DNS cache, TLS được tái sử dụng) và chạy
+    nhiều lượt thêm đồng thời, tối đa MEMBER_ADD_CONCURRENCY request cùng lúc.
+    Mỗi guild có bucket rate limit riêng đọc từ header, cộng thêm giới hạn global: request chỉ
+    được gửi khi bucket còn lượt, 429 được xếp lại đúng thời điểm reset thay vì tính là thất bại.
+    """
+    def __init__(self, concurrency=MEMBER_ADD_CONCURRENCY, max_retries=MEMBER_ADD_MAX_RETRIES):
+        self.concurrency = concurrency
+        self.max_retries = max_retries
+        self._session = None
+        self._semaphore = None
+        self._buckets = {}
+        self._global_reset_at = 0.0
+        self.requests = 0
+        self.rate_limited = 0
+        self.avg_latency = 0.5
+
+    def _get_session(self):
+        """Tạo session trên event loop đang chạy ở lần dùng đầu tiên."""
+        if self._session is None or self._session.closed:
+            connector = aiohttp.TCPConnector(limit=self.concurrency, ttl_dns_cache=300)
+            self._session = aiohttp.ClientSession(
+                connector=connector,
+                headers={"Authorization": f"Bot {DISCORD_TOKEN}"},
+                timeout=aiohttp.ClientTimeout(total=30)
+            )
+            self._semaphore = asyncio.Semaphore(self.concurrency)
+            self._buckets = {}
+        return self._session
+
+    def _bucket(self, guild_id):
+        # guild_id là tham số chính của route: mỗi guild là một bucket độc lập
+        key = (MEMBER_ADD_ROUTE, guild_id)
+        if key not in self._buckets:
+            self._buckets[key] = RateLimitBucket()
+        return self._buckets[key]
+
+    async def _wait_global(self):
+        delay = self._global_reset_at - time.monotonic()
+        if delay > 0:
+            await asyncio.sleep(delay)
+
+    async def add(self, guild_id: int, user_id: int, access_token: str):
+        """
+        Thêm một user vào một guild, tự xếp lại khi bị 429 và thử lại lỗi mạng/5xx (tối đa max_retries
+        lượt thử lại cho cả hai). Trả về MemberAddResult.
+        """
+        session = self._get_session()
+        bucket = self._bucket(guild_id)
+        url = f"https://discord.com/api/v10/guilds/{guild_id}/members/{user_id}"
+        started = time.monotonic()
+        retry_after = None
+        attempts = 0
+        while True:
+            attempts += 1
+            await bucket.acquire()
+            # Lượt đã giữ chỗ luôn được trả lại cho bucket, kể cả khi task bị hủy (tạm dừng/hủy job)
+            # trong lúc chờ global hoặc chờ response; nếu không mọi lượt sau của guild sẽ chờ mãi
+            updated = False
+            try:
+                await self._wait_global()
+                async with self._semaphore:
+                    self.requests += 1
+                    sent_at = time.monotonic()
+                    async with session.put(url, json={"access_token": access_token}) as response:
+                        status = response.status
+                        self.avg_latency = 0.8 * self.avg_latency + 0.2 * (time.monotonic() - sent_at)
+                        bucket.update(response.headers)
+                        updated = True
+                        if status == 429:
+                            retry_after, is_global = parse_rate_limit(response.headers, await response.text())
+                            if is_global:
+                                self._global_reset_at = time.monotonic() + retry_after
+                            else:
+                                bucket.defer(retry_after)
+                        else:
+                            error_text = "" if status in (201, 204) else await response.text()
+            except Exception as e:
+                status, error_text = None, f"Lỗi mạng: {e}"
+            finally:
+                if not updated:
+                    bucket.update({})
+
+            if status == 429:
+                self.rate_limited += 1
+                print(f"[RateLimit] 429 tại guild {guild_id}, thử lại sau {retry_after}s")
+                if attempts <= self.max_retries:
+                    continue  # bucket/global đã bị khóa tới thời điểm reset
+                message = f"HTTP 429: rate limited (retry after {retry_after}s)"
+            elif status is None or status >= 500:
+                # Lỗi tạm thời (mạng/5xx) cũng được thử lại ở đây, dùng chung số lượt với 429:
+                # BulkOperation không thử lại lượt thêm member nên số request không bị nhân lên
+                if attempts <= self.max_retries:
+                    await asyncio.sleep(min(2 ** attempts, 30))
+                    continue
+                message = error_text if status is None else f"HTTP {status}: {error_text}"
+            elif status == 201:
+                message = "Thêm thành công"
+            elif status == 204:
+                message = "User đã có trong server"
+            else:
+                message = f"HTTP {status}: {error_text}"
+            return MemberAddResult(guild_id, user_id, status in (201, 204), status, message, retry_after,
+                                   time.monotonic() - started, attempts)
+
+    def bucket_budget(self, guild_id):
+        """(limit, window) đã quan sát của bucket thêm member tại guild, hoặc ngân sách của bucket bất kỳ đã biết."""
+        bucket = self._buckets.get((MEMBER_ADD_ROUTE, guild_id))
+        if bucket and bucket.limit and bucket.window:
+            return bucket.limit, bucket.window
+        for bucket in self._buckets.values():
+            if bucket.limit and bucket.window:
+                return bucket.limit, bucket.window
+        return MEMBER_ADD_DEFAULT_BUDGET
+
+    def estimate(self, calls_per_guild):
+        """
+        Ước lượng thời gian (giây) cho {guild_id: số lượt thêm}: các bucket chạy song song nên lấy
+        bucket chậm nhất, nhưng không nhanh hơn giới hạn đồng thời × độ trễ trung bình.
+        """
+        slowest = 0.0
+        for guild_id, calls in calls_per_guild.items():
+            limit, window = self.bucket_budget(guild_id)
+            windows = -(-calls // limit)  # làm tròn lên
+            slowest = max(slowest, (windows - 1) * window + self.avg_latency)
+        concurrency_bound = sum(calls_per_guild.values()) * self.avg_latency / self.concurrency
+        return max(slowest, concurrency_bound)
+
+    def stats(self):
+        return {
+            "requests": self.requests,
+            "rate_limited": self.rate_limited,
+            "buckets": len(self._buckets),
+            "global_limited": self._global_reset_at > time.monotonic(),
+        }
+
+    async def close(self):
+        if self._session is not None and not self._session.closed:
+            await self._session.close()
+
+member_add_engine = MemberAddEngine()
+
+# --- PROGRESS REPORTING ---
+PROGRESS_EDIT_INTERVAL = float(os.getenv('PROGRESS_EDIT_INTERVAL', 3))
+
+def format_duration(seconds):
+    seconds = int(seconds)
+    if seconds < 60:
+        return f"{seconds}s"
+    if seconds < 3600:
+        return f"{seconds // 60}m{seconds % 60:02d}s"
+    return f"{seconds // 3600}h{seconds % 3600 // 60:02d}m"
+
+class ProgressReporter:
+    """
+    Một tin nhắn trạng thái cho thao tác hàng loạt: thành công/thất bại/còn lại, tốc độ và ETA.
+    advance() chỉ cập nhật bộ đếm; tin nhắn được sửa bởi một task nền tối đa mỗi
+    PROGRESS_EDIT_INTERVAL giây nên không bao giờ chạm rate limit sửa tin nhắn của kênh.
+    """
+    def __init__(self, title, total, done=0, failed=0, skipped=0, interval=PROGRESS_EDIT_INTERVAL):
+        self.title = title
+        self.total = total
+        self.done = done
+        self.failed = failed
+        self.skipped = skipped
+        self.interval = interval
+        self.message = None
+        self._task = None
+        self._dirty = False
+        # Tốc độ chỉ tính trên phần việc của lần chạy này (job tiếp tục có sẵn tiến độ cũ)
+        self._baseline = done + failed + skipped
+        self._started = time.monotonic()
+
+    @property
+    def processed(self):
+        return self.done + self.failed + self.skipped
+
+    async def start(self, destination):
+        """Gửi tin nhắn trạng thái vào destination (channel/ctx hoặc interaction.followup)."""
+        if isinstance(destination, discord.Webhook):
+            self.message = await destination.send(self.render(), wait=True)
+        else:
+            self.message = await destination.send(self.render())
+        self._task = asyncio.get_running_loop().create_task(self._run())
+        return self
+
+    def advance(self, done=0, failed=0, skipped=0):
+        self.done += done
+        self.failed += failed
+        self.skipped += skipped
+        self._dirty = True
+
+    def render(self, outcome=None):
+        elapsed = time.monotonic() - self._started
+        rate = (self.processed - self._baseline) / elapsed if elapsed > 0 else 0
+        remaining = max(self.total - self.processed, 0)
+        line = f"✅ {self.done} | ❌ {self.failed}"
+        if self.skipped:
+            line += f" | ⏭️ {self.skipped}"
+        if outcome:
+            return f"{outcome} **{self.title}** - {self.processed}/{self.total} sau {format_duration(elapsed)}\n{line}"
+        eta = format_duration(remaining / rate) if rate > 0 else "?"
+        return (f"🔄 **{self.title}** - {self.processed}/{self.total}\n"
+                f"{line} | ⏳ {remaining} còn lại | {rate:.1f}/s | ETA {eta}")
+
+    async def _edit(self, content):
+        try:
+            await self.message.edit(content=content)
+        except discord.HTTPException as e:
+            # Tin nhắn bị xóa hoặc webhook của interaction đã hết hạn: ngừng cập nhật
+            print(f"[Progress] Không thể cập nhật tiến độ '{self.title}': {e}")
+            self.message = None
+
+    async def _run(self):
+        while self.message is not None:
+            await asyncio.sleep(self.interval)
+            if self._dirty and self.message is not None:
+                self._dirty = False
+                await self._edit(self.render())
+
+    async def finish(self, outcome="✅ Hoàn tất"):
+        if self._task is not None:
+            self._task.cancel()
+        if self.message is not None:
+            await self._edit(self.render(outcome))
+
+# --- BULK OPERATIONS ---
+BULK_CONCURRENCY = int(os.getenv('BULK_CONCURRENCY', 5))
+BULK_RETRIES = 2
+# Số server tạo kênh song song; trong một server các kênh vẫn tạo tuần tự (cùng bucket rate limit)
+CHANNEL_CREATE_CONCURRENCY = int(os.getenv('CHANNEL_CREATE_CONCURRENCY', 10))
+
+class BulkSkip(Exception):
+    """Target không cần xử lý; message được ghi vào báo cáo với trạng thái skipped."""
+
+class BulkFailure(Exception):
+    """Thất bại đã biết trước (không thử lại); message được ghi vào báo cáo."""
+
+def describe_error(error):
+    """Thông báo lỗi thống nhất cho mọi thao tác hàng loạt."""
+    if isinstance(error, (BulkSkip, BulkFailure)):
+        return str(error)
+    if isinstance(error, discord.Forbidden):
+        return f"Thiếu quyền (403): {error.text}"
+    if isinstance(error, discord.NotFound):
+        return f"Không tìm thấy (404): {error.text}"
+    if isinstance(error, discord.HTTPException):
+        return f"HTTP {error.status}: {error.text}"
+    return f"{type(error).__name__}: {error}"
+
+def is_transient_error(error):
+    """Lỗi mạng/5xx đáng thử lại. 429 do discord.py tự xử lý; thêm member do member_add_engine tự thử lại."""
+    if isinstance(error, discord.HTTPException):
+        return error.status >= 500
+    return isinstance(error, (aiohttp.ClientError, asyncio.TimeoutError, ConnectionError))
+
+def truncate_field(lines, limit=1024):
+    """Ghép các dòng cho một field của embed, cắt bớt để không vượt giới hạn của Discord."""
+    text = "\n".join(lines)
+    if len(text) > limit:
+        text = text[:limit - 4] + "\n..."
+    return text
+
+# excluded: target bị loại ở bước kiểm tra trước (preflight), không có request nào được gửi
+BulkResult = namedtuple('BulkResult', 'target label status message excluded', defaults=(False,))
+
+class BulkReport:
+    """Kết quả một thao tác hàng loạt: embed tóm tắt + file CSV đầy đủ mọi target."""
+    def __init__(self, title, results, elapsed=None):
+        self.title = title
+        self.results = results
+        self.elapsed = elapsed
+
+    def count(self, status):
+        return sum(1 for result in self.results if result.status == status)
+
+    def embed(self, description=None):
+        failed = self.count(ITEM_FAILED)
+        embed = discord.Embed(
+            title=f"📊 Báo Cáo: {self.title}",
+            description=description,
+            color=discord.Color.green() if failed == 0 else discord.Color.gold()
+        )
+        embed.add_field(name="✅ Thành công", value=str(self.count(ITEM_DONE)), inline=True)
+        embed.add_field(name="❌ Thất bại", value=str(failed), inline=True)
+        embed.add_field(name="⏭️ Bỏ qua", value=str(self.count(ITEM_SKIPPED)), inline=True)
+        if failed:
+            embed.add_field(
+                name="Chi tiết thất bại",
+                value=truncate_field(f"{result.label}: {result.message[:80]}" for result in self.results
+                                     if result.status == ITEM_FAILED),
+                inline=False
+            )
+        excluded = defaultdict(list)
+        for result in self.results:
+            if result.excluded:
+                excluded[result.message].append(result.label)
+        if excluded:
+            embed.add_field(
+                name="⛔ Loại trước khi chạy",
+                value=truncate_field(f"**{reason}** ({len(labels)}): {', '.join(labels)[:200]}"
+                                     for reason, labels in excluded.items()),
+                inline=False
+            )
+        footer = f"{len(self.results)} mục"
+        if self.elapsed is not None:
+            footer += f" trong {format_duration(self.elapsed)}"
+        embed.set_footer(text=footer + " | Báo cáo đầy đủ trong file đính kèm")
+        return embed
+
+    def file(self):
+        buffer = io.StringIO()
+        writer = csv.writer(buffer)
+        writer.writerow(["target", "status", "message"])
+        for result in self.results:
+            writer.writerow([result.label, result.status, result.message])
+        slug = re.sub(r'[^a-z0-9]+', '-', self.title.lower()).strip('-') or 'bulk'
+        return discord.File(io.BytesIO(buffer.getvalue().encode('utf-8')), filename=f"{slug}-report.csv")
+
+    async def send(self, destination, description=None):
+        await destination.send(embed=self.embed(description), file=self.file())
+
+class BulkOperation:
+    """
+    Khung chung cho mọi thao tác hàng loạt: chạy action(target) cho từng target với số lượng đồng thời
+    giới hạn, thử lại lỗi tạm thời, cập nhật ProgressReporter và trả về BulkReport.
+    action trả về message khi thành công, raise BulkSkip/BulkFailure cho kết quả đã biết.
+    Rate limit do tầng gọi API lo (discord.py HTTP client hoặc member_add_engine); nếu có group(target),
+    các target được xen kẽ vòng tròn giữa các nhóm để các bucket độc lập cùng được dùng.
+    ordered_groups=True: target cùng nhóm chạy tuần tự theo đúng thứ tự, các nhóm chạy song song
+    (tối đa concurrency nhóm) - thời gian tổng theo nhóm chậm nhất thay vì tổng số target.
+    preflight(target) trả về lý do (chuỗi) nếu target chắc chắn sẽ thất bại: target đó được loại ngay
+    (skipped, excluded=True) mà không gọi action.
+    """
+    def __init__(self, title, targets, action, label=str, group=None, ordered_groups=False, preflight=None,
+                 concurrency=BULK_CONCURRENCY, retries=BULK_RETRIES):
+        self.title = title
+        self.targets = list(targets)
+        self.action = action
+        self.label = label
+        self.group = group
+        self.ordered_groups = ordered_groups
+        self.preflight = preflight
+        self.concurrency = concurrency
+        self.retries = retries
+        self._excluded = {}
+
+    def _lanes(self):
+        """Chỉ số target (trừ target bị loại) theo từng nhóm, giữ thứ tự xuất hiện."""
+        lanes = OrderedDict()
+        for index, target in enumerate(self.targets):
+            if index not in self._excluded:
+                lanes.setdefault(self.group(target), []).append(index)
+        return list(lanes.values())
+
+    def _ordered(self):
+        """Chỉ số target theo thứ tự chạy (vòng tròn giữa các nhóm nếu có group)."""
+        if self.group is None:
+            return [index for index in range(len(self.targets)) if index not in self._excluded]
+        return [index for round_robin in itertools.zip_longest(*self._lanes())
+                for index in round_robin if index is not None]
+
+    async def _run_one(self, target, semaphore, progress):
+        attempt = 0
+        while True:
+            attempt += 1
+            try:
+                if semaphore is None:
+                    message = await self.action(target)
+                else:
+                    async with semaphore:
+                        message = await self.action(target)
+                status, message = ITEM_DONE, message or "OK"
+            except BulkSkip as e:
+                status, message = ITEM_SKIPPED, describe_error(e)
+            except Exception as e:
+                if attempt <= self.retries and is_transient_error(e):
+                    await asyncio.sleep(2 ** attempt)
+                    continue
+                status, message = ITEM_FAILED, describe_error(e)
+            if progress:
+                progress.advance(done=status == ITEM_DONE, failed=status == ITEM_FAILED, skipped=status == ITEM_SKIPPED)
+            return BulkResult(target, self.label(target), status, message)
+
+    async def run(self, destination=None, progress=None):
+        """
+        Chạy mọi target. Nếu có destination (và không truyền progress sẵn) thì tự tạo tin nhắn tiến độ.
+        Kết quả trong report giữ đúng thứ tự targets.
+        """
+        own_progress = progress is None and destination is not None
+        if own_progress:
+            progress = await ProgressReporter(self.title, len(self.targets)).start(destination)
+        started = time.monotonic()
+        semaphore = asyncio.Semaphore(self.concurrency)
+        results = [None] * len(self.targets)
+
+        self._excluded = {}
+        if self.preflight is not None:
+            for index, target in enumerate(self.targets):
+                reason = self.preflight(target)
+                if reason:
+                    self._excluded[index] = reason
+                    results[index] = BulkResult(target, self.label(target), ITEM_SKIPPED, reason, True)
+            if progress and self._excluded:
+                progress.advance(skipped=len(self._excluded))
+
+        async def run(index):
+            results[index] = await self._run_one(self.targets[index], semaphore, progress)
+
+        async def run_lane(indexes):
+            # Cả nhóm giữ một suất của semaphore cho tới khi chạy xong target cuối
+            async with semaphore:
+                for index in indexes:
+                    results[index] = await self._run_one(self.targets[index], None, progress)
+
+        if self.ordered_groups and self.group is not None:
+            await asyncio.gather(*(run_lane(indexes) for indexes in self._lanes()))
+        else:
+            # Task được tạo theo thứ tự chạy nên cũng lấy semaphore theo thứ tự đó
+            await asyncio.gather(*(run(index) for index in self._ordered()))
+
+        if own_progress:
+            await progress.finish()
+        return BulkReport(self.title, results, time.monotonic() - started)
 
-        # 1. Xóa hồ sơ chính của user
-        if user_id_str in full_data:
-            del full_data[user_id_str]
-            made_change = True
-            print(f"[Storage] Đã xóa hồ sơ chính của user {user_id_str}.")
+async def add_member_action(guild_id: int, user_id: int, access_token: str):
+    """
+    Action thêm member cho BulkOperation (qua member_add_engine: bucket rate limit, thử lại 429 và lỗi
+    tạm thời). Engine là tầng thử lại duy nhất: kết quả thất bại trả về đã là kết quả cuối cùng.
+    """
+    result = await member_add_engine.add(guild_id, user_id, access_token)
+    if result.success:
+        return result.message
+    raise BulkFailure(result.message)
 
-        # 2. Xóa user khỏi danh sách thứ tự '_roster_order' nếu có
-        if '_roster_order' in full_data:
-            try:
-                full_data['_roster_order'].remove(user_id_str)
-                made_change = True
-                print(f"[Storage] Đã xóa user {user_id_str} khỏi _roster_order.")
-            except ValueError:
-                # User không có trong danh sách thứ tự, không sao cả
-                pass
-        
-        # 3. Chỉ ghi lại vào bin nếu có sự thay đổi
-        if made_change:
-            return self.write_data(full_data)
-        
-        return True # Trả về True nếu không có gì để xóa
+# --- GUILD DIRECTORY ---
+GUILD_PAGE_SIZE = 25  # Số option tối đa của một Select menu
+GUILD_SEARCH_LIMIT = 25  # Số gợi ý tối đa của autocomplete
 
-# Khởi tạo JSONBin storage
-jsonbin_storage = JSONBinStorage()
+class GuildDirectory:
+    """
+    Danh sách server theo thứ tự bot tham gia (cũ nhất -> mới nhất), cập nhật dần từ
+    on_guild_join/on_guild_remove/on_guild_update thay vì sắp xếp lại bot.guilds ở mỗi lệnh.
+    Các trang 25 server được tính một lần sau mỗi thay đổi và dùng chung cho mọi View.
+    Kèm chỉ mục tên (danh sách tên đã sắp xếp cho tìm tiền tố + trigram cho tìm gần đúng)
+    phục vụ autocomplete của lệnh slash.
+    """
+    def __init__(self):
+        self._keys = []  # [(joined_at, guild_id)] đã sắp xếp
+        self._guilds = {}
+        self._names = {}
+        self._by_name = []  # [(tên chuẩn hóa, guild_id)] đã sắp xếp
+        self._trigrams = defaultdict(set)
+        self._pages = None
+
+    @staticmethod
+    def _sort_key(guild):
+        joined_at = guild.me.joined_at if guild.me else None
+        return (joined_at.timestamp() if joined_at else time.time(), guild.id)
+
+    def build(self, guilds):
+        self.__init__()
+        for guild in guilds:
+            self.add(guild)
+        print(f"[Guilds] 📇 Guild directory: {len(self._guilds)} servers")
+
+    def _index_name(self, guild):
+        name = normalize_name(guild.name)
+        self._names[guild.id] = name
+        bisect.insort(self._by_name, (name, guild.id))
+        for gram in name_trigrams(name):
+            self._trigrams[gram].add(guild.id)
+
+    def _unindex_name(self, guild_id):
+        name = self._names.pop(guild_id, None)
+        if name is None:
+            return
+        index = bisect.bisect_left(self._by_name, (name, guild_id))
+        if index < len(self._by_name) and self._by_name[index] == (name, guild_id):
+            del self._by_name[index]
+        for gram in name_trigrams(name):
+            ids = self._trigrams.get(gram)
+            if ids is not None:
+                ids.discard(guild_id)
+                if not ids:
+                    del self._trigrams[gram]
+
+    def add(self, guild):
+        if guild.id in self._guilds:
+            self.remove(guild.id)
+        self._guilds[guild.id] = guild
+        bisect.insort(self._keys, self._sort_key(guild))
+        self._index_name(guild)
+        self._pages = None
+
+    def remove(self, guild_id):
+        guild = self._guilds.pop(guild_id, None)
+        if guild is None:
+            return
+        self._keys = [key for key in self._keys if key[1] != guild_id]
+        self._unindex_name(guild_id)
+        self._pages = None
 
-# --- DATABASE SETUP ---
-def init_database():
-    """Khởi tạo database và tạo bảng nếu chưa có"""
-    if not DATABASE_URL or not HAS_PSYCOPG2:
-        print("⚠️ WARNING: Không có DATABASE_URL hoặc psycopg2, sử dụng JSONBin.io")
-        return False
-    
-    try:
-        conn = psycopg2.connect(DATABASE_URL, sslmode='require')
-        cursor = conn.cursor()
-        
-        # Tạo bảng user_tokens nếu chưa có
-        cursor.execute('''
-            CREATE TABLE IF NOT EXISTS user_tokens (
-                user_id VARCHAR(50) PRIMARY KEY,
-                access_token TEXT NOT NULL,
-                username VARCHAR(100),
-                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-            )
-        ''')
-        
-        conn.commit()
-        cursor.close()
-        conn.close()
-        print("✅ Database initialized successfully")
-        return True
-        
-    except Exception as e:
-        print(f"❌ Database connection failed: {e}")
-        print("🔄 Falling back to JSONBin.io storage")
-        return False
+    def rename(self, guild):
+        """Tên server thay đổi: cập nhật chỉ mục tên và option của các trang."""
+        if guild.id not in self._guilds:
+            return
+        self._guilds[guild.id] = guild
+        self._unindex_name(guild.id)
+        self._index_name(guild)
+        self._pages = None
+
+    def __len__(self):
+        return len(self._guilds)
+
+    def get(self, guild_id):
+        return self._guilds.get(int(guild_id))
+
+    def ordered(self):
+        return [self._guilds[guild_id] for _, guild_id in self._keys]
+
+    def pages(self):
+        """Các trang GUILD_PAGE_SIZE server (tính lại chỉ sau khi danh sách thay đổi)."""
+        if self._pages is None:
+            ordered = self.ordered()
+            self._pages = [ordered[i:i + GUILD_PAGE_SIZE] for i in range(0, len(ordered), GUILD_PAGE_SIZE)]
+        return self._pages
+
+    def select(self, guild_ids):
+        """Các server trong guild_ids theo thứ tự của danh sách."""
+        return [self._guilds[guild_id] for _, guild_id in self._keys if guild_id in guild_ids]
+
+    def search(self, query, limit=GUILD_SEARCH_LIMIT):
+        """
+        Tìm server theo tên hoặc ID: khớp tiền tố tên trước, sau đó khớp gần đúng theo trigram
+        (ít nhất một nửa số trigram của truy vấn), cùng điểm thì theo thứ tự bot tham gia.
+        Truy vấn rỗng trả về các server đầu danh sách.
+        """
+        query = normalize_name(query or "")
+        if not query:
+            return self.ordered()[:limit]
+        position = {guild_id: index for index, (_, guild_id) in enumerate(self._keys)}
+        matches = []
+        seen = set()
+
+        if query.isdigit():
+            for guild_id in self._guilds:
+                if str(guild_id).startswith(query):
+                    matches.append(guild_id)
+                    seen.add(guild_id)
+            matches.sort(key=position.get)
+
+        prefix = []
+        index = bisect.bisect_left(self._by_name, (query,))
+        while index < len(self._by_name) and self._by_name[index][0].startswith(query):
+            if self._by_name[index][1] not in seen:
+                prefix.append(self._by_name[index][1])
+            index += 1
+        prefix.sort(key=position.get)
+        matches.extend(prefix)
+        seen.update(prefix)
+
+        grams = name_trigrams(query, pad_end=False)
+        scores = defaultdict(int)
+        for gram in grams:
+            for guild_id in self._trigrams.get(gram, ()):
+                if guild_id not in seen:
+                    scores[guild_id] += 1
+        threshold = (len(grams) + 1) // 2
+        fuzzy = [guild_id for guild_id, score in scores.items() if score >= threshold]
+        fuzzy.sort(key=lambda guild_id: (-scores[guild_id], position[guild_id]))
+        matches.extend(fuzzy)
+        return [self._guilds[guild_id] for guild_id in matches[:limit]]
+
+    def resolve(self, value):
+        """
+        Giá trị từ autocomplete (ID) hoặc tên gõ tay -> server. Chỉ nhận đúng ID hoặc đúng tên (sau chuẩn hóa);
+        không khớp gần đúng để một tên gõ sai không bị áp dụng nhầm lên server khác.
+        None nếu không tìm thấy hoặc có nhiều server trùng tên.
+        """
+        value = (value or "").strip()
+        if value.isdigit() and int(value) in self._guilds:
+            return self._guilds[int(value)]
+        name = normalize_name(value)
+        index = bisect.bisect_left(self._by_name, (name,))
+        matches = []
+        while index < len(self._by_name) and self._by_name[index][0] == name:
+            matches.append(self._by_name[index][1])
+            index += 1
+        return self._guilds[matches[0]] if len(matches) == 1 else None
+
+guild_directory = GuildDirectory()
+
+async def guild_autocomplete(interaction: discord.Interaction, current: str):
+    """Autocomplete tên server cho lệnh slash (chỉ chủ bot mới thấy danh sách server)."""
+    if not await bot.is_owner(interaction.user):
+        return []
+    return [app_commands.Choice(name=guild.name[:100], value=str(guild.id))
+            for guild in guild_directory.search(current)]
+
+# --- MEMBERSHIP INDEX ---
+class MembershipIndex:
+    """
+    Ma trận thành viên điệp viên × server của bot. Mỗi server là một bitset (int Python),
+    bit i bật khi điệp viên ở slot i có trong server. Dựng một lần từ member cache rồi cập nhật
+    theo on_member_join/on_member_remove. Chỉ dùng trên event loop của bot.
+    """
+    def __init__(self):
+        self._slots = {}    # user_id -> slot
+        self._agents = []   # slot -> user_id (None khi điệp viên đã bị xóa)
+        self._guilds = {}   # guild_id -> bitset
+        self.built = False
+
+    def _slot(self, user_id):
+        slot = self._slots.get(user_id)
+        if slot is None:
+            slot = self._slots[user_id] = len(self._agents)
+            self._agents.append(user_id)
+        return slot
+
+    def _scan_guild(self, guild):
+        flags = bytearray((len(self._agents) + 7) // 8)
+        for member in guild.members:
+            slot = self._slots.get(member.id)
+            if slot is not None:
+                flags[slot >> 3] |= 1 << (slot & 7)
+        return int.from_bytes(flags, 'little')
+
+    def build(self, agent_ids, guilds):
+        self._slots, self._agents = {}, []
+        for user_id in agent_ids:
+            self._slot(int(user_id))
+        self._guilds = {guild.id: self._scan_guild(guild) for guild in guilds}
+        self.built = True
+
+    def add_agent(self, user_id, guilds):
+        user_id = int(user_id)
+        if user_id in self._slots:
+            return
+        bit = 1 << self._slot(user_id)
+        for guild in guilds:
+            if guild.id in self._guilds and guild.get_member(user_id):
+                self._guilds[guild.id] |= bit
+
+    def remove_agent(self, user_id):
+        slot = self._slots.pop(int(user_id), None)
+        if slot is None:
+            return
+        self._agents[slot] = None
+        mask = ~(1 << slot)
+        for guild_id in self._guilds:
+            self._guilds[guild_id] &= mask
 
-# --- DATABASE FUNCTIONS ---
-def get_db_connection():
-    """Tạo connection tới database"""
-    if DATABASE_URL and HAS_PSYCOPG2:
-        try:
-            return psycopg2.connect(DATABASE_URL, sslmode='require')
-        except Exception as e:
-            print(f"Database connection error: {e}")
-            return None
-    return None
+    def add_guild(self, guild):
+        self._guilds[guild.id] = self._scan_guild(guild)
 
-def get_user_access_token_db(user_id: str):
-    """Lấy access token từ database"""
-    conn = get_db_connection()
-    if conn:
-        try:
-            cursor = conn.cursor()
-            cursor.execute("SELECT access_token FROM user_tokens WHERE user_id = %s", (user_id,))
-            result = cursor.fetchone()
-            cursor.close()
-            conn.close()
-            return result[0] if result else None
-        except Exception as e:
-            print(f"Database error: {e}")
-            if conn:
-                conn.close()
-    return None
+    def remove_guild(self, guild_id):
+        self._guilds.pop(guild_id, None)
 
-def save_user_token_db(user_id: str, access_token: str, username: str = None, avatar_hash: str = None):
-    """Lưu access token vào database"""
-    conn = get_db_connection()
-    if conn:
-        try:
-            cursor = conn.cursor()
-            cursor.execute('''
-                INSERT INTO user_tokens (user_id, access_token, username, avatar_hash) 
-                VALUES (%s, %s, %s, %s)
-                ON CONFLICT (user_id) 
-                DO UPDATE SET 
-                    access_token = EXCLUDED.access_token,
-                    username = EXCLUDED.username,
-                    avatar_hash = EXCLUDED.avatar_hash,
-                    updated_at = CURRENT_TIMESTAMP
-            ''', (user_id, access_token, username, avatar_hash))
-            conn.commit()
-            cursor.close()
-            conn.close()
-            print(f"✅ Saved token for user {user_id} to database")
-            return True
-        except Exception as e:
-            print(f"Database error: {e}")
-            if conn:
-                conn.close()
-    return False
+    def set_member(self, guild_id, user_id, present):
+        slot = self._slots.get(user_id)
+        if slot is None or guild_id not in self._guilds:
+            return
+        if present:
+            self._guilds[guild_id] |= 1 << slot
+        else:
+            self._guilds[guild_id] &= ~(1 << slot)
 
-# --- FALLBACK JSON FUNCTIONS (kept for compatibility) ---
-def get_user_access_token_json(user_id: str):
-    """Backup: Lấy token từ file JSON"""
-    try:
-        with open('tokens.json', 'r') as f:
-            tokens = json.load(f)
-            data = tokens.get(str(user_id))
-            if isinstance(data, dict):
-                return data.get('access_token')
-            return data
-    except (FileNotFoundError, json.JSONDecodeError):
-        return None
-
-def save_user_token_json(user_id: str, access_token: str, username: str = None, avatar_hash: str = None):
-    """Backup: Lưu token vào file JSON"""
-    try:
-        try:
-            with open('tokens.json', 'r') as f:
-                tokens = json.load(f)
-        except (FileNotFoundError, json.JSONDecodeError):
-            tokens = {}
-        
-        tokens[user_id] = {
-            'access_token': access_token,
-            'username': username,
-            'avatar_hash': avatar_hash,
-            'updated_at': str(time.time())
+    def is_member(self, user_id, guild_id):
+        """True/False theo chỉ mục, None nếu chỉ mục không biết điệp viên hoặc server này."""
+        slot = self._slots.get(int(user_id))
+        bits = self._guilds.get(int(guild_id))
+        if slot is None or bits is None:
+            return None
+        return bool(bits >> slot & 1)
+
+    def missing_pairs(self, items):
+        """Lọc [(user_id, guild_id)] bỏ các cặp đã có sẵn. Trả về (items còn thiếu, số cặp đã có)."""
+        missing = [(user_id, guild_id) for user_id, guild_id in items if not self.is_member(user_id, guild_id)]
+        return missing, len(items) - len(missing)
+
+    def coverage(self):
+        """Số điệp viên, số cặp đã có, điệp viên có mặt ở mọi/không server nào và {guild_id: số điệp viên}."""
+        agent_count = len(self._slots)
+        all_agents = 0
+        for slot in self._slots.values():
+            all_agents |= 1 << slot
+        everywhere, anywhere = all_agents, 0
+        per_guild = {}
+        for guild_id, bits in self._guilds.items():
+            per_guild[guild_id] = bits.bit_count()
+            everywhere &= bits
+            anywhere |= bits
+        return {
+            "agents": agent_count,
+            "guilds": len(self._guilds),
+            "pairs": sum(per_guild.values()),
+            "everywhere": everywhere.bit_count() if self._guilds else 0,
+            "nowhere": agent_count - (anywhere & all_agents).bit_count(),
+            "per_guild": per_guild,
         }
-        
-        with open('tokens.json', 'w') as f:
-            json.dump(tokens, f, indent=4)
-        print(f"✅ Saved token for user {user_id} to JSON file")
-        return True
-    except Exception as e:
-        print(f"JSON file error: {e}")
-        return False
 
-# --- UNIFIED TOKEN FUNCTIONS ---
-def get_user_access_token(user_id: int):
-    """Lấy access token (Ưu tiên: Database > JSONBin.io > JSON file)"""
-    user_id_str = str(user_id)
-    
-    # Try database first
-    token = get_user_access_token_db(user_id_str)
-    if token:
-        return token
-    
-    # Try JSONBin.io
-    if JSONBIN_API_KEY:
-        token = jsonbin_storage.get_user_token(user_id_str)
-        if token:
-            return token
-    
-    # Fallback to JSON file (for local development)
-    return get_user_access_token_json(user_id_str)
+membership_index = MembershipIndex()
 
-def save_user_token(user_id: str, access_token: str, username: str = None, avatar_hash: str = None):
-    """Lưu access token (Database + JSONBin.io + JSON backup)"""
-    success_db = save_user_token_db(user_id, access_token, username, avatar_hash)
-    success_jsonbin = False
-    success_json = False
-    
-    # Try JSONBin.io
-    if JSONBIN_API_KEY:
-        success_jsonbin = jsonbin_storage.save_user_token(user_id, access_token, username, avatar_hash)
-    
-    # Local JSON backup (for development)
-    success_json = save_user_token_json(user_id, access_token, username, avatar_hash)
-    
-    return success_db or success_jsonbin or success_json
+# --- JOB QUEUE ---
+JOB_BATCH_SIZE = int(os.getenv('JOB_BATCH_SIZE', 100))
 
-def delete_user_from_db(user_id: str):
-    """Xóa user khỏi database"""
-    conn = get_db_connection()
-    if conn:
+job_store = JobStore()
+
+class JobRunner:
+    """
+    Chạy các job thêm member từ job_store: mỗi lần lấy một lô item đang chờ, chạy lô đó bằng
+    BulkOperation rồi ghi kết quả của cả lô trong một checkpoint. Trạng thái job được đọc lại
+    trước mỗi lô nên lệnh pause/cancel có hiệu lực sau lô hiện tại.
+    """
+    def __init__(self, batch_size=JOB_BATCH_SIZE):
+        self.batch_size = batch_size
+        self._tasks = {}
+
+    def is_running(self, job_id):
+        task = self._tasks.get(job_id)
+        return task is not None and not task.done()
+
+    def start(self, job_id):
+        if not self.is_running(job_id):
+            self._tasks[job_id] = asyncio.get_running_loop().create_task(self._run(job_id))
+
+    async def submit(self, kind, items, owner_id, channel_id, label):
+        """
+        Lưu job [(user_id, guild_id)] rồi bắt đầu chạy; các cặp đã có sẵn theo membership_index được bỏ qua.
+        Trả về (job_id, số cặp đã có), job_id là None nếu không còn cặp nào cần thêm.
+        """
+        items, satisfied = membership_index.missing_pairs(items)
+        if not items:
+            return None, satisfied
+        job_id = await token_store.run(job_store.create_job, kind, items, owner_id, channel_id, label)
+        self.start(job_id)
+        return job_id, satisfied
+
+    @staticmethod
+    def describe_submission(job_id, satisfied):
+        """Tin nhắn xác nhận sau submit()."""
+        skipped = f" ({satisfied} cặp đã có sẵn được bỏ qua)" if satisfied else ""
+        if job_id is None:
+            return f"✅ Không cần thêm ai: mọi cặp đã có sẵn{skipped}."
+        return f"📋 Đã tạo job **#{job_id}**{skipped}. Dùng `!jobs {job_id}` để xem tiến độ, báo cáo sẽ được gửi khi hoàn tất."
+
+    async def resume_all(self):
+        """Tiếp tục mọi job đang chạy dở (gọi khi bot khởi động)."""
+        jobs = await token_store.run(job_store.list_jobs, [JOB_RUNNING], 1000)
+        for job in jobs:
+            self.start(job['job_id'])
+        return len(jobs)
+
+    async def _start_progress(self, job_id):
+        job = await token_store.run(job_store.get_job, job_id)
+        channel = bot.get_channel(int(job['channel_id'])) if job and job['channel_id'].isdigit() else None
+        if channel is None:
+            return None
+        counts = job['counts']
+        progress = ProgressReporter(
+            f"Job #{job_id} - {job['label'] or job['kind']}", job['total'],
+            done=counts.get(ITEM_DONE, 0), failed=counts.get(ITEM_FAILED, 0), skipped=counts.get(ITEM_SKIPPED, 0)
+        )
         try:
-            cursor = conn.cursor()
-            cursor.execute("DELETE FROM user_tokens WHERE user_id = %s", (user_id,))
-            conn.commit()
-            cursor.close()
-            conn.close()
-            print(f"✅ Deleted user {user_id} from database")
-            return True
-        except Exception as e:
-            print(f"Database delete error: {e}")
-            if conn:
-                conn.close()
-    return False
+            return await progress.start(channel)
+        except discord.HTTPException as e:
+            print(f"[Jobs] Không thể gửi tin nhắn tiến độ cho job #{job_id}: {e}")
+            return None
 
-def delete_user_from_json(user_id: str):
-    """Xóa user khỏi file JSON"""
-    try:
-        with open('tokens.json', 'r') as f:
-            tokens = json.load(f)
-
-        if user_id in tokens:
-            del tokens[user_id]
-            with open('tokens.json', 'w') as f:
-                json.dump(tokens, f, indent=4)
-            print(f"✅ Deleted user {user_id} from JSON file")
-        return True
-    except (FileNotFoundError, json.JSONDecodeError):
-        return True # File không tồn tại coi như đã xóa
-    except Exception as e:
-        print(f"JSON file delete error: {e}")
-        return False
-        
-# --- DISCORD BOT SETUP ---
-intents = discord.Intents.default()
-intents.members = True
-intents.message_content = True
-bot = commands.Bot(command_prefix='!', intents=intents, owner_id=1386710352426959011, help_command=None)
+    async def _run(self, job_id):
+        progress = None
+        outcome = "✅ Hoàn tất"
+        try:
+            progress = await self._start_progress(job_id)
+            while True:
+                status = await token_store.run(job_store.get_status, job_id)
+                if status != JOB_RUNNING:
+                    outcome = "⏸️ Tạm dừng" if status == JOB_PAUSED else "🛑 Đã hủy"
+                    return
+                batch = await token_store.run(job_store.pending_items, job_id, self.batch_size)
+                if not batch:
+                    break
+                results = await self._process(job_id, batch, progress)
+                await token_store.run(job_store.record_results, job_id, results)
+            await token_store.run(job_store.set_status, job_id, JOB_DONE)
+            await self._report(job_id)
+        except Exception as e:
+            # Item chưa checkpoint vẫn ở trạng thái pending, job sẽ chạy tiếp ở lần khởi động sau
+            print(f"[Jobs] ❌ Job #{job_id} dừng do lỗi: {e}")
+            outcome = "❌ Dừng do lỗi"
+        finally:
+            if progress:
+                await progress.finish(outcome)
+
+    async def _process(self, job_id, batch, progress):
+        """Xử lý một lô [(user_id, guild_id)]. Trả về [(user_id, guild_id, status, message)]."""
+        tokens, _ = await token_store.get_tokens({int(user_id) for user_id, _ in batch})
+
+        async def add(item):
+            user_id, guild_id = item
+            guild = bot.get_guild(int(guild_id))
+            if token_health.is_dead(user_id):
+                raise BulkSkip("Token đã hỏng - bỏ qua")
+            if not guild:
+                raise BulkFailure("Không tìm thấy hoặc bot không ở trong server")
+            if membership_index.is_member(user_id, guild_id) or guild.get_member(int(user_id)):
+                return "User đã có trong server"
+            if not tokens.get(user_id):
+                raise BulkFailure("Không có token")
+            return await add_member_action(guild.id, int(user_id), tokens[user_id])
+
+        report = await BulkOperation(
+            f"Job #{job_id}", batch, add, group=lambda item: item[1],
+            concurrency=member_add_engine.concurrency
+        ).run(progress=progress)
+        return [(user_id, guild_id, result.status, result.message[:200])
+                for (user_id, guild_id), result in zip(batch, report.results)]
+
+    async def _report(self, job_id):
+        """Gửi báo cáo cuối (kèm file đầy đủ) vào kênh đã tạo job, không phụ thuộc interaction token."""
+        job = await token_store.run(job_store.get_job, job_id)
+        items = await token_store.run(job_store.items, job_id)
+        channel = bot.get_channel(int(job['channel_id'])) if job['channel_id'].isdigit() else None
+        print(f"[Jobs] ✅ Job #{job_id} hoàn tất: {job['counts']}")
+        if channel:
+            report = BulkReport(f"Job #{job_id} - {job['label'] or job['kind']}", [
+                BulkResult((user_id, guild_id), member_pair_label(user_id, guild_id), status, message or "")
+                for user_id, guild_id, status, message in items
+            ])
+            await report.send(channel)
+
+job_runner = JobRunner()
+
+def create_job_embed(job, failures=()):
+    """Embed trạng thái/báo cáo của một job."""
+    counts = job['counts']
+    status_emoji = {JOB_RUNNING: "⏳", JOB_PAUSED: "⏸️", JOB_CANCELLED: "🛑", JOB_DONE: "✅"}
+    embed = discord.Embed(
+        title=f"📋 Job #{job['job_id']} - {job['label'] or job['kind']}",
+        description=f"Trạng thái: {status_emoji.get(job['status'], '')} **{job['status']}**",
+        color=0x00ff00 if job['status'] == JOB_DONE else discord.Color.orange()
+    )
+    embed.add_field(name="✅ Thành công", value=str(counts.get(ITEM_DONE, 0)), inline=True)
+    embed.add_field(name="❌ Thất bại", value=str(counts.get(ITEM_FAILED, 0)), inline=True)
+    embed.add_field(name="⏭️ Bỏ qua", value=str(counts.get(ITEM_SKIPPED, 0)), inline=True)
+    embed.add_field(name="⌛ Đang chờ", value=f"{counts.get('pending', 0)}/{job['total']}", inline=True)
+    if failures:
+        embed.add_field(
+            name="Chi tiết thất bại",
+            value=truncate_field(f"{member_pair_label(user_id, guild_id)}: {(message or '')[:50]}"
+                                 for user_id, guild_id, message in failures),
+            inline=False
+        )
+    return embed
 
-# --- FLASK WEB SERVER SETUP ---
-app = Flask(__name__)
+def member_pair_label(user_id, guild_id):
+    guild = bot.get_guild(int(guild_id))
+    return f"{user_id} -> {guild.name if guild else guild_id}"
 
-# --- UTILITY FUNCTIONS ---
-async def add_member_to_guild(guild_id: int, user_id: int, access_token: str):
-    """Thêm member vào guild sử dụng Discord API trực tiếp"""
-    url = f"https://discord.com/api/v10/guilds/{guild_id}/members/{user_id}"
-    headers = {
-        "Authorization": f"Bot {DISCORD_TOKEN}",
-        "Content-Type": "application/json"
-    }
-    data = {
-        "access_token": access_token
-    }
-    
-    async with aiohttp.ClientSession() as session:
-        async with session.put(url, headers=headers, json=data) as response:
-            if response.status == 201:
-                return True, "Thêm thành công"
-            elif response.status == 204:
-                return True, "User đã có trong server"
+# --- DEPLOY PLANNER ---
+class DeployPlan:
+    """
+    Kế hoạch cho một lượt triển khai: các cặp (điệp viên, server) đã khử trùng lặp và phân loại,
+    các lượt gọi API thật nhóm theo bucket rate limit (mỗi server một bucket) và ETA ước lượng.
+    """
+    def __init__(self):
+        self.requested = 0
+        self.items = []           # [(user_id, guild_id)] cần gọi API
+        self.satisfied = 0
+        self.dead_token = 0
+        self.no_token = 0
+        self.missing_guild = 0
+        self.calls_per_guild = {}
+        self.eta = 0.0
+
+    def drop_unavailable_guilds(self):
+        """
+        Bỏ khỏi kế hoạch các server bot đã rời (hoặc không khả dụng) từ lúc lập kế hoạch,
+        tính chúng vào missing_guild. Trả về số lượt gọi API bị bỏ.
+        """
+        gone = {guild_id for guild_id in self.calls_per_guild if not bot.get_guild(guild_id)}
+        if not gone:
+            return 0
+        dropped = sum(self.calls_per_guild.pop(guild_id) for guild_id in gone)
+        self.items = [(user_id, guild_id) for user_id, guild_id in self.items if guild_id not in gone]
+        self.missing_guild += dropped
+        self.eta = member_add_engine.estimate(self.calls_per_guild)
+        return dropped
+
+    def embed(self, dry_run=False):
+        embed = discord.Embed(
+            title="🧭 Kế Hoạch Triển Khai" + (" (Dry Run)" if dry_run else ""),
+            description=f"**{len(self.items)}** lượt gọi API thật trên **{len(self.calls_per_guild)}** bucket "
+                        f"(ETA ~{format_duration(self.eta)})",
+            color=discord.Color.blue() if dry_run else discord.Color.orange()
+        )
+        embed.add_field(name="📦 Cặp đã chọn", value=str(self.requested), inline=True)
+        embed.add_field(name="✅ Đã có sẵn", value=str(self.satisfied), inline=True)
+        embed.add_field(name="💀 Token hỏng", value=str(self.dead_token), inline=True)
+        embed.add_field(name="🔑 Không có token", value=str(self.no_token), inline=True)
+        embed.add_field(name="❓ Server không khả dụng", value=str(self.missing_guild), inline=True)
+        if self.calls_per_guild:
+            lines = []
+            for guild_id, calls in sorted(self.calls_per_guild.items(), key=lambda item: -item[1])[:10]:
+                limit, window = member_add_engine.bucket_budget(guild_id)
+                guild = bot.get_guild(guild_id)
+                lines.append(f"`{calls:>4}` lượt - {guild.name if guild else guild_id} ({limit}/{window:g}s)")
+            embed.add_field(name="🪣 Bucket lớn nhất", value=truncate_field(lines), inline=False)
+        return embed
+
+async def plan_member_adds(user_ids, guild_ids):
+    """Lập DeployPlan cho điệp viên × server (không gửi request nào tới Discord)."""
+    plan = DeployPlan()
+    user_ids = sorted({int(user_id) for user_id in user_ids})
+    guild_ids = sorted({int(guild_id) for guild_id in guild_ids})
+    plan.requested = len(user_ids) * len(guild_ids)
+    tokens, _ = await token_store.get_tokens(user_ids)
+
+    for guild_id in guild_ids:
+        guild = bot.get_guild(guild_id)
+        if not guild:
+            plan.missing_guild += len(user_ids)
+            continue
+        for user_id in user_ids:
+            if membership_index.is_member(user_id, guild_id) or guild.get_member(user_id):
+                plan.satisfied += 1
+            elif token_health.is_dead(user_id):
+                plan.dead_token += 1
+            elif not tokens.get(str(user_id)):
+                plan.no_token += 1
             else:
-                error_text = await response.text()
-                return False, f"HTTP {response.status}: {error_text}"
-                
+                plan.items.append((user_id, guild_id))
+                plan.calls_per_guild[guild_id] = plan.calls_per_guild.get(guild_id, 0) + 1
+
+    plan.eta = member_add_engine.estimate(plan.calls_per_guild)
+    return plan
+
+# --- CHANNEL LAYOUT ---
+LAYOUT_MAX_FILE_SIZE = 256 * 1024
+LAYOUT_REASON = "Áp dụng bố cục kênh (!layout)"
+LAYOUT_OP_NAMES = {
+    OP_CREATE_CATEGORY: "📁 Tạo danh mục",
+    OP_CREATE_CHANNEL: "➕ Tạo kênh",
+    OP_UPDATE_CHANNEL: "✏️ Sửa kênh",
+    OP_REORDER: "↕️ Sắp xếp lại",
+}
+
+class LayoutApplier:
+    """
+    Thực thi các LayoutOp của một server theo đúng thứ tự plan_layout() trả về.
+    Danh mục/kênh vừa tạo hoặc vừa sửa được ghi nhớ để các thao tác sau (tạo kênh trong danh mục mới,
+    sắp xếp lại) dùng ngay mà không phải chờ cache của discord.py nhận sự kiện từ gateway.
+    """
+    def __init__(self, guild, spec):
+        self.guild = guild
+        self.spec = spec
+        self.categories, self.channels = current_layout(guild)
+
+    def category(self, name):
+        return self.categories.get(category_key(name)) if name else None
+
+    def _parent(self, name):
+        category = self.category(name)
+        if name and category is None:
+            raise BulkFailure(f"Danh mục `{name}` chưa được tạo.")
+        return category
+
+    async def apply(self, op):
+        if op.kind == OP_CREATE_CATEGORY:
+            category = await self.guild.create_category(op.name, reason=LAYOUT_REASON)
+            self.categories[category_key(op.name)] = category
+            return f"Đã tạo danh mục {category.name} ({category.id})"
+        if op.kind == OP_CREATE_CHANNEL:
+            options = {'topic': op.changes['topic']} if op.changes.get('topic') else {}
+            channel = await self.guild.create_text_channel(
+                op.name, category=self._parent(op.category), reason=LAYOUT_REASON, **options
+            )
+            self.channels[channel_name_key(op.name)] = channel
+            return f"Đã tạo #{channel.name} ({channel.id})"
+        if op.kind == OP_UPDATE_CHANNEL:
+            channel = self.channels[channel_name_key(op.name)]
+            options = {}
+            if 'topic' in op.changes:
+                options['topic'] = op.changes['topic']
+            if 'category' in op.changes:
+                options['category'] = self._parent(op.changes['category'])
+            self.channels[channel_name_key(op.name)] = await channel.edit(reason=LAYOUT_REASON, **options) or channel
+            return "Đã cập nhật " + ", ".join(op.changes)
+        if op.kind == OP_REORDER:
+            payload = self._positions()
+            # Một request PATCH /guilds/{id}/channels cho mọi vị trí, qua rate limiter của discord.py
+            await bot.http.bulk_channel_update(self.guild.id, payload, reason=LAYOUT_REASON)
+            return f"Đã sắp xếp lại {len(payload)} danh mục/kênh"
+        raise BulkFailure(f"Thao tác không hỗ trợ: {op.kind}")
+
+    def _positions(self):
+        """Vị trí mới: mục trong bố cục theo đúng thứ tự khai báo, các mục khác giữ thứ tự cũ phía sau."""
+        by_position = lambda channel: (channel.position, channel.id)
+        payload = []
+        managed = [self.category(entry['name']) for entry in self.spec['categories'] if entry['name']]
+        managed = [category for category in managed if category]
+        managed_ids = {category.id for category in managed}
+        others = [category for category in sorted(self.guild.categories, key=by_position) if category.id not in managed_ids]
+        payload.extend({'id': category.id, 'position': position} for position, category in enumerate(managed + others))
+
+        spec_channels = {
+            entry['name']: [channel for channel in (self.channels.get(channel_name_key(spec_channel['name']))
+                                                    for spec_channel in entry['channels']) if channel]
+            for entry in self.spec['categories']
+        }
+        managed_channel_ids = {channel.id for channels in spec_channels.values() for channel in channels}
+        for entry in self.spec['categories']:
+            category = self.category(entry['name'])
+            if entry['name'] and category is None:
+                continue
+            parent_id = category.id if category else None
+            channels = spec_channels[entry['name']] + [
+                channel for channel in sorted(self.guild.text_channels, key=by_position)
+                if channel.category_id == parent_id and channel.id not in managed_channel_ids
+            ]
+            payload.extend({'id': channel.id, 'position': position, 'parent_id': parent_id}
+                           for position, channel in enumerate(channels))
+        return payload
+
+def layout_plan_embed(plans, unresolved, dry_run=False):
+    """Tóm tắt kế hoạch {guild: [LayoutOp]} trước khi áp dụng."""
+    total = sum(len(ops) for ops in plans.values())
+    changed = {guild: ops for guild, ops in plans.items() if ops}
+    embed = discord.Embed(
+        title="🧱 Kế Hoạch Bố Cục Kênh" + (" (Dry Run)" if dry_run else ""),
+        description=f"**{total}** thao tác trên **{len(changed)}** server, "
+                    f"**{len(plans) - len(changed)}** server đã khớp bố cục.",
+        color=discord.Color.blue() if dry_run or not total else discord.Color.orange()
+    )
+    counts = defaultdict(int)
+    for ops in changed.values():
+        for op in ops:
+            counts[op.kind] += 1
+    for kind, name in LAYOUT_OP_NAMES.items():
+        if counts[kind]:
+            embed.add_field(name=name, value=str(counts[kind]), inline=True)
+    if changed:
+        embed.add_field(
+            name="🖥️ Server cần thay đổi",
+            value=truncate_field(f"`{len(ops):>3}` - {guild.name}" for guild, ops in
+                                 sorted(changed.items(), key=lambda item: -len(item[1]))),
+            inline=False
+        )
+    if unresolved:
+        embed.add_field(name="❓ Không tìm thấy server", value=truncate_field(f"`{value}`" for value in unresolved), inline=False)
+    return embed
+
 # --- INTERACTIVE UI COMPONENTS ---
 
 # Lớp này định nghĩa giao diện lựa chọn server
 class ServerSelectView(discord.ui.View):
-    def __init__(self, author: discord.User, target_user: discord.User, guilds: list[discord.Guild]):
+    def __init__(self, author: discord.User, target_user: discord.User):
         super().__init__(timeout=300)
         self.author = author
         self.target_user = target_user
-        self.guilds = guilds
         self.selected_guild_ids = set()
 
-        # Chia danh sách server thành các phần nhỏ, mỗi phần tối đa 25
-        guild_chunks = [self.guilds[i:i + 25] for i in range(0, len(self.guilds), 25)]
+        # Các trang 25 server lấy sẵn từ guild_directory
+        guild_chunks = guild_directory.pages()
         
         # Tạo một menu cho mỗi phần
         for index, chunk in enumerate(guild_chunks):
@@ -480,44 +3412,78 @@ class ServerSelectView(discord.ui.View):
         
         await interaction.followup.send(f"✅ Đã nhận lệnh! Bắt đầu mời **{self.target_user.name}** vào **{len(self.selected_guild_ids)}** server đã chọn...")
 
-        access_token = get_user_access_token(self.target_user.id)
+        access_token = await token_store.get_token(self.target_user.id)
         if not access_token:
             await interaction.followup.send(f"❌ Người dùng **{self.target_user.name}** chưa ủy quyền cho bot.")
             return
 
-        success_count, fail_count = 0, 0
-        for guild_id in self.selected_guild_ids:
-            success, message = await add_member_to_guild(guild_id, self.target_user.id, access_token)
-            if success:
-                success_count += 1
-            else:
-                fail_count += 1
-        
-        embed = discord.Embed(title=f"📊 Kết quả mời {self.target_user.name}", color=0x00ff00)
-        embed.add_field(name="✅ Thành công", value=f"{success_count} server", inline=True)
-        embed.add_field(name="❌ Thất bại", value=f"{fail_count} server", inline=True)
-        await interaction.followup.send(embed=embed)
+        membership_index.add_agent(self.target_user.id, bot.guilds)
+        user_id = self.target_user.id
+
+        async def summon(guild_id):
+            # Server đã có user theo chỉ mục thành viên thì không cần gửi PUT
+            if membership_index.is_member(user_id, guild_id):
+                return "User đã có trong server"
+            return await add_member_action(int(guild_id), user_id, access_token)
+
+        operation = BulkOperation(
+            f"Mời {self.target_user.name}", self.selected_guild_ids, summon,
+            label=lambda guild_id: getattr(bot.get_guild(int(guild_id)), 'name', str(guild_id)),
+            concurrency=member_add_engine.concurrency
+        )
+        report = await operation.run(interaction.followup)
+        await report.send(interaction.followup)
 
 # Roster
+class RosterSource:
+    """
+    Danh sách điệp viên theo thứ tự roster, đọc theo trang.
+    Có PostgreSQL: mỗi trang là một truy vấn ORDER BY roster_position LIMIT/OFFSET trên index.
+    Không có: đọc JSONBin một lần rồi cắt trang trong bộ nhớ.
+    """
+    def __init__(self, total, agents=None):
+        self.total = total
+        self._agents = agents  # None => đọc từng trang từ database
+
+    @classmethod
+    async def open(cls):
+        total = await token_store.run(get_roster_count_db)
+        if total:
+            return cls(total)
+        full_data = await token_store.read_jsonbin()
+        agents = order_roster_from_jsonbin(full_data or {})
+        return cls(len(agents), agents)
+
+    @property
+    def from_database(self):
+        return self._agents is None
+
+    async def page(self, offset, limit):
+        if self._agents is not None:
+            return self._agents[offset:offset + limit]
+        return await token_store.run(get_roster_page_db, offset, limit) or []
+
 class RosterPages(discord.ui.View):
-    def __init__(self, agents, ctx):
+    def __init__(self, roster: RosterSource, ctx):
         super().__init__(timeout=180)  # Menu sẽ tự động tắt sau 180 giây
-        self.agents = agents
+        self.roster = roster
         self.ctx = ctx
         self.current_page = 0
         self.items_per_page = 6  # Hiển thị 6 điệp viên mỗi trang
-        self.total_pages = (len(self.agents) + self.items_per_page - 1) // self.items_per_page
+        self.total_pages = (self.roster.total + self.items_per_page - 1) // self.items_per_page
         self.message = None
 
     async def create_page_embed(self, page_num):
         """Tạo Embed và ảnh ghép cho một trang cụ thể."""
-        start_index = page_num * self.items_per_page
-        end_index = start_index + self.items_per_page
-        page_agents = self.agents[start_index:end_index]
+        page_agents = await self.roster.page(page_num * self.items_per_page, self.items_per_page)
 
         if not page_agents:
             return discord.Embed(title="Lỗi", description="Không có dữ liệu cho trang này."), None
 
+        # Đánh dấu điệp viên không còn token (một lần tra cứu cho cả trang)
+        _, missing_ids = await token_store.get_tokens([agent['id'] for agent in page_agents])
+        missing_ids = set(missing_ids)
+
         # --- Logic tạo ảnh ghép cho trang hiện tại (ĐÃ SỬA) ---
         avatar_size = 128
         padding = 10
@@ -548,35 +3514,19 @@ class RosterPages(discord.ui.View):
         discord_file = discord.File(buffer, filename=f"roster_page_{page_num}.png")
         # --- Kết thúc logic tạo ảnh ---
 
-        description_list = [f"👤 **{agent['username']}** `(ID: {agent['id']})`" for agent in page_agents]
-        description_text = "\n".join(description_list)
-
-        embed = discord.Embed(
-            title=f"AGENT ROSTER ({len(self.agents)} Active)",
-            description=description_text,
-            color=discord.Color.dark_grey()
-        )
-        embed.set_image(url=f"attachment://roster_page_{page_num}.png")
-        embed.set_footer(text=f"Trang {self.current_page + 1}/{self.total_pages}")
-        
-        return embed, discord_file
-        
-        buffer = io.BytesIO()
-        canvas.save(buffer, 'PNG')
-        buffer.seek(0)
-        discord_file = discord.File(buffer, filename=f"roster_page_{page_num}.png")
-        # --- Kết thúc logic tạo ảnh ---
-
-        description_list = [f"👤 **{agent['username']}** `(ID: {agent['id']})`" for agent in page_agents]
+        description_list = [
+            f"{'⚠️' if agent['id'] in missing_ids else '👤'} **{agent['username']}** `(ID: {agent['id']})`"
+            for agent in page_agents
+        ]
         description_text = "\n".join(description_list)
 
         embed = discord.Embed(
-            title=f"AGENT ROSTER ({len(self.agents)} Active)",
+            title=f"AGENT ROSTER ({self.roster.total} Active)",
             description=description_text,
             color=discord.Color.dark_grey()
         )
         embed.set_image(url=f"attachment://roster_page_{page_num}.png")
-        embed.set_footer(text=f"Trang {self.current_page + 1}/{self.total_pages}")
+        embed.set_footer(text=f"Trang {self.current_page + 1}/{self.total_pages} • ⚠️ = không có token")
         
         return embed, discord_file
 
@@ -636,13 +3586,16 @@ class RosterPages(discord.ui.View):
         await interaction.response.edit_message(embed=embed, attachments=[file], view=self)
 
 class DeployView(discord.ui.View):
-    def __init__(self, author: discord.User, guilds: list[discord.Guild], agents: list[dict]):
+    def __init__(self, author: discord.User, roster: RosterSource, dry_run: bool = False):
         super().__init__(timeout=600) # Tăng thời gian chờ
         self.author = author
+        self.dry_run = dry_run
         
-        # Chia dữ liệu thành các trang
-        self.guild_pages = [guilds[i:i + 25] for i in range(0, len(guilds), 25)]
-        self.agent_pages = [agents[i:i + 25] for i in range(0, len(agents), 25)]
+        # Chia dữ liệu thành các trang (điệp viên được đọc từng trang từ RosterSource)
+        self.guild_pages = guild_directory.pages()
+        self.roster = roster
+        self.agent_page_count = (roster.total + 24) // 25
+        self.page_agents = []
         
         # Theo dõi trang hiện tại
         self.current_guild_page = 0
@@ -652,7 +3605,10 @@ class DeployView(discord.ui.View):
         self.selected_guild_ids = set()
         self.selected_user_ids = set()
 
-        # Gọi hàm để xây dựng giao diện ban đầu
+    async def load_agent_page(self, page):
+        """Đọc một trang điệp viên rồi dựng lại giao diện."""
+        self.current_agent_page = page
+        self.page_agents = await self.roster.page(page * 25, 25)
         self.update_view()
 
     def update_view(self):
@@ -726,10 +3682,12 @@ class DeployView(discord.ui.View):
             discord.SelectOption(
                 label=str(agent.get('username', agent.get('id'))), 
                 value=str(agent.get('id')),
+                emoji="💀" if token_health.is_dead(agent.get('id')) else None,
+                description="Token đã hỏng - sẽ bị bỏ qua" if token_health.is_dead(agent.get('id')) else None,
                 default=(int(agent.get('id')) in self.selected_user_ids)
-            ) for agent in self.agent_pages[self.current_agent_page]
+            ) for agent in self.page_agents
         ]
-        agent_placeholder = f"Bước 2: Chọn Điệp viên (Trang {self.current_agent_page + 1}/{len(self.agent_pages)})"
+        agent_placeholder = f"Bước 2: Chọn Điệp viên (Trang {self.current_agent_page + 1}/{self.agent_page_count})"
         agent_select = discord.ui.Select(placeholder=agent_placeholder, min_values=0, max_values=len(agent_options), options=agent_options, row=2)
 
         async def agent_callback(interaction: discord.Interaction):
@@ -749,20 +3707,18 @@ class DeployView(discord.ui.View):
         self.add_item(agent_select)
         
         # --- Tạo các nút điều hướng cho Điệp viên ---
-        if len(self.agent_pages) > 1:
+        if self.agent_page_count > 1:
             prev_agent_button = discord.ui.Button(label="◀️ Điệp viên Trước", style=discord.ButtonStyle.secondary, row=3, disabled=(self.current_agent_page == 0))
-            next_agent_button = discord.ui.Button(label="Điệp viên Tiếp ▶️", style=discord.ButtonStyle.secondary, row=3, disabled=(self.current_agent_page >= len(self.agent_pages) - 1))
+            next_agent_button = discord.ui.Button(label="Điệp viên Tiếp ▶️", style=discord.ButtonStyle.secondary, row=3, disabled=(self.current_agent_page >= self.agent_page_count - 1))
 
             async def prev_agent_callback(interaction: discord.Interaction):
                 if interaction.user.id != self.author.id: return
-                self.current_agent_page -= 1
-                self.update_view()
+                await self.load_agent_page(self.current_agent_page - 1)
                 await interaction.response.edit_message(view=self)
 
             async def next_agent_callback(interaction: discord.Interaction):
                 if interaction.user.id != self.author.id: return
-                self.current_agent_page += 1
-                self.update_view()
+                await self.load_agent_page(self.current_agent_page + 1)
                 await interaction.response.edit_message(view=self)
 
             prev_agent_button.callback = prev_agent_callback
@@ -772,189 +3728,75 @@ class DeployView(discord.ui.View):
 
         # --- Nút hành động cuối cùng ---
         # *** THAY ĐỔI 5: Cập nhật label và điều kiện disabled của nút ***
-        button_label = f"Triển Khai ({len(self.selected_user_ids)} agents -> {len(self.selected_guild_ids)} servers)"
+        button_label = f"{'Lập Kế Hoạch' if self.dry_run else 'Triển Khai'} ({len(self.selected_user_ids)} agents -> {len(self.selected_guild_ids)} servers)"
         deploy_button = discord.ui.Button(
             label=button_label, 
-            style=discord.ButtonStyle.danger, 
-            emoji="🚀", 
-            row=4, 
-            disabled=(not self.selected_guild_ids or not self.selected_user_ids)
-        )
-        
-        # *** THAY ĐỔI 6: Cập nhật logic xử lý triển khai cho nhiều server ***
-        async def deploy_callback(interaction: discord.Interaction):
-            if interaction.user.id != self.author.id: return
-            
-            # Vô hiệu hóa view
-            for item in self.children: item.disabled = True
-            await interaction.response.edit_message(view=self)
-            
-            await interaction.followup.send(
-                f"🚀 **Bắt đầu triển khai {len(self.selected_user_ids)} điệp viên tới {len(self.selected_guild_ids)} server...**"
-            )
-            
-            success_count, fail_count, failed_adds = 0, 0, []
-            
-            for guild_id in self.selected_guild_ids:
-                guild = bot.get_guild(guild_id)
-                if not guild:
-                    fail_count += len(self.selected_user_ids)
-                    failed_adds.append(f"Tất cả agents -> Server ID `{guild_id}` (Không tìm thấy hoặc bot không ở trong server)")
-                    continue
-                    
-                for user_id in self.selected_user_ids:
-                    access_token = get_user_access_token(user_id)
-                    if not access_token:
-                        fail_count += 1
-                        failed_adds.append(f"<@{user_id}> -> `{guild.name}` (Không có token)")
-                        continue
-                    
-                    try:
-                        success, message = await add_member_to_guild(guild.id, user_id, access_token)
-                        if success:
-                            success_count += 1
-                        else:
-                            fail_count += 1
-                            failed_adds.append(f"<@{user_id}> -> `{guild.name}` ({message[:50]})")
-                    except Exception as e:
-                        fail_count += 1
-                        failed_adds.append(f"<@{user_id}> -> `{guild.name}` (Lỗi: {e})")
-            
-            embed = discord.Embed(title=f"Báo Cáo Triển Khai Hàng Loạt", color=0x00ff00)
-            embed.add_field(name="✅ Lượt Thêm Thành Công", value=f"{success_count}", inline=True)
-            embed.add_field(name="❌ Lượt Thêm Thất Bại", value=f"{fail_count}", inline=True)
-            
-            if failed_adds:
-                # Giới hạn chi tiết lỗi để không vượt quá giới hạn của Discord Embed
-                error_details = "\n".join(failed_adds)
-                if len(error_details) > 1024:
-                    error_details = error_details[:1020] + "\n..."
-                embed.add_field(name="Chi tiết thất bại", value=error_details, inline=False)
-                
-            await interaction.followup.send(embed=embed)
-
-        deploy_button.callback = deploy_callback
-        self.add_item(deploy_button)
-
-# --- Modal 1: Nhập số lượng kênh ---
-# --- View để chọn số lượng kênh ---
-class QuantityView(discord.ui.View):
-    def __init__(self, selected_guilds: list[discord.Guild], author: discord.User):
-        super().__init__(timeout=300)
-        self.selected_guilds = selected_guilds
-        self.author = author
-
-    @discord.ui.button(label="1 Kênh", style=discord.ButtonStyle.secondary)
-    async def one_channel(self, interaction: discord.Interaction, button: discord.ui.Button):
-        if interaction.user.id != self.author.id:
-            return await interaction.response.send_message("❌ Chỉ người tạo lệnh mới có thể sử dụng!", ephemeral=True)
-        await interaction.response.send_modal(NamesModal(self.selected_guilds, 1))
-
-    @discord.ui.button(label="2 Kênh", style=discord.ButtonStyle.secondary)
-    async def two_channels(self, interaction: discord.Interaction, button: discord.ui.Button):
-        if interaction.user.id != self.author.id:
-            return await interaction.response.send_message("❌ Chỉ người tạo lệnh mới có thể sử dụng!", ephemeral=True)
-        await interaction.response.send_modal(NamesModal(self.selected_guilds, 2))
-
-    @discord.ui.button(label="3 Kênh", style=discord.ButtonStyle.secondary)
-    async def three_channels(self, interaction: discord.Interaction, button: discord.ui.Button):
-        if interaction.user.id != self.author.id:
-            return await interaction.response.send_message("❌ Chỉ người tạo lệnh mới có thể sử dụng!", ephemeral=True)
-        await interaction.response.send_modal(NamesModal(self.selected_guilds, 3))
-
-    @discord.ui.button(label="4 Kênh", style=discord.ButtonStyle.secondary)
-    async def four_channels(self, interaction: discord.Interaction, button: discord.ui.Button):
-        if interaction.user.id != self.author.id:
-            return await interaction.response.send_message("❌ Chỉ người tạo lệnh mới có thể sử dụng!", ephemeral=True)
-        await interaction.response.send_modal(NamesModal(self.selected_guilds, 4))
-
-    @discord.ui.button(label="5 Kênh", style=discord.ButtonStyle.secondary)
-    async def five_channels(self, interaction: discord.Interaction, button: discord.ui.Button):
-        if interaction.user.id != self.author.id:
-            return await interaction.response.send_message("❌ Chỉ người tạo lệnh mới có thể sử dụng!", ephemeral=True)
-        await interaction.response.send_modal(NamesModal(self.selected_guilds, 5))
-
-# --- Modal để nhập tên riêng cho từng kênh ---
-class NamesModal(discord.ui.Modal):
-    def __init__(self, selected_guilds: list[discord.Guild], quantity: int):
-        super().__init__(title=f"Nhập Tên Cho {quantity} Kênh")
-        self.selected_guilds = selected_guilds
-        self.quantity = quantity
-        
-        # Tạo các TextInput fields dựa trên số lượng
-        if quantity >= 1:
-            self.name1 = discord.ui.TextInput(
-                label="Tên Kênh #1",
-                placeholder="Nhập tên cho kênh thứ 1...",
-                required=True
-            )
-            self.add_item(self.name1)
+            style=discord.ButtonStyle.primary if self.dry_run else discord.ButtonStyle.danger, 
+            emoji="🧭" if self.dry_run else "🚀", 
+            row=4, 
+            disabled=(not self.selected_guild_ids or not self.selected_user_ids)
+        )
         
-        if quantity >= 2:
-            self.name2 = discord.ui.TextInput(
-                label="Tên Kênh #2", 
-                placeholder="Nhập tên cho kênh thứ 2...",
-                required=True
-            )
-            self.add_item(self.name2)
-            
-        if quantity >= 3:
-            self.name3 = discord.ui.TextInput(
-                label="Tên Kênh #3",
-                placeholder="Nhập tên cho kênh thứ 3...", 
-                required=True
-            )
-            self.add_item(self.name3)
+        # *** THAY ĐỔI 6: Cập nhật logic xử lý triển khai cho nhiều server ***
+        async def deploy_callback(interaction: discord.Interaction):
+            if interaction.user.id != self.author.id: return
             
-        if quantity >= 4:
-            self.name4 = discord.ui.TextInput(
-                label="Tên Kênh #4",
-                placeholder="Nhập tên cho kênh thứ 4...",
-                required=True
-            )
-            self.add_item(self.name4)
+            # Vô hiệu hóa view
+            for item in self.children: item.disabled = True
+            await interaction.response.edit_message(view=self)
             
-        if quantity >= 5:
-            self.name5 = discord.ui.TextInput(
-                label="Tên Kênh #5",
-                placeholder="Nhập tên cho kênh thứ 5...",
-                required=True
+            # Lập kế hoạch trước: chủ bot thấy số lượt gọi API thật và ETA rồi mới xác nhận
+            plan = await plan_member_adds(self.selected_user_ids, self.selected_guild_ids)
+            if self.dry_run or not plan.items:
+                return await interaction.followup.send(embed=plan.embed(dry_run=self.dry_run))
+            
+            confirm_view = DeployPlanView(self.author)
+            confirm_message = await interaction.followup.send(embed=plan.embed(), view=confirm_view, wait=True)
+            await confirm_view.wait()
+            if not confirm_view.value:
+                reason = "Hết thời gian chờ" if confirm_view.value is None else "Đã hủy"
+                return await confirm_message.edit(content=f"🛑 {reason}, không gửi request nào.", view=None)
+            # Bot có thể đã rời server trong lúc chờ xác nhận
+            if plan.drop_unavailable_guilds() and not plan.items:
+                return await confirm_message.edit(content="🛑 Các server trong kế hoạch không còn khả dụng, không gửi request nào.",
+                                                  embed=plan.embed(), view=None)
+            
+            # Mỗi cặp (điệp viên, server) là một work item của job bền vững: khởi động lại bot
+            # hay interaction hết hạn cũng không làm mất tiến độ, báo cáo được gửi vào kênh này
+            job_id, satisfied = await job_runner.submit(
+                "deploy", plan.items, self.author.id, interaction.channel_id,
+                f"Deploy {len(self.selected_user_ids)} agents -> {len(self.selected_guild_ids)} servers"
             )
-            self.add_item(self.name5)
+            await confirm_message.edit(content=JobRunner.describe_submission(job_id, satisfied), view=None)
 
-    async def on_submit(self, interaction: discord.Interaction):
-        # Lấy tên từ các ô nhập liệu dựa trên số lượng
-        channel_names = []
-        
-        if hasattr(self, 'name1'):
-            channel_names.append(self.name1.value)
-        if hasattr(self, 'name2'):
-            channel_names.append(self.name2.value)
-        if hasattr(self, 'name3'):
-            channel_names.append(self.name3.value)
-        if hasattr(self, 'name4'):
-            channel_names.append(self.name4.value)
-        if hasattr(self, 'name5'):
-            channel_names.append(self.name5.value)
-        
-        await interaction.response.send_message(f"✅ **Đã nhận lệnh!** Chuẩn bị tạo **{len(channel_names)}** kênh trong **{len(self.selected_guilds)}** server...", ephemeral=True)
+        deploy_button.callback = deploy_callback
+        self.add_item(deploy_button)
 
-        total_success = 0
-        total_fail = 0
-        
-        for guild in self.selected_guilds:
-            for name in channel_names:
-                try:
-                    await guild.create_text_channel(name=name)
-                    total_success += 1
-                except discord.Forbidden:
-                    total_fail += 1
-                    print(f"Lỗi quyền: Không thể tạo kênh '{name}' trong server {guild.name}")
-                except Exception as e:
-                    total_fail += 1
-                    print(f"Lỗi không xác định khi tạo kênh '{name}': {e}")
-        
-        await interaction.followup.send(f"**Báo cáo hoàn tất:**\n✅ Đã tạo thành công: **{total_success}** kênh.\n❌ Thất bại: **{total_fail}** kênh.")
+class DeployPlanView(discord.ui.View):
+    """Xác nhận hoặc hủy một kế hoạch (DeployPlan, bố cục kênh)."""
+    def __init__(self, author: discord.User, confirm_label: str = None):
+        super().__init__(timeout=120)
+        self.author = author
+        self.value = None
+        if confirm_label:
+            self.confirm.label = confirm_label
+
+    async def _decide(self, interaction: discord.Interaction, value: bool):
+        if interaction.user.id != self.author.id:
+            return await interaction.response.send_message("Bạn không có quyền thực hiện hành động này.", ephemeral=True)
+        self.value = value
+        self.stop()
+        for item in self.children:
+            item.disabled = True
+        await interaction.response.edit_message(view=self)
+
+    @discord.ui.button(label="Xác Nhận Triển Khai", style=discord.ButtonStyle.danger, emoji="🚀")
+    async def confirm(self, interaction: discord.Interaction, button: discord.ui.Button):
+        await self._decide(interaction, True)
+
+    @discord.ui.button(label="Hủy", style=discord.ButtonStyle.secondary)
+    async def cancel(self, interaction: discord.Interaction, button: discord.ui.Button):
+        await self._decide(interaction, False)
 
 # --- View để chọn số lượng kênh ---
 class QuantityView(discord.ui.View):
@@ -1058,32 +3900,40 @@ class NamesModal(discord.ui.Modal):
         
         await interaction.response.send_message(f"✅ **Đã nhận lệnh!** Chuẩn bị tạo **{len(channel_names)}** kênh trong **{len(self.selected_guilds)}** server...", ephemeral=True)
 
-        total_success = 0
-        total_fail = 0
-        
-        for guild in self.selected_guilds:
-            for name in channel_names:
-                try:
-                    await guild.create_text_channel(name=name)
-                    total_success += 1
-                except discord.Forbidden:
-                    total_fail += 1
-                    print(f"Lỗi quyền: Không thể tạo kênh '{name}' trong server {guild.name}")
-                except Exception as e:
-                    total_fail += 1
-                    print(f"Lỗi không xác định khi tạo kênh '{name}': {e}")
-        
-        await interaction.followup.send(f"**Báo cáo hoàn tất:**\n✅ Đã tạo thành công: **{total_success}** kênh.\n❌ Thất bại: **{total_fail}** kênh.")
+        forbidden_guilds = set()
+
+        async def create(target):
+            guild, name = target
+            if channel_index.exists(name, guild.id):
+                raise BulkSkip("Kênh đã tồn tại")
+            # Đã bị 403 trong server này thì các kênh còn lại cũng sẽ thất bại: không gọi API nữa
+            if guild.id in forbidden_guilds:
+                raise BulkFailure("Bot không có quyền `Manage Channels`.")
+            try:
+                channel = await guild.create_text_channel(name=name)
+            except discord.Forbidden:
+                forbidden_guilds.add(guild.id)
+                raise BulkFailure("Bot không có quyền `Manage Channels`.")
+            return f"Đã tạo #{channel.name} ({channel.id})"
+
+        # Các server chạy song song; trong mỗi server các kênh được tạo tuần tự theo đúng thứ tự nhập
+        # (POST /guilds/{id}/channels là bucket rate limit riêng của từng server, discord.py tự chờ khi gặp 429)
+        operation = BulkOperation(
+            "Tạo kênh", [(guild, name) for guild in self.selected_guilds for name in channel_names], create,
+            label=lambda target: f"{target[0].name} / #{target[1]}",
+            group=lambda target: target[0].id, ordered_groups=True, concurrency=CHANNEL_CREATE_CONCURRENCY
+        )
+        report = await operation.run(interaction.followup)
+        await report.send(interaction.followup)
 
 # --- View để chọn server và bắt đầu quy trình (PHIÊN BẢN NÂNG CẤP) ---
 class CreateChannelView(discord.ui.View):
-    def __init__(self, author: discord.User, guilds: list[discord.Guild]):
+    def __init__(self, author: discord.User):
         super().__init__(timeout=600)
         self.author = author
-        self.all_guilds = guilds
         
-        # Chia danh sách server thành các trang, mỗi trang 25 server
-        self.guild_pages = [self.all_guilds[i:i + 25] for i in range(0, len(self.all_guilds), 25)]
+        # Các trang 25 server lấy sẵn từ guild_directory
+        self.guild_pages = guild_directory.pages()
         
         # Theo dõi trạng thái
         self.current_guild_page = 0
@@ -1181,7 +4031,7 @@ class CreateChannelView(discord.ui.View):
             await interaction.message.edit(view=self)
 
             # Lấy các đối tượng guild từ các ID đã chọn
-            selected_guilds = [g for g in self.all_guilds if g.id in self.selected_guild_ids]
+            selected_guilds = guild_directory.select(self.selected_guild_ids)
 
             embed = discord.Embed(
                 title="🔢 Chọn Số Lượng Kênh",
@@ -1201,18 +4051,73 @@ class CreateChannelView(discord.ui.View):
 @commands.is_owner()
 async def create(ctx):
     """Mở giao diện tạo kênh hàng loạt."""
-    # Sắp xếp server giống như lệnh deploy để có thứ tự nhất quán
-    sorted_guilds = sorted(bot.guilds, key=lambda g: g.me.joined_at)
-    
-    view = CreateChannelView(ctx.author, sorted_guilds)
+    view = CreateChannelView(ctx.author)
     
     embed = discord.Embed(
         title="🛠️ Bảng Điều Khiển Tạo Kênh",
-        description="Sử dụng các công cụ bên dưới để tạo kênh hàng loạt.",
+        description="Sử dụng các công cụ bên dưới để tạo kênh hàng loạt.\n"
+                    "Cần nhiều hơn 5 kênh, danh mục hoặc chủ đề? Đính kèm file bố cục YAML/JSON với `!layout`.",
         color=discord.Color.blue()
     )
     await ctx.send(embed=embed, view=view)
 
+@bot.command(name='layout', help='(Chủ bot) Áp dụng bố cục kênh từ file YAML/JSON đính kèm lên các server.')
+@commands.is_owner()
+async def layout(ctx, *flags: str):
+    """
+    So sánh bố cục khai báo trong file đính kèm với kênh hiện có của từng server và chỉ thực hiện
+    các thao tác còn thiếu/khác (song song giữa các server, tuần tự trong một server).
+    Chạy lại cùng file khi mọi thứ đã khớp sẽ không gọi API nào. --dry-run chỉ hiển thị kế hoạch.
+    Cách dùng: !layout [--dry-run] (kèm file .yaml/.yml/.json)
+    """
+    if not ctx.message.attachments:
+        return await ctx.send("❌ Vui lòng đính kèm file bố cục `.yaml`/`.json`. Xem README để biết định dạng.")
+    attachment = ctx.message.attachments[0]
+    if attachment.size > LAYOUT_MAX_FILE_SIZE:
+        return await ctx.send(f"❌ File bố cục quá lớn (tối đa {LAYOUT_MAX_FILE_SIZE // 1024}KB).")
+    try:
+        spec = parse_layout((await attachment.read()).decode('utf-8'), attachment.filename)
+    except (ValueError, UnicodeDecodeError) as e:
+        return await ctx.send(f"❌ {e}")
+
+    if spec['guilds'] == ALL_GUILDS:
+        guilds, unresolved = guild_directory.ordered(), []
+    else:
+        guilds, unresolved = [], []
+        for value in spec['guilds']:
+            guild = guild_directory.resolve(value)
+            if guild and guild not in guilds:
+                guilds.append(guild)
+            elif not guild:
+                unresolved.append(value)
+
+    plans = {guild: plan_layout(spec, guild) for guild in guilds}
+    dry_run = "--dry-run" in flags
+    embed = layout_plan_embed(plans, unresolved, dry_run)
+    if spec['guilds'] == ALL_GUILDS:
+        embed.add_field(name="🎯 Phạm vi", value=f"`guilds: all` - mọi server bot đang ở ({len(guilds)})", inline=False)
+    # Mỗi server dùng chung một LayoutApplier để nhớ các danh mục/kênh vừa tạo
+    appliers = {guild.id: LayoutApplier(guild, spec) for guild, ops in plans.items() if ops}
+    targets = [(appliers[guild.id], op) for guild, ops in plans.items() for op in ops]
+    if dry_run or not targets:
+        if not targets:
+            embed.set_footer(text="✅ Mọi server đã khớp bố cục, không cần gọi API nào.")
+        return await ctx.send(embed=embed)
+
+    view = DeployPlanView(ctx.author, confirm_label="Áp Dụng Bố Cục")
+    message = await ctx.send(embed=embed, view=view)
+    await view.wait()
+    if not view.value:
+        return await message.edit(content="Đã hủy áp dụng bố cục.", view=None)
+
+    operation = BulkOperation(
+        "Áp dụng bố cục", targets, lambda target: target[0].apply(target[1]),
+        label=lambda target: f"{target[0].guild.name} / {LAYOUT_OP_NAMES[target[1].kind]} {target[1].name or ''}".rstrip(),
+        group=lambda target: target[0].guild.id, ordered_groups=True, concurrency=CHANNEL_CREATE_CONCURRENCY
+    )
+    report = await operation.run(ctx)
+    await report.send(ctx, f"Đã áp dụng bố cục lên **{len(appliers)}** server.")
+
 # --- Getid ---
 class ChannelNameModal(discord.ui.Modal, title="Nhập Tên Kênh Cần Tìm"):
     def __init__(self, selected_guilds: list[discord.Guild]):
@@ -1221,24 +4126,26 @@ class ChannelNameModal(discord.ui.Modal, title="Nhập Tên Kênh Cần Tìm"):
 
     channel_name = discord.ui.TextInput(
         label="Tên kênh bạn muốn tìm ID",
-        placeholder="Nhập chính xác tên kênh, không bao gồm dấu #",
+        placeholder="Nhập tên kênh, không bao gồm dấu # (không phân biệt hoa thường, dấu)",
         required=True
     )
 
     async def on_submit(self, interaction: discord.Interaction):
         await interaction.response.send_message(f"🔎 Đang tìm kiếm các kênh có tên `{self.channel_name.value}`...", ephemeral=True)
         
-        results = {}
-        target_name = self.channel_name.value.lower().strip()
-
-        for guild in self.selected_guilds:
-            found_channels = []
-            for channel in guild.text_channels:
-                if channel.name.lower() == target_name:
-                    found_channels.append(channel.id)
-            
-            if found_channels:
-                results[guild.name] = found_channels
+        # Tra chỉ mục tên kênh thay vì duyệt text_channels của từng server;
+        # không có kênh trùng tên thì hiển thị các kênh có tên gần giống (tiền tố/trigram)
+        guild_ids = {guild.id for guild in self.selected_guilds}
+        pairs = channel_index.lookup(self.channel_name.value, guild_ids)
+        approximate = not pairs
+        if approximate:
+            pairs = [pair for _, matched in channel_index.search(self.channel_name.value, guild_ids) for pair in matched]
+
+        results = defaultdict(list)
+        for guild_id, channel_id in pairs:
+            channel = bot.get_channel(channel_id)
+            if channel:
+                results[guild_id].append(f"#{channel.name}: `{channel_id}`" if approximate else f"`{channel_id}`")
 
         # Tạo Embed kết quả
         if not results:
@@ -1250,23 +4157,26 @@ class ChannelNameModal(discord.ui.Modal, title="Nhập Tên Kênh Cần Tìm"):
         else:
             embed = discord.Embed(
                 title=f"Kết Quả Tìm Kiếm cho Kênh '{self.channel_name.value}'",
-                color=discord.Color.green()
+                description="Không có kênh trùng tên, dưới đây là các kênh có tên gần giống." if approximate else None,
+                color=discord.Color.gold() if approximate else discord.Color.green()
             )
-            for guild_name, channel_ids in results.items():
-                id_string = "\n".join([f"`{channel_id}`" for channel_id in channel_ids])
-                embed.add_field(name=f"🖥️ Server: {guild_name}", value=id_string, inline=False)
+            matched_guilds = [guild for guild in self.selected_guilds if guild.id in results]
+            # Embed tối đa 25 field
+            for guild in matched_guilds[:25]:
+                embed.add_field(name=f"🖥️ Server: {guild.name}", value=truncate_field(results[guild.id]), inline=False)
+            if len(matched_guilds) > 25:
+                embed.set_footer(text=f"... và {len(matched_guilds) - 25} server khác")
         
         await interaction.followup.send(embed=embed)
         
 # --- View để lấy ID kênh (PHIÊN BẢN NÂNG CẤP VỚI PHÂN TRANG) ---
 class GetIdPaginatedView(discord.ui.View):
-    def __init__(self, author: discord.User, guilds: list[discord.Guild]):
+    def __init__(self, author: discord.User):
         super().__init__(timeout=600)
         self.author = author
-        self.all_guilds = guilds
         
-        # Chia danh sách server thành các trang, mỗi trang 25 server
-        self.guild_pages = [self.all_guilds[i:i + 25] for i in range(0, len(self.all_guilds), 25)]
+        # Các trang 25 server lấy sẵn từ guild_directory
+        self.guild_pages = guild_directory.pages()
         
         # Theo dõi trạng thái
         self.current_page = 0
@@ -1354,7 +4264,7 @@ class GetIdPaginatedView(discord.ui.View):
             if interaction.user.id != self.author.id: return
             
             # Lấy các đối tượng guild từ các ID đã chọn
-            selected_guilds = [g for g in self.all_guilds if g.id in self.selected_guild_ids]
+            selected_guilds = guild_directory.select(self.selected_guild_ids)
             
             # Mở Modal để người dùng nhập tên kênh
             modal = ChannelNameModal(selected_guilds)
@@ -1371,7 +4281,21 @@ async def on_ready():
     print(f'🔑 Redirect URI: {REDIRECT_URI}')
     
     # Check storage status
-    db_status = "Connected" if get_db_connection() else "Unavailable"
+    loop_lag_monitor.start()
+    for entry in await token_store.run(read_refresh_schedule):
+        token_refresher.schedule(*entry)
+    token_refresher.start()
+    print(f"🔄 Token refresh: {token_refresher.stats()['scheduled']} tokens scheduled")
+    token_health.load(await token_store.run(read_token_health))
+    token_health.start()
+    guild_directory.build(bot.guilds)
+    channel_index.build(bot.guilds)
+    membership_index.build(await token_store.run(read_agent_ids), bot.guilds)
+    print(f"🧮 Membership index: {membership_index.coverage()['agents']} agents × {len(bot.guilds)} servers")
+    resumed = await job_runner.resume_all()
+    if resumed:
+        print(f"📋 Đã tiếp tục {resumed} job đang chạy dở")
+    db_status = "Connected" if await token_store.is_database_available() else "Unavailable"
     jsonbin_status = "Connected" if JSONBIN_API_KEY else "Not configured"
     print(f'💾 Database: {db_status}')
     print(f'🌐 JSONBin.io: {jsonbin_status}')
@@ -1392,6 +4316,44 @@ async def on_message(message):
     # Xử lý các lệnh !command
     await bot.process_commands(message)
 
+@bot.event
+async def on_member_join(member):
+    membership_index.set_member(member.guild.id, member.id, True)
+
+@bot.event
+async def on_member_remove(member):
+    membership_index.set_member(member.guild.id, member.id, False)
+
+@bot.event
+async def on_guild_join(guild):
+    guild_directory.add(guild)
+    channel_index.add_guild(guild)
+    membership_index.add_guild(guild)
+
+@bot.event
+async def on_guild_remove(guild):
+    guild_directory.remove(guild.id)
+    channel_index.remove_guild(guild.id)
+    membership_index.remove_guild(guild.id)
+
+@bot.event
+async def on_guild_update(before, after):
+    if before.name != after.name:
+        guild_directory.rename(after)
+
+@bot.event
+async def on_guild_channel_create(channel):
+    channel_index.add_channel(channel)
+
+@bot.event
+async def on_guild_channel_delete(channel):
+    channel_index.remove_channel(channel.id)
+
+@bot.event
+async def on_guild_channel_update(before, after):
+    if before.name != after.name:
+        channel_index.add_channel(after)
+
 @bot.event
 async def on_message_edit(before, after):
     """Xử lý khi tin nhắn được CHỈNH SỬA."""
@@ -1424,7 +4386,7 @@ async def add_me(ctx):
     user_id = ctx.author.id
     await ctx.send(f"✅ Bắt đầu quá trình thêm {ctx.author.mention} vào các server...")
     
-    access_token = get_user_access_token(user_id)
+    access_token = await token_store.get_token(user_id)
     if not access_token:
         embed = discord.Embed(
             title="❌ Chưa ủy quyền",
@@ -1434,39 +4396,17 @@ async def add_me(ctx):
         await ctx.send(embed=embed)
         return
     
-    success_count = 0
-    fail_count = 0
-    
-    for guild in bot.guilds:
-        try:
-            member = guild.get_member(user_id)
-            if member:
-                print(f"👍 {ctx.author.name} đã có trong server {guild.name}")
-                success_count += 1
-                continue
-            
-            success, message = await add_member_to_guild(guild.id, user_id, access_token)
-            
-            if success:
-                print(f"👍 Thêm thành công {ctx.author.name} vào server {guild.name}: {message}")
-                success_count += 1
-            else:
-                print(f"👎 Lỗi khi thêm vào {guild.name}: {message}")
-                fail_count += 1
-                
-        except Exception as e:
-            print(f"👎 Lỗi không xác định khi thêm vào {guild.name}: {e}")
-            fail_count += 1
-    
-    embed = discord.Embed(title="📊 Kết quả", color=0x00ff00)
-    embed.add_field(name="✅ Thành công", value=f"{success_count} server", inline=True)
-    embed.add_field(name="❌ Thất bại", value=f"{fail_count} server", inline=True)
-    await ctx.send(embed=embed)
+    membership_index.add_agent(user_id, bot.guilds)
+    job_id, satisfied = await job_runner.submit(
+        "add_me", [(user_id, guild.id) for guild in bot.guilds], ctx.author.id, ctx.channel.id,
+        f"add_me {ctx.author.name}"
+    )
+    await ctx.send(JobRunner.describe_submission(job_id, satisfied))
 
 @bot.command(name='check_token', help='Kiểm tra xem bạn đã ủy quyền chưa.')
 async def check_token(ctx):
     user_id = ctx.author.id
-    token = get_user_access_token(user_id)
+    token = await token_store.get_token(user_id)
     
     if token:
         embed = discord.Embed(
@@ -1487,10 +4427,7 @@ async def check_token(ctx):
 @bot.command(name='status', help='Kiểm tra trạng thái bot và storage.')
 async def status(ctx):
     # Test database connection
-    db_connection = get_db_connection()
-    db_status = "✅ Connected" if db_connection else "❌ Unavailable"
-    if db_connection:
-        db_connection.close()
+    db_status = "✅ Connected" if await token_store.is_database_available() else "❌ Unavailable"
     
     # Test JSONBin connection
     jsonbin_status = "✅ Configured" if JSONBIN_API_KEY else "❌ Not configured"
@@ -1500,6 +4437,8 @@ async def status(ctx):
     embed.add_field(name="👥 Người dùng", value=f"{len(bot.users)} user", inline=True)
     embed.add_field(name="💾 Database", value=db_status, inline=True)
     embed.add_field(name="🌐 JSONBin.io", value=jsonbin_status, inline=True)
+    lag = loop_lag_monitor.stats()
+    embed.add_field(name="⏱️ Event Loop Lag", value=f"{lag['last_ms']}ms (max {lag['max_ms']}ms)", inline=True)
     embed.add_field(name="🌍 Web Server", value=f"[Truy cập]({RENDER_URL})", inline=False)
     await ctx.send(embed=embed)
     
@@ -1513,7 +4452,7 @@ async def force_add(ctx, user_to_add: discord.User):
     user_id = user_to_add.id
     await ctx.send(f"✅ Đã nhận lệnh! Bắt đầu quá trình thêm {user_to_add.mention} vào các server...")
     
-    access_token = get_user_access_token(user_id)
+    access_token = await token_store.get_token(user_id)
     if not access_token:
         embed = discord.Embed(
             title="❌ Người dùng chưa ủy quyền",
@@ -1523,34 +4462,12 @@ async def force_add(ctx, user_to_add: discord.User):
         await ctx.send(embed=embed)
         return
     
-    success_count = 0
-    fail_count = 0
-    
-    for guild in bot.guilds:
-        try:
-            member = guild.get_member(user_id)
-            if member:
-                print(f"👍 {user_to_add.name} đã có trong server {guild.name}")
-                success_count += 1
-                continue
-            
-            success, message = await add_member_to_guild(guild.id, user_id, access_token)
-            
-            if success:
-                print(f"👍 Thêm thành công {user_to_add.name} vào server {guild.name}: {message}")
-                success_count += 1
-            else:
-                print(f"👎 Lỗi khi thêm vào {guild.name}: {message}")
-                fail_count += 1
-                
-        except Exception as e:
-            print(f"👎 Lỗi không xác định khi thêm vào {guild.name}: {e}")
-            fail_count += 1
-    
-    embed = discord.Embed(title=f"📊 Kết quả thêm {user_to_add.name}", color=0x00ff00)
-    embed.add_field(name="✅ Thành công", value=f"{success_count} server", inline=True)
-    embed.add_field(name="❌ Thất bại", value=f"{fail_count} server", inline=True)
-    await ctx.send(embed=embed)
+    membership_index.add_agent(user_id, bot.guilds)
+    job_id, satisfied = await job_runner.submit(
+        "force_add", [(user_id, guild.id) for guild in bot.guilds], ctx.author.id, ctx.channel.id,
+        f"force_add {user_to_add.name}"
+    )
+    await ctx.send(JobRunner.describe_submission(job_id, satisfied))
 
 @force_add.error
 async def force_add_error(ctx, error):
@@ -1573,7 +4490,7 @@ async def invite(ctx, user_to_add: discord.User):
         return
         
     # Tạo giao diện (View) và truyền các thông tin cần thiết
-    view = ServerSelectView(author=ctx.author, target_user=user_to_add, guilds=bot.guilds)
+    view = ServerSelectView(author=ctx.author, target_user=user_to_add)
     
     embed = discord.Embed(
         title=f"💌 Mời {user_to_add.name}",
@@ -1585,6 +4502,27 @@ async def invite(ctx, user_to_add: discord.User):
     await ctx.send(embed=embed, view=view)
 
 # --- SLASH COMMANDS ---
+@bot.tree.command(name="invite", description="(Chủ bot) Mời một điệp viên vào một server, gõ vài chữ để tìm server")
+@app_commands.describe(user="Điệp viên cần mời", server="Tên hoặc ID server")
+@app_commands.autocomplete(server=guild_autocomplete)
+async def invite_slash(interaction: discord.Interaction, user: discord.User, server: str):
+    if not await bot.is_owner(interaction.user):
+        return await interaction.response.send_message("🚫 Lệnh này chỉ dành cho chủ sở hữu bot!", ephemeral=True)
+    guild = guild_directory.resolve(server)
+    if not guild:
+        return await interaction.response.send_message(
+            f"❌ Không tìm thấy server `{server}` (cần đúng ID hoặc tên, hãy chọn từ gợi ý).", ephemeral=True
+        )
+    await interaction.response.defer(ephemeral=True)
+    if not await token_store.get_token(user.id):
+        return await interaction.followup.send(f"❌ Người dùng **{user.name}** chưa ủy quyền cho bot.", ephemeral=True)
+
+    membership_index.add_agent(user.id, bot.guilds)
+    job_id, satisfied = await job_runner.submit(
+        "invite", [(user.id, guild.id)], interaction.user.id, interaction.channel_id, f"invite {user.name} -> {guild.name}"
+    )
+    await interaction.followup.send(JobRunner.describe_submission(job_id, satisfied), ephemeral=True)
+
 @bot.tree.command(name="help", description="Hiển thị thông tin về các lệnh của bot")
 async def help_slash(interaction: discord.Interaction):
     embed = discord.Embed(
@@ -1608,6 +4546,7 @@ async def help_slash(interaction: discord.Interaction):
         embed.add_field(name="`!roster`", value="Xem danh sách điệp viên.", inline=True)
         embed.add_field(name="`!deploy`", value="Thêm NHIỀU điệp viên vào MỘT server.", inline=True)
         embed.add_field(name="`!invite <User>`", value="Thêm MỘT điệp viên vào NHIỀU server.", inline=True)
+        embed.add_field(name="`/invite <User> <Server>`", value="Gõ vài chữ để tìm server thay vì lật trang.", inline=True)
         embed.add_field(name="`!remove <User>`", value="Xóa dữ liệu của một điệp viên.", inline=True)
         embed.add_field(name="`!force_add <User>`", value="Ép thêm điệp viên vào TẤT CẢ server.", inline=True)
         embed.add_field(name="`!storage_info`", value="Xem thông tin các hệ thống lưu trữ.", inline=True)
@@ -1638,6 +4577,7 @@ async def help(ctx):
         embed.add_field(name="`!roster`", value="Xem danh sách điệp viên.", inline=True)
         embed.add_field(name="`!deploy`", value="Thêm NHIỀU điệp viên vào MỘT server.", inline=True)
         embed.add_field(name="`!invite <User>`", value="Thêm MỘT điệp viên vào NHIỀU server.", inline=True)
+        embed.add_field(name="`/invite <User> <Server>`", value="Gõ vài chữ để tìm server thay vì lật trang.", inline=True)
         embed.add_field(name="`!remove <User>`", value="Xóa dữ liệu của một điệp viên.", inline=True)
         embed.add_field(name="`!force_add <User>`", value="Ép thêm điệp viên vào TẤT CẢ server.", inline=True)
         embed.add_field(name="`!storage_info`", value="Xem thông tin các hệ thống lưu trữ.", inline=True)
@@ -1652,30 +4592,19 @@ async def storage_info(ctx):
     """Hiển thị thông tin chi tiết về các storage systems"""
     
     # Test Database
-    db_connection = get_db_connection()
-    if db_connection:
-        try:
-            cursor = db_connection.cursor()
-            cursor.execute("SELECT COUNT(*) FROM user_tokens")
-            db_count = cursor.fetchone()[0]
-            cursor.close()
-            db_connection.close()
-            db_info = f"✅ Connected ({db_count} tokens)"
-        except:
-            db_info = "❌ Connection Error"
-    else:
-        db_info = "❌ Not Available"
+    db_info = await token_store.run(describe_database)
     
     # Test JSONBin
     if JSONBIN_API_KEY and JSONBIN_BIN_ID:
         try:
-            data = jsonbin_storage.read_data()
+            data = await token_store.read_jsonbin()
             jsonbin_count = len(data) if isinstance(data, dict) else 0
             jsonbin_info = f"✅ Connected ({jsonbin_count} tokens)"
         except:
             jsonbin_info = "❌ Connection Error"
     else:
         jsonbin_info = "❌ Not Configured"
+    jsonbin_info += f"\nWrite-behind: {jsonbin_storage.pending_count()} pending, {jsonbin_storage.flush_count} flushes"
     
     embed = discord.Embed(title="💾 Storage Systems Info", color=0x0099ff)
     embed.add_field(name="🗃️ PostgreSQL Database", value=db_info, inline=False)
@@ -1683,18 +4612,73 @@ async def storage_info(ctx):
     
     if JSONBIN_BIN_ID:
         embed.add_field(name="📋 JSONBin Bin ID", value=f"`{JSONBIN_BIN_ID}`", inline=False)
+        layout = jsonbin_storage.layout
+        payload = jsonbin_storage.payload_stats()
+        layout_info = f"Sharded ({len(layout['shards'])} shards)" if layout else "Legacy (single bin)"
+        layout_info += f"\nAvg payload: read {payload['read']['avg_bytes']} B ({payload['read']['ops']} ops), write {payload['write']['avg_bytes']} B ({payload['write']['ops']} ops)"
+        embed.add_field(name="🗂️ JSONBin Layout", value=layout_info, inline=False)
+    
+    cache_stats = token_cache.stats()
+    embed.add_field(
+        name="⚡ Token Cache",
+        value=f"{cache_stats['size']} tokens | hit rate {cache_stats['hit_rate']}% ({cache_stats['hits']}/{cache_stats['hits'] + cache_stats['misses']})\n"
+              f"Chưa ủy quyền: {cache_stats['negatives']} user được nhớ, {cache_stats['negative_hits']} lượt tra bỏ qua storage",
+        inline=False
+    )
+    
+    breaker_lines = []
+    for name, breaker in storage_breakers.items():
+        state = breaker.state()
+        if state['state'] == 'open':
+            breaker_lines.append(f"⛔ `{name}` ngắt {state['open_for']:.0f}s ({state['probes']} probes)")
+        else:
+            breaker_lines.append(f"✅ `{name}` hoạt động ({state['total_failures']} lỗi, {state['trips']} lần ngắt)")
+    embed.add_field(name="🛡️ Circuit Breakers", value="\n".join(breaker_lines), inline=False)
     
-    embed.add_field(name="ℹ️ Hierarchy", value="Database → JSONBin.io → Local JSON", inline=False)
+    refresh_stats = token_refresher.stats()
+    next_due = refresh_stats['next_due_in']
+    embed.add_field(
+        name="🔄 Token Refresh",
+        value=f"{refresh_stats['scheduled']} scheduled | next in {f'{max(next_due, 0) // 60} min' if next_due is not None else 'N/A'}\n"
+              f"✅ {refresh_stats['refreshed']} refreshed, ❌ {refresh_stats['failed']} failed, ⚠️ {refresh_stats['revoked']} revoked",
+        inline=False
+    )
+    health_stats = token_health.stats()
+    embed.add_field(
+        name="🩺 Token Health",
+        value=f"✅ {health_stats['valid']} valid, ⏳ {health_stats['expired']} chờ làm mới, 💀 {health_stats['invalid']} invalid | {health_stats['checks']} checks",
+        inline=False
+    )
+    embed.add_field(name="ℹ️ Hierarchy", value="Cache → Database → JSONBin.io → Local SQLite", inline=False)
     
     await ctx.send(embed=embed)
 
+MIGRATION_CHUNK_SIZE = int(os.getenv('MIGRATION_CHUNK_SIZE', 500))
+MIGRATION_TIERS = ("db", "jsonbin", "local")
+
+def iter_token_chunks(source, chunk_size=MIGRATION_CHUNK_SIZE):
+    """Đọc tầng nguồn theo từng lô [(user_id, data)], bỏ qua các khóa không phải user."""
+    if source == "db":
+        yield from iter_token_chunks_db(chunk_size)
+    elif source == "local":
+        yield from local_store.iter_chunks(chunk_size)
+    elif source == "jsonbin":
+        chunk = []
+        for record in jsonbin_storage.iter_user_records():
+            chunk.append(record)
+            if len(chunk) >= chunk_size:
+                yield chunk
+                chunk = []
+        if chunk:
+            yield chunk
+
 @bot.command(name='migrate_tokens', help='(Chủ bot) Migrate tokens between storage systems.')
 @commands.is_owner()
-async def migrate_tokens(ctx, source: str = None, target: str = None):
+async def migrate_tokens(ctx, source: str = None, target: str = None, *flags: str):
     """
     Migrate tokens between storage systems
-    Usage: !migrate_tokens <source> <target>
-    Sources/Targets: db, jsonbin, json
+    Usage: !migrate_tokens <source> <target> [--dry-run]
+    Sources/Targets: db, jsonbin, local (json = alias của local)
     """
     
     if not source or not target:
@@ -1705,89 +4689,143 @@ async def migrate_tokens(ctx, source: str = None, target: str = None):
         )
         embed.add_field(
             name="Usage", 
-            value="`!migrate_tokens <source> <target>`\n\nValid options:\n• `db` - PostgreSQL Database\n• `jsonbin` - JSONBin.io\n• `json` - Local JSON file", 
+            value="`!migrate_tokens <source> <target> [--dry-run]`\n\nValid options:\n• `db` - PostgreSQL Database\n• `jsonbin` - JSONBin.io\n• `local` - Local SQLite store (`json` vẫn được chấp nhận)", 
             inline=False
         )
         embed.add_field(
             name="Examples", 
-            value="`!migrate_tokens json jsonbin`\n`!migrate_tokens db jsonbin`", 
+            value="`!migrate_tokens local jsonbin`\n`!migrate_tokens db jsonbin --dry-run`", 
             inline=False
         )
         await ctx.send(embed=embed)
         return
     
-    await ctx.send(f"🔄 Starting migration from {source} to {target}...")
+    # Kho JSON cũ đã được thay bằng SQLite, giữ 'json' làm bí danh
+    source = "local" if source == "json" else source
+    target = "local" if target == "json" else target
+    dry_run = "--dry-run" in flags
     
-    # Get source data
-    source_data = {}
-    if source == "db":
-        conn = get_db_connection()
-        if conn:
+    if source not in MIGRATION_TIERS or target not in MIGRATION_TIERS or source == target:
+        await ctx.send(f"❌ Invalid migration `{source}` → `{target}`. Valid options: {', '.join(MIGRATION_TIERS)}")
+        return
+    
+    target_lookups = {
+        "db": get_user_access_tokens_db,
+        "jsonbin": jsonbin_storage.get_user_tokens,
+        "local": get_user_access_tokens_local,
+    }
+    bulk_writers = {
+        "db": save_user_tokens_db,
+        "jsonbin": jsonbin_storage.save_user_tokens,
+        "local": save_user_tokens_local,
+    }
+    
+    mode = " (dry run)" if dry_run else ""
+    progress_msg = await ctx.send(f"🔄 Starting migration from {source} to {target}{mode}...")
+    
+    counts = {"total": 0, "new": 0, "updated": 0, "unchanged": 0, "written": 0, "failed": 0}
+    started_at = time.monotonic()
+    last_edit = started_at
+    chunks = iter_token_chunks(source)
+    try:
+        while True:
             try:
-                cursor = conn.cursor()
-                cursor.execute("SELECT user_id, access_token, username FROM user_tokens")
-                rows = cursor.fetchall()
-                for row in rows:
-                    source_data[row[0]] = {
-                        'access_token': row[1],
-                        'username': row[2],
-                        'updated_at': str(time.time())
-                    }
-                cursor.close()
-                conn.close()
+                chunk = await token_store.run(next, chunks, None)
             except Exception as e:
-                await ctx.send(f"❌ Database read error: {e}")
+                await ctx.send(f"❌ {source} read error: {e}")
                 return
-    elif source == "jsonbin":
-        try:
-            source_data = jsonbin_storage.read_data()
-        except Exception as e:
-            await ctx.send(f"❌ JSONBin read error: {e}")
-            return
-    elif source == "json":
-        try:
-            with open('tokens.json', 'r') as f:
-                source_data = json.load(f)
-        except Exception as e:
-            await ctx.send(f"❌ JSON file read error: {e}")
-            return
+            if chunk is None:
+                break
+            
+            # Một lần tra cứu đích cho cả lô để lập diff mới/cập nhật/không đổi
+            records = [(uid, data if isinstance(data, dict) else {'access_token': data}) for uid, data in chunk]
+            records = [(uid, data) for uid, data in records if data.get('access_token')]
+            existing_tokens = await token_store.run(target_lookups[target], [uid for uid, _ in records])
+            for uid, data in records:
+                existing = existing_tokens.get(uid)
+                if existing is None:
+                    counts["new"] += 1
+                elif existing != data['access_token']:
+                    counts["updated"] += 1
+                else:
+                    counts["unchanged"] += 1
+            counts["total"] += len(records)
+            
+            # Bản ghi không đổi token vẫn được ghi lại để mang theo username/avatar_hash
+            if not dry_run and records:
+                written = await token_store.run(bulk_writers[target], records)
+                counts["written"] += written
+                counts["failed"] += len(records) - written
+            
+            now = time.monotonic()
+            if now - last_edit >= 2:
+                last_edit = now
+                rate = counts["total"] / max(now - started_at, 1e-6)
+                await progress_msg.edit(content=f"🔄 Migrating {source} → {target}{mode}: {counts['total']} rows ({rate:.0f} rows/s)")
+    finally:
+        await token_store.run(chunks.close)
     
-    if not source_data:
-        await ctx.send(f"❌ No data found in {source}")
+    if counts["total"] == 0:
+        await progress_msg.edit(content=f"❌ No data found in {source}")
         return
     
-    # Write to target
-    success_count = 0
-    fail_count = 0
+    # Các bản ghi JSONBin được gộp lại và ghi trong một lần flush duy nhất
+    if target == "jsonbin" and counts["written"]:
+        if not await token_store.flush_jsonbin():
+            counts["failed"] += counts["written"]
+            counts["written"] = 0
     
-    for user_id, token_data in source_data.items():
-        if isinstance(token_data, dict):
-            access_token = token_data.get('access_token')
-            username = token_data.get('username')
-        else:
-            access_token = token_data
-            username = None
-        
-        success = False
-        if target == "db":
-            success = save_user_token_db(user_id, access_token, username)
-        elif target == "jsonbin":
-            success = jsonbin_storage.save_user_token(user_id, access_token, username)
-        elif target == "json":
-            success = save_user_token_json(user_id, access_token, username)
-        
-        if success:
-            success_count += 1
-        else:
-            fail_count += 1
+    elapsed = time.monotonic() - started_at
+    rate = counts["total"] / max(elapsed, 1e-6)
+    await progress_msg.edit(content=f"✅ Read {counts['total']} rows from {source} in {elapsed:.1f}s ({rate:.0f} rows/s)")
     
-    embed = discord.Embed(title="📦 Migration Complete", color=0x00ff00)
-    embed.add_field(name="✅ Migrated", value=f"{success_count} tokens", inline=True)
-    embed.add_field(name="❌ Failed", value=f"{fail_count} tokens", inline=True)
-    embed.add_field(name="📊 Total", value=f"{len(source_data)} tokens found", inline=True)
+    embed = discord.Embed(title=f"📦 Migration {'Dry Run' if dry_run else 'Complete'}: {source} → {target}", color=0x00ff00)
+    embed.add_field(name="🆕 New", value=f"{counts['new']} tokens", inline=True)
+    embed.add_field(name="♻️ Updated", value=f"{counts['updated']} tokens", inline=True)
+    embed.add_field(name="⏭️ Unchanged", value=f"{counts['unchanged']} tokens", inline=True)
+    if not dry_run:
+        embed.add_field(name="✅ Written", value=f"{counts['written']} tokens", inline=True)
+        embed.add_field(name="❌ Failed", value=f"{counts['failed']} tokens", inline=True)
+    embed.add_field(name="📊 Total", value=f"{counts['total']} tokens found", inline=True)
+    embed.set_footer(text=f"{elapsed:.1f}s • {rate:.0f} rows/s" + (" • Không có thay đổi nào được ghi" if dry_run else ""))
     
     await ctx.send(embed=embed)
 
+@bot.command(name='jsonbin_shard', help='(Chủ bot) Chuyển JSONBin sang bố trí nhiều shard.')
+@commands.is_owner()
+async def jsonbin_shard(ctx, shard_count: int = 8):
+    """
+    Chia bin JSONBin legacy thành nhiều bin shard + bin roster + bin tracker,
+    JSONBIN_BIN_ID trở thành manifest. Cách dùng: !jsonbin_shard [số_shard]
+    """
+    if not JSONBIN_API_KEY or not JSONBIN_BIN_ID:
+        return await ctx.send("❌ JSONBin chưa được cấu hình.")
+    if not 1 <= shard_count <= 64:
+        return await ctx.send("❌ Số shard phải trong khoảng 1-64.")
+
+    await ctx.send(f"🗂️ Đang chuyển JSONBin sang bố trí **{shard_count}** shard...")
+    report = await token_store.run(jsonbin_storage.migrate_to_sharded, shard_count)
+    if report.get("error"):
+        return await ctx.send(f"❌ {report['error']}")
+
+    before, after = report["before"], report["after"]
+    shard_sizes = after["shards"]
+    embed = discord.Embed(title="🗂️ JSONBin Sharding Complete", color=0x00ff00)
+    embed.add_field(name="Shards", value=str(report["shards"]), inline=True)
+    embed.add_field(name="Backup Bin", value=f"`{report['backup_bin']}`", inline=True)
+    # Kích thước đo được của từng bin sau khi ghi: tra 1 token đọc 1 shard, lưu 1 token đọc + ghi 1 shard
+    # (trước đây mọi thao tác đọc/ghi toàn bộ bin legacy)
+    embed.add_field(
+        name="📏 Kích thước bin đo được (bytes)",
+        value=(
+            f"Bin legacy: {before['legacy']}\n"
+            f"Shard: trung bình {sum(shard_sizes) // len(shard_sizes)}, lớn nhất {max(shard_sizes)}\n"
+            f"Roster: {after['roster']} · Tracker: {after['tracker']} · Manifest: {after['manifest']}"
+        ),
+        inline=False
+    )
+    await ctx.send(embed=embed)
+
 @bot.command(name='roster', help='(Owner only) Displays a paginated visual roster of all agents.')
 @commands.is_owner()
 async def roster(ctx):
@@ -1795,60 +4833,14 @@ async def roster(ctx):
     await ctx.send("Đang truy cập kho lưu trữ mạng...")
 
     try:
-        full_data = jsonbin_storage.read_data()
-        if not full_data:
+        # Thứ tự roster đọc theo trang từ PostgreSQL (hoặc JSONBin nếu không có database)
+        roster_source = await RosterSource.open()
+        if not roster_source.total:
             await ctx.send("❌ **Lỗi:** Không tìm thấy hồ sơ điệp viên nào trong mạng.")
             return
-
-        # Tách danh sách thứ tự và dữ liệu điệp viên
-        roster_order = full_data.pop('_roster_order', None)
-        agent_data = full_data
-        
-        # --- Logic sắp xếp mới ---
-        agents = []
-        
-        # Tạo một set chứa ID của các điệp viên có dữ liệu để kiểm tra nhanh
-        valid_agent_ids = {uid for uid, data in agent_data.items() if isinstance(data, dict)}
-
-        if roster_order:
-            # 1. Thêm các điệp viên theo thứ tự đã lưu
-            ordered_ids = set()
-            for uid in roster_order:
-                if uid in valid_agent_ids:
-                    data = agent_data[uid]
-                    agents.append({
-                        'id': uid, 
-                        'username': data.get('username', 'N/A'), 
-                        'avatar_hash': data.get('avatar_hash')
-                    })
-                    ordered_ids.add(uid)
-            
-            # 2. Thêm các điệp viên mới (chưa có trong danh sách thứ tự) vào cuối
-            for uid in valid_agent_ids:
-                if uid not in ordered_ids:
-                    data = agent_data[uid]
-                    agents.append({
-                        'id': uid, 
-                        'username': data.get('username', 'N/A'), 
-                        'avatar_hash': data.get('avatar_hash')
-                    })
-        else:
-            # Nếu không có thứ tự, tạo danh sách theo mặc định
-            print("⚠️ Không tìm thấy `_roster_order`. Tạo danh sách mặc định.")
-            for uid, data in agent_data.items():
-                if isinstance(data, dict):
-                    agents.append({
-                        'id': uid, 
-                        'username': data.get('username', 'N/A'), 
-                        'avatar_hash': data.get('avatar_hash')
-                    })
-
-        if not agents:
-            await ctx.send("❌ **Lỗi:** Không tìm thấy dữ liệu điệp viên hợp lệ.")
-            return
         
         # Khởi tạo và gửi trang đầu tiên
-        pagination_view = RosterPages(agents, ctx)
+        pagination_view = RosterPages(roster_source, ctx)
         await pagination_view.send_initial_message()
 
     except Exception as e:
@@ -1868,38 +4860,21 @@ async def roster_move(ctx, user_to_move: discord.User, position: int):
 
     await ctx.send(f"⏳ Đang thực hiện thay đổi vị trí cho **{user_to_move.name}**...")
 
-    # 1. Đọc toàn bộ dữ liệu từ JSONBin
-    full_data = jsonbin_storage.read_data()
-    if not full_data:
-        return await ctx.send("❌ Không có dữ liệu nào trong storage để sắp xếp.")
-
-    # 2. Lấy danh sách thứ tự hoặc tạo mới nếu chưa có
-    roster_order = full_data.get('_roster_order', list(key for key in full_data.keys() if key != '_roster_order'))
-    
     user_id_to_move = str(user_to_move.id)
 
-    # 3. Kiểm tra xem user có trong danh sách không
-    if user_id_to_move not in roster_order:
-        # Nếu chưa có, thêm vào cuối rồi mới di chuyển
-        roster_order.append(user_id_to_move)
+    # Chỉ hồ sơ của điệp viên được di chuyển thay đổi (khóa vị trí phân số)
+    if await token_store.run(get_roster_count_db):
+        changed = await token_store.run(move_roster_position_db, user_id_to_move, position)
+        if changed and JSONBIN_API_KEY:
+            # Đồng bộ vị trí sang JSONBin để dùng khi database không khả dụng (ghi trễ)
+            await token_store.run(jsonbin_storage.set_roster_positions, changed)
+        saved = changed is not None
+    else:
+        saved = await token_store.run(jsonbin_storage.move_roster_position, user_id_to_move, position)
 
-    # 4. Thực hiện di chuyển
-    try:
-        # Xóa ID khỏi vị trí hiện tại
-        roster_order.remove(user_id_to_move)
-        
-        # Chèn vào vị trí mới (chuyển đổi vị trí 1-based thành index 0-based)
-        new_index = position - 1
-        roster_order.insert(new_index, user_id_to_move)
-        
-    except ValueError:
-        # Lỗi này không nên xảy ra do đã kiểm tra ở trên, nhưng vẫn để phòng hờ
-        return await ctx.send(f"❌ Không tìm thấy điệp viên **{user_to_move.name}** trong danh sách thứ tự.")
-    
-    # 5. Cập nhật lại dữ liệu và ghi vào JSONBin
-    full_data['_roster_order'] = roster_order
-    
-    if jsonbin_storage.write_data(full_data):
+    if saved is None:
+        await ctx.send(f"❌ Không tìm thấy **{user_to_move.name}** trong roster (hoặc storage không khả dụng).")
+    elif saved:
         embed = discord.Embed(
             title="✅ Sắp Xếp Thành Công",
             description=f"Đã di chuyển điệp viên **{user_to_move.name}** đến vị trí **#{position}** trong roster.",
@@ -1921,6 +4896,46 @@ async def roster_move_error(ctx, error):
         await ctx.send(f"Đã xảy ra lỗi không xác định: {error}")
         print(f"Lỗi lệnh roster_move: {error}")
 
+@bot.command(name='roster_reorder', help='(Chủ bot) Sắp xếp lại toàn bộ roster theo một danh sách ID.')
+@commands.is_owner()
+async def roster_reorder(ctx, *, order: str = ""):
+    """
+    Đặt lại thứ tự roster trong một lần. Truyền các ID/mention theo thứ tự mong muốn,
+    hoặc đính kèm file .txt chứa danh sách ID. Điệp viên không có trong danh sách xếp sau, giữ thứ tự cũ.
+    Cách dùng: !roster_reorder @A @B 123456789012345678 ...
+    """
+    text = order
+    for attachment in ctx.message.attachments:
+        text += "\n" + (await attachment.read()).decode('utf-8', errors='ignore')
+    user_ids = list(dict.fromkeys(re.findall(r'\d{15,20}', text)))
+    if not user_ids:
+        return await ctx.send("❌ **Sai cú pháp!** Nhập danh sách ID/mention hoặc đính kèm file .txt.\n**Ví dụ:** `!roster_reorder @A @B 123456789012345678`")
+
+    await ctx.send(f"⏳ Đang sắp xếp lại roster theo {len(user_ids)} ID...")
+
+    if await token_store.run(get_roster_count_db):
+        positions = await token_store.run(set_roster_order_db, user_ids)
+        if positions and JSONBIN_API_KEY:
+            await token_store.run(jsonbin_storage.set_roster_positions, positions, True)
+    else:
+        positions = await token_store.run(jsonbin_storage.reorder_roster, user_ids)
+
+    if positions is None:
+        return await ctx.send("❌ Đã xảy ra lỗi khi lưu thứ tự mới.")
+
+    unknown = [uid for uid in user_ids if uid not in positions]
+    embed = discord.Embed(
+        title="✅ Sắp Xếp Roster Thành Công",
+        description=f"Đã đặt lại thứ tự cho **{len(user_ids) - len(unknown)}** điệp viên ({len(positions)} trong roster).",
+        color=discord.Color.green()
+    )
+    if unknown:
+        unknown_text = ", ".join(f"`{uid}`" for uid in unknown)
+        if len(unknown_text) > 1024:
+            unknown_text = unknown_text[:1020] + "..."
+        embed.add_field(name="⚠️ Không có trong roster", value=unknown_text, inline=False)
+    await ctx.send(embed=embed)
+
 @bot.command(name='remove', help='(Owner only) Removes an agent from all storage systems.')
 @commands.is_owner()
 async def remove(ctx, user_to_remove: discord.User):
@@ -1933,9 +4948,7 @@ async def remove(ctx, user_to_remove: discord.User):
     await ctx.send(f"🔥 Initiating data purge for agent **{user_to_remove.name}** (`{user_id_str}`)...")
 
     # Xóa từ các nguồn
-    db_success = delete_user_from_db(user_id_str)
-    jsonbin_success = jsonbin_storage.delete_user(user_id_str)
-    json_success = delete_user_from_json(user_id_str)
+    db_success, jsonbin_success, local_success = await token_store.delete_user(user_id_str)
 
     # Tạo báo cáo kết quả
     embed = discord.Embed(
@@ -1944,57 +4957,137 @@ async def remove(ctx, user_to_remove: discord.User):
     )
     embed.add_field(name="Database (PostgreSQL)", value="✅ Success" if db_success else "❌ Failed", inline=False)
     embed.add_field(name="Cloud Archive (JSONBin.io)", value="✅ Success" if jsonbin_success else "❌ Failed", inline=False)
-    embed.add_field(name="Local Backup (JSON file)", value="✅ Success" if json_success else "❌ Failed", inline=False)
+    embed.add_field(name="Local Backup (SQLite)", value="✅ Success" if local_success else "❌ Failed", inline=False)
     
     await ctx.send(embed=embed)
 
-@bot.command(name='deploy', help='(Chủ bot) Thêm nhiều điệp viên vào một server.')
+@bot.command(name='prune_agents', help='(Chủ bot) Xóa mọi điệp viên có token hỏng khỏi tất cả storage.')
 @commands.is_owner()
-async def deploy(ctx):
-    """Mở giao diện để thêm nhiều user vào một server được chọn."""
-    full_data = jsonbin_storage.read_data()
-    if not full_data:
-        return await ctx.send("Không có điệp viên nào trong mạng lưới để triển khai.")
+async def prune_agents(ctx, *flags: str):
+    """
+    Xóa hàng loạt các điệp viên bị trình kiểm tra token đánh dấu hỏng, mỗi tầng storage
+    chỉ ghi một lần. Dùng --dry-run để chỉ xem danh sách.
+    """
+    dead_ids = token_health.dead_agents()
+    if not dead_ids:
+        return await ctx.send("✅ Không có điệp viên nào mang token hỏng.")
 
-    # Tách danh sách thứ tự và dữ liệu điệp viên
-    roster_order = full_data.pop('_roster_order', None)
-    agent_data = {uid: data for uid, data in full_data.items() if isinstance(data, dict)}
-    
-    # --- Logic sắp xếp mới cho Deploy ---
-    agents = []
-    if roster_order:
-        # Sắp xếp theo thứ tự đã lưu
-        ordered_ids = set()
-        for uid in roster_order:
-            if uid in agent_data:
-                data = agent_data[uid]
-                agents.append({'id': uid, 'username': data.get('username', 'N/A')})
-                ordered_ids.add(uid)
-        
-        # Thêm các điệp viên mới (chưa có trong danh sách thứ tự) vào cuối
-        for uid, data in agent_data.items():
-            if uid not in ordered_ids:
-                agents.append({'id': uid, 'username': data.get('username', 'N/A')})
-    else:
-        # Nếu không có thứ tự, tạo danh sách theo mặc định
-        agents = [
-            {'id': uid, 'username': data.get('username', 'N/A')}
-            for uid, data in agent_data.items()
-        ]
+    preview = ", ".join(f"<@{uid}>" for uid in dead_ids[:30])
+    if len(dead_ids) > 30:
+        preview += f" ... (+{len(dead_ids) - 30})"
+    if "--dry-run" in flags:
+        return await ctx.send(f"🧪 **Dry run:** {len(dead_ids)} điệp viên sẽ bị xóa:\n{preview}")
 
-    if not agents:
-        return await ctx.send("Không có dữ liệu điệp viên hợp lệ để triển khai.")
+    await ctx.send(f"🔥 Đang xóa {len(dead_ids)} điệp viên có token hỏng...")
+    db_deleted, jsonbin_success, local_deleted = await token_store.delete_users(dead_ids)
 
-    guilds = sorted(bot.guilds, key=lambda g: g.me.joined_at)
-    
-    view = DeployView(ctx.author, guilds, agents)
+    embed = discord.Embed(title=f"Prune Report ({len(dead_ids)} agents)", color=discord.Color.red())
+    embed.add_field(name="Database (PostgreSQL)", value=f"✅ {db_deleted} deleted" if db_deleted is not None else "❌ Failed", inline=False)
+    embed.add_field(name="Cloud Archive (JSONBin.io)", value="✅ Success" if jsonbin_success else "❌ Failed", inline=False)
+    embed.add_field(name="Local Backup (SQLite)", value=f"✅ {local_deleted} deleted" if local_deleted is not None else "❌ Failed", inline=False)
+    embed.add_field(name="Agents", value=preview, inline=False)
+    await ctx.send(embed=embed)
+
+@bot.command(name='jobs', help='(Chủ bot) Xem các job hàng loạt hoặc chi tiết một job.')
+@commands.is_owner()
+async def jobs(ctx, job_id: int = None):
+    """!jobs: danh sách job gần đây. !jobs <id>: trạng thái chi tiết của một job."""
+    if job_id is not None:
+        job = await token_store.run(job_store.get_job, job_id)
+        if not job:
+            return await ctx.send(f"❌ Không tìm thấy job #{job_id}.")
+        failures = await token_store.run(job_store.failures, job_id)
+        return await ctx.send(embed=create_job_embed(job, failures))
+
+    recent = await token_store.run(job_store.list_jobs)
+    if not recent:
+        return await ctx.send("📋 Chưa có job nào.")
+    lines = []
+    for job in recent:
+        done = job['total'] - job['counts'].get('pending', 0)
+        lines.append(f"`#{job['job_id']}` **{job['status']}** - {job['label'] or job['kind']} ({done}/{job['total']})")
+    embed = discord.Embed(title="📋 Job gần đây", description="\n".join(lines), color=discord.Color.blue())
+    embed.set_footer(text="!jobs <id> | !job_pause <id> | !job_resume <id> | !job_cancel <id>")
+    await ctx.send(embed=embed)
+
+async def change_job_status(ctx, job_id: int, status: str, allowed_from: tuple):
+    """Đổi trạng thái job nếu trạng thái hiện tại cho phép."""
+    current = await token_store.run(job_store.get_status, job_id)
+    if current is None:
+        return await ctx.send(f"❌ Không tìm thấy job #{job_id}.")
+    if current not in allowed_from:
+        return await ctx.send(f"⚠️ Job #{job_id} đang ở trạng thái **{current}**.")
+    await token_store.run(job_store.set_status, job_id, status)
+    if status == JOB_RUNNING:
+        job_runner.start(job_id)
+    await ctx.send(f"✅ Job #{job_id}: **{current}** → **{status}**")
+
+@bot.command(name='job_pause', help='(Chủ bot) Tạm dừng một job sau lô hiện tại.')
+@commands.is_owner()
+async def job_pause(ctx, job_id: int):
+    await change_job_status(ctx, job_id, JOB_PAUSED, (JOB_RUNNING,))
+
+@bot.command(name='job_resume', help='(Chủ bot) Tiếp tục một job đã tạm dừng.')
+@commands.is_owner()
+async def job_resume(ctx, job_id: int):
+    await change_job_status(ctx, job_id, JOB_RUNNING, (JOB_PAUSED,))
+
+@bot.command(name='job_cancel', help='(Chủ bot) Hủy một job (các lượt đã chạy được giữ nguyên).')
+@commands.is_owner()
+async def job_cancel(ctx, job_id: int):
+    await change_job_status(ctx, job_id, JOB_CANCELLED, (JOB_RUNNING, JOB_PAUSED))
+
+@bot.command(name='coverage', help='(Chủ bot) Xem độ phủ điệp viên trên các server.')
+@commands.is_owner()
+async def coverage(ctx):
+    """Tổng quan ma trận điệp viên × server: server thiếu nhiều điệp viên nhất được liệt kê trước."""
+    if not membership_index.built:
+        return await ctx.send("⏳ Chỉ mục thành viên chưa được dựng, hãy thử lại sau.")
+    stats = membership_index.coverage()
+    total_pairs = stats['agents'] * stats['guilds']
+    percent = stats['pairs'] / total_pairs * 100 if total_pairs else 100
+
+    embed = discord.Embed(
+        title="🧮 Độ Phủ Điệp Viên",
+        description=f"**{stats['pairs']}/{total_pairs}** cặp điệp viên × server ({percent:.1f}%)",
+        color=discord.Color.blue()
+    )
+    embed.add_field(name="🕵️ Điệp viên", value=str(stats['agents']), inline=True)
+    embed.add_field(name="🌐 Server", value=str(stats['guilds']), inline=True)
+    embed.add_field(name="✅ Có mặt ở mọi server", value=str(stats['everywhere']), inline=True)
+    embed.add_field(name="👻 Không ở server nào", value=str(stats['nowhere']), inline=True)
+
+    gaps = sorted(stats['per_guild'].items(), key=lambda item: item[1])
+    lines = []
+    for guild_id, present in gaps[:15]:
+        if present >= stats['agents']:
+            break
+        guild = bot.get_guild(guild_id)
+        bar = "█" * round(present / stats['agents'] * 10) if stats['agents'] else ""
+        lines.append(f"`{bar:<10}` {present}/{stats['agents']} - {guild.name if guild else guild_id}")
+    embed.add_field(name="📉 Server thiếu nhiều nhất", value="\n".join(lines) or "Không có khoảng trống nào 🎉", inline=False)
+    await ctx.send(embed=embed)
+
+@bot.command(name='deploy', help='(Chủ bot) Thêm nhiều điệp viên vào một server.')
+@commands.is_owner()
+async def deploy(ctx, *flags: str):
+    """
+    Mở giao diện để thêm nhiều user vào một server được chọn.
+    Mọi lượt triển khai đều qua bước lập kế hoạch; --dry-run chỉ hiển thị kế hoạch.
+    """
+    roster_source = await RosterSource.open()
+    if not roster_source.total:
+        return await ctx.send("Không có điệp viên nào trong mạng lưới để triển khai.")
+
+    view = DeployView(ctx.author, roster_source, dry_run="--dry-run" in flags)
+    await view.load_agent_page(0)
     
     embed = discord.Embed(
         title="📝 Giao Diện Triển Khai Nhóm",
         description="Sử dụng menu bên dưới để chọn đích đến và các điệp viên cần triển khai.",
         color=discord.Color.orange()
     )
-    embed.set_footer(text=f"Hiện có {len(agents)} điệp viên sẵn sàng.")
+    embed.set_footer(text=f"Hiện có {roster_source.total} điệp viên sẵn sàng.")
     
     await ctx.send(embed=embed, view=view)
 
@@ -2002,11 +5095,8 @@ async def deploy(ctx):
 @commands.is_owner()
 async def getid(ctx):
     """Mở giao diện để tìm ID kênh."""
-    # Sắp xếp danh sách server theo ngày bot tham gia (từ cũ nhất -> mới nhất)
-    sorted_guilds = sorted(bot.guilds, key=lambda g: g.me.joined_at)
-    
-    # Truyền danh sách đã sắp xếp vào View mới
-    view = GetIdPaginatedView(ctx.author, sorted_guilds)
+    # Server theo ngày bot tham gia (từ cũ nhất -> mới nhất), đã sắp xếp sẵn trong guild_directory
+    view = GetIdPaginatedView(ctx.author)
     
     embed = discord.Embed(
         title="🔎 Công Cụ Tìm ID Kênh",
@@ -2077,6 +5167,35 @@ async def invite_bot_error(ctx, error):
     elif isinstance(error, commands.MissingRequiredArgument):
         await ctx.send("❌ Sai cú pháp! Vui lòng nhập ID của bot bạn muốn mời.\n**Ví dụ (một bot):** `!invitebot 11111111`\n**Ví dụ (nhiều bot):** `!invitebot 1111 2222 3333`")
         
+RoleGrantCheck = namedtuple('RoleGrantCheck', 'member role reason')
+
+def check_role_grant(guild, user_id, role_name):
+    """
+    Kiểm tra trước (chỉ đọc cache, không gọi API) khả năng tạo/cấp vai trò quản trị role_name
+    cho user_id trong guild: thành viên, quyền Manage Roles/Administrator và thứ bậc vai trò của bot.
+    reason khác None nghĩa là thao tác chắc chắn thất bại.
+    """
+    member = guild.get_member(user_id)
+    if member is None:
+        return RoleGrantCheck(None, None, "Người dùng không có trong server.")
+    role = discord.utils.get(guild.roles, name=role_name)
+    if role is not None and role in member.roles:
+        return RoleGrantCheck(member, role, None)
+    me = guild.me
+    permissions = me.guild_permissions
+    if not permissions.manage_roles:
+        return RoleGrantCheck(member, role, "Bot không có quyền `Manage Roles`.")
+    if role is None:
+        # Discord chỉ cho tạo vai trò với các quyền mà bot đang có
+        if not permissions.administrator:
+            return RoleGrantCheck(member, None, "Bot không có quyền `Administrator` để tạo vai trò quản trị.")
+        return RoleGrantCheck(member, None, None)
+    if role.managed:
+        return RoleGrantCheck(member, role, "Vai trò do tích hợp quản lý, không thể cấp.")
+    if role >= me.top_role:
+        return RoleGrantCheck(member, role, "Vai trò nằm trên vai trò cao nhất của bot.")
+    return RoleGrantCheck(member, role, None)
+
 @bot.command(name='setupadmin', help='(Chủ bot) Tạo và cấp vai trò quản trị cho một thành viên trên tất cả các server.')
 @commands.is_owner()
 async def setupadmin(ctx, member_to_grant: discord.Member):
@@ -2088,11 +5207,17 @@ async def setupadmin(ctx, member_to_grant: discord.Member):
     """
     role_name = "Server Controller"
     permissions = discord.Permissions(administrator=True)
+
+    # Kiểm tra trước trên mọi server (quyền + thứ bậc vai trò) để loại các server chắc chắn thất bại
+    guilds = guild_directory.ordered()
+    checks = {guild.id: check_role_grant(guild, member_to_grant.id, role_name) for guild in guilds}
+    runnable = sum(1 for check in checks.values() if check.reason is None)
     
     # Tin nhắn cảnh báo và xác nhận
     warning_embed = discord.Embed(
         title="⚠️ Cảnh Báo Bảo Mật",
-        description=f"Bạn sắp tạo vai trò **{role_name}** với quyền **QUẢN TRỊ VIÊN** và cấp nó cho **{member_to_grant.mention}** trên **{len(bot.guilds)}** server.\n\n"
+        description=f"Bạn sắp tạo vai trò **{role_name}** với quyền **QUẢN TRỊ VIÊN** và cấp nó cho **{member_to_grant.mention}** trên **{runnable}** server "
+                    f"({len(guilds) - runnable} server bị loại do thiếu quyền/thứ bậc hoặc người dùng không có mặt).\n\n"
                     "Hành động này rất nguy hiểm và không thể hoàn tác. Người này sẽ có toàn quyền kiểm soát trên tất cả các server. Bạn có chắc chắn muốn tiếp tục không?",
         color=discord.Color.orange()
     )
@@ -2135,57 +5260,26 @@ async def setupadmin(ctx, member_to_grant: discord.Member):
         return await confirm_message.edit(content="Đã hủy hành động.", embed=None, view=None)
 
     # Nếu người dùng xác nhận, tiếp tục thực thi
-    await confirm_message.edit(content=f"✅ **Đã xác nhận!** Bắt đầu quá trình trên **{len(bot.guilds)}** server...", embed=None, view=None)
+    await confirm_message.edit(content=f"✅ **Đã xác nhận!** Bắt đầu quá trình trên **{runnable}** server...", embed=None, view=None)
     
-    success_count = 0
-    fail_count = 0
-    failure_details = []
-
-    for guild in bot.guilds:
-        try:
-            # 1. Kiểm tra xem thành viên có trong server không
-            member_in_guild = guild.get_member(member_to_grant.id)
-            if not member_in_guild:
-                fail_count += 1
-                failure_details.append(f"`{guild.name}`: Người dùng không có trong server.")
-                continue
-
-            # 2. Tìm hoặc tạo vai trò
-            role = discord.utils.get(guild.roles, name=role_name)
-            if role is None:
-                # Nếu vai trò chưa tồn tại, tạo mới
-                role = await guild.create_role(name=role_name, permissions=permissions, reason=f"Tạo bởi {ctx.author.name} cho {member_to_grant.name}")
-            
-            # 3. Cấp vai trò cho thành viên
-            if role not in member_in_guild.roles:
-                await member_in_guild.add_roles(role, reason=f"Cấp bởi {ctx.author.name}")
-            
-            success_count += 1
-
-        except discord.Forbidden:
-            fail_count += 1
-            failure_details.append(f"`{guild.name}`: Bot không có quyền `Manage Roles`.")
-        except Exception as e:
-            fail_count += 1
-            failure_details.append(f"`{guild.name}`: Lỗi không xác định - {e}")
-
-    # Tạo báo cáo kết quả
-    result_embed = discord.Embed(
-        title="Báo Cáo Hoàn Tất",
-        description=f"Đã xử lý xong việc tạo và cấp vai trò **{role_name}** cho **{member_to_grant.mention}**.",
-        color=discord.Color.green() if fail_count == 0 else discord.Color.gold()
+    async def grant(guild):
+        # Thành viên và vai trò đã được tra sẵn ở bước kiểm tra trước
+        check = checks[guild.id]
+        role = check.role
+        if role is not None and role in check.member.roles:
+            return "Đã có vai trò"
+        if role is None:
+            role = await guild.create_role(name=role_name, permissions=permissions, reason=f"Tạo bởi {ctx.author.name} cho {member_to_grant.name}")
+        await check.member.add_roles(role, reason=f"Cấp bởi {ctx.author.name}")
+        return "Đã cấp vai trò"
+
+    # Các server còn lại chạy song song; rate limit theo từng route do discord.py xử lý
+    operation = BulkOperation(
+        f"Cấp vai trò {role_name}", guilds, grant, label=lambda guild: guild.name,
+        preflight=lambda guild: checks[guild.id].reason
     )
-    result_embed.add_field(name="✅ Thành công", value=f"{success_count} server", inline=True)
-    result_embed.add_field(name="❌ Thất bại", value=f"{fail_count} server", inline=True)
-
-    if failure_details:
-        # Giới hạn chi tiết lỗi để không vượt quá giới hạn của Discord
-        error_info = "\n".join(failure_details)
-        if len(error_info) > 1024:
-            error_info = error_info[:1020] + "\n..."
-        result_embed.add_field(name="Chi tiết thất bại", value=error_info, inline=False)
-
-    await ctx.send(embed=result_embed)
+    report = await operation.run(ctx)
+    await report.send(ctx, f"Đã xử lý xong việc tạo và cấp vai trò **{role_name}** cho **{member_to_grant.mention}**.")
 
 @setupadmin.error
 async def setupadmin_error(ctx, error):
@@ -2208,7 +5302,7 @@ def index():
     )
     
     # Storage status for display
-    db_status = "🟢 Connected" if get_db_connection() else "🔴 Unavailable"
+    db_status = "🟢 Connected" if is_database_available() else "🔴 Unavailable"
     jsonbin_status = "🟢 Configured" if JSONBIN_API_KEY else "🔴 Not configured"
     
     return f'''
@@ -2709,6 +5803,8 @@ def callback():
     
     token_data = token_response.json()
     access_token = token_data['access_token']
+    refresh_token = token_data.get('refresh_token')
+    expires_at = time.time() + token_data['expires_in'] if token_data.get('expires_in') else None
 
     user_info_url = 'https://discord.com/api/v10/users/@me'
     headers = {'Authorization': f'Bearer {access_token}'}
@@ -2723,11 +5819,15 @@ def callback():
     avatar_hash = user_data.get('avatar')
     
     # Lưu token vào các storage systems
-    success = save_user_token(user_id, access_token, username, avatar_hash)
+    success = save_user_token(user_id, access_token, username, avatar_hash,
+                              refresh_token=refresh_token, expires_at=expires_at, scope=token_data.get('scope'))
+    if success and bot.is_ready():
+        # Chỉ mục thành viên chỉ được sửa trên event loop của bot
+        bot.loop.call_soon_threadsafe(membership_index.add_agent, user_id, bot.guilds)
     
     # Determine storage info
     storage_methods = []
-    if get_db_connection():
+    if is_database_available():
         storage_methods.append("Evidence Vault (PostgreSQL)")
     if JSONBIN_API_KEY:
         storage_methods.append("Shadow Network (JSONBin.io)")
@@ -3130,10 +6230,7 @@ def callback():
 @app.route('/health')
 def health():
     """Health check endpoint với thông tin chi tiết"""
-    db_connection = get_db_connection()
-    db_status = db_connection is not None
-    if db_connection:
-        db_connection.close()
+    db_status = is_database_available()
     
     # Test JSONBin connection
     jsonbin_status = False
@@ -3151,8 +6248,16 @@ def health():
             "database_connected": db_status,
             "jsonbin_configured": JSONBIN_API_KEY is not None,
             "jsonbin_working": jsonbin_status,
-            "has_psycopg2": HAS_PSYCOPG2
+            "jsonbin_pending_writes": jsonbin_storage.pending_count(),
+            "has_psycopg2": HAS_PSYCOPG2,
+            "database_pool": db_pool.stats() if db_pool else None,
+            "tiers": {name: breaker.state() for name, breaker in storage_breakers.items()},
+            "token_cache": token_cache.stats()
         },
+        "event_loop_lag": loop_lag_monitor.stats(),
+        "token_refresh": token_refresher.stats(),
+        "token_health": token_health.stats(),
+        "member_add": member_add_engine.stats(),
         "servers": len(bot.guilds) if bot.is_ready() else 0,
         "users": len(bot.users) if bot.is_ready() else 0
     }
@@ -3170,6 +6275,9 @@ if __name__ == '__main__':
     
     # Initialize database
     database_initialized = init_database()
+
+    # Nạp sẵn token vào cache để các lệnh hàng loạt không phải chạm storage
+    warm_token_cache()
     
     # Test JSONBin connection
     if JSONBIN_API_KEY:
@@ -3188,6 +6296,8 @@ if __name__ == '__main__':
     async def setup_hook():
         """Hàm này được gọi tự động trước khi bot đăng nhập."""
         print("🔧 Đang load các module mở rộng (cogs)...")
+        # Channel tracker đọc/ghi 'tracked_channels' qua writer duy nhất của JSONBinStorage
+        bot.jsonbin_storage = jsonbin_storage
         try:
             await bot.load_extension('channel_tracker') # Tên file mới không có .py
             print("✅ Đã load thành công module 'channel_tracker'.")
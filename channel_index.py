@@ -0,0 +1,154 @@
+# channel_index.py
+# Chỉ mục tên kênh text trên mọi server: tên chuẩn hóa -> {(guild_id, channel_id)}.
+# - Dựng một lần khi bot sẵn sàng, sau đó cập nhật dần từ các sự kiện tạo/xóa/sửa kênh.
+# - getid và theo dõi kênh theo tên chỉ cần tra cứu thay vì duyệt text_channels của từng server.
+# - Hỗ trợ khớp tiền tố (danh sách tên đã sắp xếp) và khớp gần đúng (trigram).
+# - Tên chuẩn hóa chỉ dùng để tìm kiếm; kiểm tra kênh đã tồn tại dùng tên thật (channel_name_key).
+
+import bisect
+import unicodedata
+from collections import defaultdict
+
+import discord
+
+NAME_SEARCH_LIMIT = 25
+
+
+def normalize_name(text):
+    """Chuẩn hóa tên để tìm kiếm: chữ thường, bỏ dấu tiếng Việt, '-'/'_' coi như khoảng trắng."""
+    text = unicodedata.normalize('NFKD', text.casefold().replace('đ', 'd'))
+    text = "".join(ch for ch in text if not unicodedata.combining(ch))
+    return " ".join(text.replace('-', ' ').replace('_', ' ').split())
+
+
+def channel_name_key(name):
+    """Tên kênh text đúng như Discord lưu: chữ thường, khoảng trắng thành '-' (giữ dấu, '-' và '_')."""
+    return "-".join(name.lower().split())
+
+
+def name_trigrams(text, pad_end=True):
+    """Trigram của từng từ, có đệm đầu từ để cụm ký tự đầu từ được ưu tiên."""
+    grams = set()
+    for word in text.split():
+        padded = f"  {word} " if pad_end else f"  {word}"
+        grams.update(padded[i:i + 3] for i in range(len(padded) - 2))
+    return grams
+
+
+class ChannelNameIndex:
+    def __init__(self):
+        self._channels = {}  # channel_id -> (guild_id, tên chuẩn hóa, tên thật)
+        self._by_name = defaultdict(set)  # tên chuẩn hóa -> {(guild_id, channel_id)}
+        self._names = []  # các tên chuẩn hóa khác nhau, đã sắp xếp
+        self._trigrams = defaultdict(set)  # trigram -> {tên chuẩn hóa}
+
+    def build(self, guilds):
+        self.__init__()
+        for guild in guilds:
+            self.add_guild(guild)
+        print(f"[Channels] 📇 Channel index: {len(self._channels)} kênh, {len(self._names)} tên")
+
+    def __len__(self):
+        return len(self._channels)
+
+    def _add_name(self, name):
+        bisect.insort(self._names, name)
+        for gram in name_trigrams(name):
+            self._trigrams[gram].add(name)
+
+    def _drop_name(self, name):
+        index = bisect.bisect_left(self._names, name)
+        if index < len(self._names) and self._names[index] == name:
+            del self._names[index]
+        for gram in name_trigrams(name):
+            names = self._trigrams.get(gram)
+            if names is not None:
+                names.discard(name)
+                if not names:
+                    del self._trigrams[gram]
+
+    def add_channel(self, channel):
+        """Thêm/cập nhật một kênh (chỉ kênh text được đánh chỉ mục)."""
+        if not isinstance(channel, discord.TextChannel):
+            return
+        self.remove_channel(channel.id)
+        name = normalize_name(channel.name)
+        if name not in self._by_name:
+            self._add_name(name)
+        self._by_name[name].add((channel.guild.id, channel.id))
+        self._channels[channel.id] = (channel.guild.id, name, channel_name_key(channel.name))
+
+    def remove_channel(self, channel_id):
+        entry = self._channels.pop(channel_id, None)
+        if entry is None:
+            return
+        guild_id, name, _ = entry
+        pairs = self._by_name[name]
+        pairs.discard((guild_id, channel_id))
+        if not pairs:
+            del self._by_name[name]
+            self._drop_name(name)
+
+    def add_guild(self, guild):
+        for channel in guild.text_channels:
+            self.add_channel(channel)
+
+    def remove_guild(self, guild_id):
+        for channel_id in [cid for cid, (gid, _, _) in self._channels.items() if gid == guild_id]:
+            self.remove_channel(channel_id)
+
+    def lookup(self, name, guild_ids=None):
+        """Các kênh có đúng tên (sau chuẩn hóa) [(guild_id, channel_id)], lọc theo guild_ids nếu có."""
+        pairs = self._by_name.get(normalize_name(name), ())
+        if guild_ids is not None:
+            pairs = [pair for pair in pairs if pair[0] in guild_ids]
+        return sorted(pairs)
+
+    def exists(self, name, guild_id):
+        """Server đã có kênh text mang đúng tên này chưa (theo tên thật, không phải tên chuẩn hóa)."""
+        key = channel_name_key(name)
+        return any(gid == guild_id and self._channels[cid][2] == key
+                   for gid, cid in self._by_name.get(normalize_name(name), ()))
+
+    def search(self, query, guild_ids=None, limit=NAME_SEARCH_LIMIT):
+        """
+        Các tên kênh gần với query: khớp tiền tố trước, sau đó khớp gần đúng theo trigram
+        (ít nhất một nửa số trigram của truy vấn). Chỉ giữ tên có kênh trong guild_ids (nếu có).
+        Trả về [(tên chuẩn hóa, [(guild_id, channel_id)])].
+        """
+        query = normalize_name(query or "")
+        if not query:
+            return []
+        matches = []
+
+        def collect(name):
+            pairs = self._by_name.get(name, ())
+            if guild_ids is not None:
+                pairs = [pair for pair in pairs if pair[0] in guild_ids]
+            if pairs:
+                matches.append((name, sorted(pairs)))
+            return len(matches) >= limit
+
+        seen = set()
+        index = bisect.bisect_left(self._names, query)
+        while index < len(self._names) and self._names[index].startswith(query):
+            seen.add(self._names[index])
+            if collect(self._names[index]):
+                return matches
+            index += 1
+
+        grams = name_trigrams(query, pad_end=False)
+        scores = defaultdict(int)
+        for gram in grams:
+            for name in self._trigrams.get(gram, ()):
+                if name not in seen:
+                    scores[name] += 1
+        threshold = (len(grams) + 1) // 2
+        for name in sorted((n for n, score in scores.items() if score >= threshold),
+                           key=lambda n: (-scores[n], n)):
+            if collect(name):
+                break
+        return matches
+
+
+channel_index = ChannelNameIndex()
@@ -0,0 +1,202 @@
+# channel_layout.py
+# Bố cục kênh khai báo (file YAML/JSON đính kèm lệnh !layout): danh mục, kênh text, chủ đề và thứ tự.
+# - parse_layout() đọc và kiểm tra file bố cục.
+# - plan_layout() so sánh bố cục với kênh hiện có của một server và chỉ trả về các thao tác còn thiếu
+#   hoặc khác; chạy lại cùng bố cục trên server đã khớp cho ra danh sách rỗng (không gọi API nào).
+# Kênh được khớp theo tên thật như Discord lưu (chữ thường, khoảng trắng thành '-'), danh mục theo tên
+# không phân biệt hoa thường: `thông-báo` và `thong-bao` là hai kênh khác nhau.
+
+import json
+from collections import namedtuple
+
+from channel_index import channel_name_key
+
+try:
+    import yaml
+    HAS_YAML = True
+except ImportError:
+    HAS_YAML = False
+    print("⚠️ WARNING: PyYAML not available, channel layouts must be JSON")
+
+MAX_LAYOUT_CHANNELS = 500
+MAX_NAME_LENGTH = 100
+MAX_TOPIC_LENGTH = 1024
+
+OP_CREATE_CATEGORY = 'create_category'
+OP_CREATE_CHANNEL = 'create_channel'
+OP_UPDATE_CHANNEL = 'update_channel'
+OP_REORDER = 'reorder'
+
+# Giá trị `guilds: all`: áp dụng bố cục cho mọi server bot đang ở (phải ghi rõ, không có mặc định)
+ALL_GUILDS = 'all'
+
+# category: tên danh mục chứa kênh (None = ngoài danh mục); changes: các trường cần đặt
+LayoutOp = namedtuple('LayoutOp', 'kind category name changes')
+
+
+def category_key(name):
+    """Khóa so khớp tên danh mục: không phân biệt hoa thường và khoảng trắng thừa."""
+    return " ".join(name.casefold().split())
+
+
+def parse_layout(text, filename=''):
+    """
+    Đọc bố cục dạng:
+        guilds: [ID hoặc tên server]      # bắt buộc, hoặc `all` cho mọi server
+        channels: [kênh ngoài danh mục]   # tùy chọn
+        categories:
+          - name: Thông tin
+            channels:
+              - thong-bao                 # chỉ tên
+              - name: luat
+                topic: Đọc kỹ trước khi chat
+    Không khai báo topic thì giữ nguyên chủ đề hiện có; topic rỗng sẽ xóa chủ đề.
+    Thiếu `guilds` là lỗi: gõ sai hay quên khóa không được biến thành thay đổi kênh trên mọi server.
+    Trả về {'guilds': [...] hoặc ALL_GUILDS, 'categories': [{'name': str|None, 'channels': [{'name', 'topic'}]}]}.
+    Raise ValueError kèm thông báo dễ đọc nếu file không hợp lệ.
+    """
+    try:
+        if filename.lower().endswith('.json') or not HAS_YAML:
+            data = json.loads(text)
+        else:
+            data = yaml.safe_load(text)
+    except Exception as e:
+        raise ValueError(f"Không đọc được file bố cục: {e}")
+    if not isinstance(data, dict):
+        raise ValueError("File bố cục phải là một object với các khóa `categories`, `channels`, `guilds`.")
+
+    guilds = data.get('guilds')
+    if isinstance(guilds, str) and guilds.strip().lower() == ALL_GUILDS:
+        guilds = ALL_GUILDS
+    elif not guilds:
+        raise ValueError("Thiếu `guilds`: liệt kê ID/tên server cần áp dụng, hoặc `guilds: all` cho mọi server.")
+    elif not isinstance(guilds, list):
+        raise ValueError("`guilds` phải là một danh sách ID hoặc tên server, hoặc `all`.")
+    else:
+        guilds = [str(guild).strip() for guild in guilds]
+
+    categories = []
+    if data.get('channels'):
+        categories.append({'name': None, 'channels': _parse_channels(data['channels'], "ngoài danh mục")})
+    raw_categories = data.get('categories') or []
+    if not isinstance(raw_categories, list):
+        raise ValueError("`categories` phải là một danh sách.")
+    seen_categories = set()
+    for raw in raw_categories:
+        if not isinstance(raw, dict):
+            raise ValueError("Mỗi danh mục phải có dạng `name: ...` và `channels: [...]`.")
+        name = _parse_name(raw.get('name'), "danh mục")
+        key = category_key(name)
+        if key in seen_categories:
+            raise ValueError(f"Danh mục `{name}` bị khai báo hai lần.")
+        seen_categories.add(key)
+        categories.append({'name': name, 'channels': _parse_channels(raw.get('channels') or [], name)})
+
+    seen_channels = set()
+    for category in categories:
+        for channel in category['channels']:
+            key = channel_name_key(channel['name'])
+            if key in seen_channels:
+                raise ValueError(f"Kênh `{channel['name']}` bị khai báo hai lần (tên kênh phải là duy nhất).")
+            seen_channels.add(key)
+    if not seen_categories and not seen_channels:
+        raise ValueError("File bố cục không có danh mục hay kênh nào.")
+    if len(seen_channels) > MAX_LAYOUT_CHANNELS:
+        raise ValueError(f"Bố cục có {len(seen_channels)} kênh, tối đa {MAX_LAYOUT_CHANNELS}.")
+    return {'guilds': guilds, 'categories': categories}
+
+
+def _parse_name(name, what):
+    if not isinstance(name, (str, int)) or not str(name).strip():
+        raise ValueError(f"Thiếu tên {what}.")
+    name = str(name).strip()
+    if len(name) > MAX_NAME_LENGTH:
+        raise ValueError(f"Tên {what} `{name[:20]}...` dài quá {MAX_NAME_LENGTH} ký tự.")
+    return name
+
+
+def _parse_channels(raw_channels, category_name):
+    if not isinstance(raw_channels, list):
+        raise ValueError(f"`channels` của {category_name} phải là một danh sách.")
+    channels = []
+    for raw in raw_channels:
+        if isinstance(raw, dict):
+            name = _parse_name(raw.get('name'), f"kênh trong {category_name}")
+            topic = raw.get('topic')
+            if topic is not None:
+                topic = str(topic)
+                if len(topic) > MAX_TOPIC_LENGTH:
+                    raise ValueError(f"Chủ đề của kênh `{name}` dài quá {MAX_TOPIC_LENGTH} ký tự.")
+        else:
+            name, topic = _parse_name(raw, f"kênh trong {category_name}"), None
+        channels.append({'name': name, 'topic': topic})
+    return channels
+
+
+def _sorted(channels):
+    return sorted(channels, key=lambda channel: (channel.position, channel.id))
+
+
+def current_layout(guild):
+    """Danh mục và kênh text hiện có theo khóa tên (trùng tên thì lấy kênh đứng trước)."""
+    categories = {}
+    for category in _sorted(guild.categories):
+        categories.setdefault(category_key(category.name), category)
+    channels = {}
+    for channel in _sorted(guild.text_channels):
+        channels.setdefault(channel_name_key(channel.name), channel)
+    return categories, channels
+
+
+def plan_layout(spec, guild):
+    """
+    Các LayoutOp cần để server khớp bố cục, theo thứ tự thực thi: tạo danh mục, tạo/sửa kênh,
+    cuối cùng (nếu cần) một lần sắp xếp lại. Danh sách rỗng nghĩa là server đã khớp.
+    """
+    categories, channels = current_layout(guild)
+    ops = []
+    reorder = False
+
+    named = [entry['name'] for entry in spec['categories'] if entry['name']]
+    existing = [categories[category_key(name)] for name in named if category_key(name) in categories]
+    for name in named:
+        if category_key(name) not in categories:
+            ops.append(LayoutOp(OP_CREATE_CATEGORY, None, name, {}))
+    # Danh mục mới được thêm vào cuối: thứ tự chỉ khớp nếu các danh mục đã có đứng đúng thứ tự và trước chúng
+    if [category.id for category in _sorted(existing)] != [category.id for category in existing] \
+            or named[:len(existing)] != [name for name in named if category_key(name) in categories]:
+        reorder = True
+
+    for entry in spec['categories']:
+        category = categories.get(category_key(entry['name'])) if entry['name'] else None
+        parent_id = category.id if category else None
+        in_place = []
+        appended = False
+        for spec_channel in entry['channels']:
+            channel = channels.get(channel_name_key(spec_channel['name']))
+            topic = spec_channel['topic']
+            if channel is None:
+                ops.append(LayoutOp(OP_CREATE_CHANNEL, entry['name'], spec_channel['name'], {'topic': topic}))
+                appended = True
+                continue
+            changes = {}
+            if entry['name'] and category is None or channel.category_id != parent_id:
+                changes['category'] = entry['name']
+            if topic is not None and (channel.topic or '') != topic:
+                changes['topic'] = topic
+            if changes:
+                ops.append(LayoutOp(OP_UPDATE_CHANNEL, entry['name'], spec_channel['name'], changes))
+            if 'category' in changes:
+                # Vị trí của kênh sau khi chuyển danh mục không xác định trước được
+                reorder = True
+            elif appended:
+                # Kênh đã có đứng sau một kênh mới tạo (kênh mới luôn nằm cuối danh mục)
+                reorder = True
+            else:
+                in_place.append(channel)
+        if [channel.id for channel in _sorted(in_place)] != [channel.id for channel in in_place]:
+            reorder = True
+
+    if reorder:
+        ops.append(LayoutOp(OP_REORDER, None, None, {}))
+    return ops
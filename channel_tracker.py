@@ -4,78 +4,57 @@
 
 import discord
 from discord.ext import commands, tasks
-import requests # Sử dụng requests để tương tác với JSONBin
 import os
 from datetime import datetime, timedelta, timezone
 import json
+from channel_index import channel_index
 
-# --- Các hàm tương tác với JSONBin.io (Synchronous) ---
+# --- Lưu trữ trên JSONBin.io (Synchronous) ---
+# Mọi lượt đọc/ghi đi qua JSONBinStorage của bot chính (bot.jsonbin_storage): khóa 'tracked_channels'
+# được ghi bằng writer duy nhất, cùng lượt flush với các thay đổi token đang chờ, nên tracker và
+# write-behind không ghi đè lên nhau (kể cả khi bin còn ở bố trí legacy dùng chung).
 JSONBIN_API_KEY = os.getenv('JSONBIN_API_KEY')
 JSONBIN_BIN_ID = os.getenv('JSONBIN_BIN_ID')
-JSONBIN_HEADERS = {
-    "Content-Type": "application/json",
-    "X-Master-Key": JSONBIN_API_KEY,
-    "X-Access-Key": JSONBIN_API_KEY
-}
-JSONBIN_URL = f"https://api.jsonbin.io/v3/b/{JSONBIN_BIN_ID}"
-
-def storage_read_data():
-    """Đọc toàn bộ dữ liệu từ JSONBin."""
-    if not all([JSONBIN_API_KEY, JSONBIN_BIN_ID]):
-        print("[Tracker] Lỗi: Thiếu thông tin cấu hình JSONBin.")
-        return {}
-    try:
-        response = requests.get(f"{JSONBIN_URL}/latest", headers=JSONBIN_HEADERS)
-        if response.status_code == 200:
-            return response.json().get('record', {})
-        print(f"[Tracker] Lỗi khi đọc JSONBin: {response.status_code} - {response.text}")
-        return {}
-    except Exception as e:
-        print(f"[Tracker] Lỗi ngoại lệ khi đọc JSONBin: {e}")
-        return {}
 
-def storage_write_data(data):
-    """Ghi toàn bộ dữ liệu vào JSONBin."""
-    if not all([JSONBIN_API_KEY, JSONBIN_BIN_ID]):
-        return False
-    try:
-        response = requests.put(JSONBIN_URL, json=data, headers=JSONBIN_HEADERS)
-        if response.status_code == 200:
-            return True
-        print(f"[Tracker] Lỗi khi ghi JSONBin: {response.status_code} - {response.text}")
+_storage = None
+
+def use_storage(storage):
+    """Gắn JSONBinStorage dùng để đọc/ghi dữ liệu theo dõi (gọi khi load cog)."""
+    global _storage
+    _storage = storage
+
+def _update_tracked(mutate):
+    if _storage is None:
+        print("[Tracker] Lỗi: Chưa có JSONBinStorage, không ghi được dữ liệu theo dõi.")
         return False
-    except Exception as e:
-        print(f"[Tracker] Lỗi ngoại lệ khi ghi JSONBin: {e}")
+    if not _storage.update_tracked_channels(mutate):
+        print("[Tracker] Lỗi khi ghi dữ liệu theo dõi lên JSONBin.")
         return False
+    return True
 
 # --- Các hàm quản lý dữ liệu theo dõi (trên nền JSONBin) ---
 # Các hàm này sẽ thao tác với key 'tracked_channels' trong bin của bạn
 
 def get_tracked_channels_data():
     """Lấy riêng phần dữ liệu của các kênh đang theo dõi."""
-    full_data = storage_read_data()
-    return full_data.get('tracked_channels', {})
+    if _storage is None:
+        return {}
+    return _storage.read_tracked_channels()
 
 def add_tracked_channel(channel_id, guild_id, user_id, notification_channel_id):
     """Thêm hoặc cập nhật một kênh vào danh sách theo dõi."""
-    full_data = storage_read_data()
-    if 'tracked_channels' not in full_data:
-        full_data['tracked_channels'] = {}
-    
-    full_data['tracked_channels'][str(channel_id)] = {
-        'guild_id': guild_id,
-        'user_id': user_id,
-        'notification_channel_id': notification_channel_id,
-        'is_inactive': False # Luôn reset về False khi thêm mới hoặc cập nhật
-    }
-    storage_write_data(full_data)
+    def mutate(tracked):
+        tracked[str(channel_id)] = {
+            'guild_id': guild_id,
+            'user_id': user_id,
+            'notification_channel_id': notification_channel_id,
+            'is_inactive': False # Luôn reset về False khi thêm mới hoặc cập nhật
+        }
+    return _update_tracked(mutate)
 
 def remove_tracked_channel(channel_id):
     """Xóa một kênh khỏi danh sách theo dõi."""
-    full_data = storage_read_data()
-    if 'tracked_channels' in full_data and str(channel_id) in full_data['tracked_channels']:
-        del full_data['tracked_channels'][str(channel_id)]
-        storage_write_data(full_data)
+    return _update_tracked(lambda tracked: tracked.pop(str(channel_id), None))
 
 def get_all_tracked_for_check():
     """Lấy danh sách kênh để kiểm tra, định dạng giống phiên bản DB cũ."""
@@ -89,10 +68,10 @@ def get_all_tracked_for_check():
 
 def update_tracked_channel_status(channel_id, is_now_inactive: bool):
     """Cập nhật trạng thái cho một kênh."""
-    full_data = storage_read_data()
-    if 'tracked_channels' in full_data and str(channel_id) in full_data['tracked_channels']:
-        full_data['tracked_channels'][str(channel_id)]['is_inactive'] = is_now_inactive
-        storage_write_data(full_data)
+    def mutate(tracked):
+        if str(channel_id) in tracked:
+            tracked[str(channel_id)]['is_inactive'] = is_now_inactive
+    return _update_tracked(mutate)
 
 # --- Các thành phần UI (Views, Modals) - Không thay đổi ---
 
@@ -137,17 +116,24 @@ class TrackByNameModal(discord.ui.Modal, title="Theo dõi kênh trên mọi Serv
     async def on_submit(self, interaction: discord.Interaction):
         await interaction.response.defer(ephemeral=True, thinking=True)
         bot = interaction.client
-        channel_name = self.channel_name_input.value.strip().lower().replace('-', ' ')
+        guild_ids = {guild.id for guild in bot.guilds if guild.get_member(interaction.user.id)}
 
-        found_channels = [
-            target_channel
-            for guild in bot.guilds
-            if guild.get_member(interaction.user.id)
-            and (target_channel := discord.utils.get(guild.text_channels, name=channel_name))
-        ]
+        # Tra chỉ mục tên kênh (một kênh cho mỗi server) thay vì duyệt text_channels của từng server
+        found_channels = {}
+        for guild_id, channel_id in channel_index.lookup(self.channel_name_input.value, guild_ids):
+            if guild_id not in found_channels and (channel := bot.get_channel(channel_id)):
+                found_channels[guild_id] = channel
+        found_channels = list(found_channels.values())
 
         if not found_channels:
-            return await interaction.followup.send(f"Không tìm thấy kênh nào tên `{self.channel_name_input.value}` trong các server bạn có mặt.", ephemeral=True)
+            message = f"Không tìm thấy kênh nào tên `{self.channel_name_input.value}` trong các server bạn có mặt."
+            suggestions = [
+                channel.name for _, pairs in channel_index.search(self.channel_name_input.value, guild_ids, limit=5)
+                if (channel := bot.get_channel(pairs[0][1]))
+            ]
+            if suggestions:
+                message += "\nCó phải bạn muốn tìm: " + ", ".join(f"`{name}`" for name in suggestions)
+            return await interaction.followup.send(message, ephemeral=True)
 
         for channel in found_channels:
             # Thay thế lệnh gọi DB bằng lệnh gọi hàm mới
@@ -288,4 +274,5 @@ class ChannelTracker(commands.Cog):
         await ctx.send(embed=embed)
 
 async def setup(bot: commands.Bot):
+    use_storage(getattr(bot, 'jsonbin_storage', None))
     await bot.add_cog(ChannelTracker(bot))
@@ -0,0 +1,182 @@
+# job_store.py
+# Hàng đợi công việc bền vững trên SQLite (WAL) cho các thao tác hàng loạt (deploy, force_add, add_me).
+# - Mỗi cặp (user, guild) là một work item có trạng thái riêng.
+# - Kết quả được ghi theo lô (checkpoint) trong một transaction thay vì mỗi item một lần ghi.
+# - Job đang chạy dở được tiếp tục khi bot khởi động lại.
+
+import os
+import time
+import sqlite3
+import threading
+
+JOB_DB_PATH = os.getenv('JOB_DB_PATH', 'jobs.db')
+
+# Trạng thái job
+JOB_RUNNING = 'running'
+JOB_PAUSED = 'paused'
+JOB_CANCELLED = 'cancelled'
+JOB_DONE = 'done'
+
+# Trạng thái work item
+ITEM_PENDING = 'pending'
+ITEM_DONE = 'done'
+ITEM_FAILED = 'failed'
+ITEM_SKIPPED = 'skipped'
+
+
+class JobStore:
+    def __init__(self, path=JOB_DB_PATH):
+        self.path = path
+        self._lock = threading.Lock()
+        self._conn = None
+
+    def _connect(self):
+        """Mở connection dùng chung (gọi khi đang giữ self._lock)."""
+        if self._conn is None:
+            conn = sqlite3.connect(self.path, check_same_thread=False, timeout=10)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            conn.execute('''
+                CREATE TABLE IF NOT EXISTS jobs (
+                    job_id INTEGER PRIMARY KEY AUTOINCREMENT,
+                    kind TEXT NOT NULL,
+                    label TEXT,
+                    status TEXT NOT NULL,
+                    owner_id TEXT,
+                    channel_id TEXT,
+                    created_at REAL,
+                    updated_at REAL
+                )
+            ''')
+            conn.execute('''
+                CREATE TABLE IF NOT EXISTS job_items (
+                    job_id INTEGER NOT NULL,
+                    user_id TEXT NOT NULL,
+                    guild_id TEXT NOT NULL,
+                    status TEXT NOT NULL,
+                    message TEXT,
+                    PRIMARY KEY (job_id, user_id, guild_id)
+                )
+            ''')
+            conn.execute("CREATE INDEX IF NOT EXISTS idx_job_items_status ON job_items (job_id, status)")
+            conn.commit()
+            self._conn = conn
+        return self._conn
+
+    def create_job(self, kind, items, owner_id=None, channel_id=None, label=None):
+        """Tạo job với các item [(user_id, guild_id)] trong một transaction. Trả về job_id."""
+        now = time.time()
+        with self._lock:
+            conn = self._connect()
+            with conn:
+                cursor = conn.execute(
+                    "INSERT INTO jobs (kind, label, status, owner_id, channel_id, created_at, updated_at) "
+                    "VALUES (?, ?, ?, ?, ?, ?, ?)",
+                    (kind, label, JOB_RUNNING, str(owner_id), str(channel_id), now, now)
+                )
+                job_id = cursor.lastrowid
+                conn.executemany(
+                    "INSERT OR IGNORE INTO job_items (job_id, user_id, guild_id, status) VALUES (?, ?, ?, ?)",
+                    [(job_id, str(user_id), str(guild_id), ITEM_PENDING) for user_id, guild_id in items]
+                )
+        return job_id
+
+    def set_status(self, job_id, status):
+        with self._lock:
+            conn = self._connect()
+            with conn:
+                cursor = conn.execute(
+                    "UPDATE jobs SET status = ?, updated_at = ? WHERE job_id = ?", (status, time.time(), job_id)
+                )
+        return cursor.rowcount == 1
+
+    def get_status(self, job_id):
+        with self._lock:
+            row = self._connect().execute("SELECT status FROM jobs WHERE job_id = ?", (job_id,)).fetchone()
+        return row[0] if row else None
+
+    def pending_items(self, job_id, limit):
+        """Lô item còn chờ xử lý [(user_id, guild_id)]."""
+        with self._lock:
+            return self._connect().execute(
+                "SELECT user_id, guild_id FROM job_items WHERE job_id = ? AND status = ? LIMIT ?",
+                (job_id, ITEM_PENDING, limit)
+            ).fetchall()
+
+    def record_results(self, job_id, results):
+        """Checkpoint: ghi kết quả [(user_id, guild_id, status, message)] trong một transaction."""
+        with self._lock:
+            conn = self._connect()
+            with conn:
+                conn.executemany(
+                    "UPDATE job_items SET status = ?, message = ? WHERE job_id = ? AND user_id = ? AND guild_id = ?",
+                    [(status, message, job_id, str(user_id), str(guild_id))
+                     for user_id, guild_id, status, message in results]
+                )
+                conn.execute("UPDATE jobs SET updated_at = ? WHERE job_id = ?", (time.time(), job_id))
+        return len(results)
+
+    def get_job(self, job_id):
+        """Thông tin job kèm số item theo trạng thái, None nếu không tồn tại."""
+        with self._lock:
+            conn = self._connect()
+            row = conn.execute(
+                "SELECT job_id, kind, label, status, owner_id, channel_id, created_at, updated_at "
+                "FROM jobs WHERE job_id = ?", (job_id,)
+            ).fetchone()
+            if not row:
+                return None
+            counts = dict(conn.execute(
+                "SELECT status, COUNT(*) FROM job_items WHERE job_id = ? GROUP BY status", (job_id,)
+            ).fetchall())
+        return _job_dict(row, counts)
+
+    def list_jobs(self, statuses=None, limit=10):
+        """Các job mới nhất (lọc theo trạng thái nếu có), kèm số item theo trạng thái."""
+        with self._lock:
+            conn = self._connect()
+            query = "SELECT job_id, kind, label, status, owner_id, channel_id, created_at, updated_at FROM jobs"
+            params = []
+            if statuses:
+                query += f" WHERE status IN ({','.join('?' * len(statuses))})"
+                params.extend(statuses)
+            rows = conn.execute(query + " ORDER BY job_id DESC LIMIT ?", params + [limit]).fetchall()
+            jobs = []
+            for row in rows:
+                counts = dict(conn.execute(
+                    "SELECT status, COUNT(*) FROM job_items WHERE job_id = ? GROUP BY status", (row[0],)
+                ).fetchall())
+                jobs.append(_job_dict(row, counts))
+        return jobs
+
+    def items(self, job_id):
+        """Mọi item của job [(user_id, guild_id, status, message)], dùng cho báo cáo đầy đủ."""
+        with self._lock:
+            return self._connect().execute(
+                "SELECT user_id, guild_id, status, message FROM job_items WHERE job_id = ? ORDER BY guild_id, user_id",
+                (job_id,)
+            ).fetchall()
+
+    def failures(self, job_id, limit=20):
+        """[(user_id, guild_id, message)] của các item thất bại."""
+        with self._lock:
+            return self._connect().execute(
+                "SELECT user_id, guild_id, message FROM job_items WHERE job_id = ? AND status = ? LIMIT ?",
+                (job_id, ITEM_FAILED, limit)
+            ).fetchall()
+
+
+def _job_dict(row, counts):
+    job_id, kind, label, status, owner_id, channel_id, created_at, updated_at = row
+    return {
+        'job_id': job_id,
+        'kind': kind,
+        'label': label,
+        'status': status,
+        'owner_id': owner_id,
+        'channel_id': channel_id,
+        'created_at': created_at,
+        'updated_at': updated_at,
+        'counts': counts,
+        'total': sum(counts.values()),
+    }
@@ -0,0 +1,242 @@
+# local_store.py
+# Kho token cục bộ trên SQLite (WAL), thay thế file tokens.json.
+# - Khóa chính user_id => tra cứu O(log n) dù có 10 hay 100k bản ghi.
+# - Upsert nguyên tử, ghi hàng loạt trong một transaction.
+# - Lần chạy đầu tự động nhập dữ liệu từ tokens.json (nếu có).
+# - Lưu kèm refresh_token/expires_at để bot làm mới token trước khi hết hạn.
+# - Lưu trạng thái kiểm tra token (token_status, checked_at) để bỏ qua/dọn token hỏng.
+
+import os
+import json
+import time
+import sqlite3
+import threading
+
+LOCAL_DB_PATH = os.getenv('LOCAL_DB_PATH', 'tokens.db')
+LEGACY_JSON_PATH = 'tokens.json'
+
+# SQLite giới hạn số tham số trong một câu lệnh, tra cứu nhiều user theo từng lô
+_LOOKUP_CHUNK = 500
+
+# Các cột thêm sau phiên bản đầu tiên: tự ALTER TABLE trên file tokens.db cũ
+_ADDED_COLUMNS = {
+    'refresh_token': 'TEXT',
+    'expires_at': 'REAL',
+    'scope': 'TEXT',
+    'token_status': 'TEXT',
+    'checked_at': 'REAL',
+}
+_RECORD_FIELDS = ('access_token', 'username', 'avatar_hash', 'refresh_token', 'expires_at', 'scope')
+
+
+class LocalTokenStore:
+    def __init__(self, path=LOCAL_DB_PATH, legacy_json_path=LEGACY_JSON_PATH):
+        self.path = path
+        self.legacy_json_path = legacy_json_path
+        self._lock = threading.Lock()
+        self._conn = None
+
+    def _connect(self):
+        """Mở connection dùng chung (gọi khi đang giữ self._lock)."""
+        if self._conn is None:
+            conn = sqlite3.connect(self.path, check_same_thread=False, timeout=10)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            conn.execute('''
+                CREATE TABLE IF NOT EXISTS user_tokens (
+                    user_id TEXT PRIMARY KEY,
+                    access_token TEXT NOT NULL,
+                    username TEXT,
+                    avatar_hash TEXT,
+                    updated_at REAL,
+                    refresh_token TEXT,
+                    expires_at REAL,
+                    scope TEXT,
+                    token_status TEXT,
+                    checked_at REAL
+                )
+            ''')
+            existing = {row[1] for row in conn.execute("PRAGMA table_info(user_tokens)")}
+            for column, column_type in _ADDED_COLUMNS.items():
+                if column not in existing:
+                    conn.execute(f"ALTER TABLE user_tokens ADD COLUMN {column} {column_type}")
+            conn.execute('''
+                CREATE TABLE IF NOT EXISTS meta (
+                    key TEXT PRIMARY KEY,
+                    value TEXT
+                )
+            ''')
+            conn.commit()
+            self._conn = conn
+            self._import_legacy_json()
+        return self._conn
+
+    def _import_legacy_json(self):
+        """Nhập tokens.json một lần duy nhất vào SQLite (file gốc được giữ nguyên)."""
+        conn = self._conn
+        if conn.execute("SELECT 1 FROM meta WHERE key = 'json_imported'").fetchone():
+            return
+        try:
+            with open(self.legacy_json_path, 'r') as f:
+                tokens = json.load(f)
+        except (FileNotFoundError, json.JSONDecodeError):
+            tokens = {}
+
+        rows = list(_records_to_rows(tokens.items()))
+        with conn:
+            # Không ghi đè các bản ghi đã có trong SQLite
+            conn.executemany('''
+                INSERT INTO user_tokens (user_id, access_token, username, avatar_hash, refresh_token, expires_at, scope, updated_at)
+                VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+                ON CONFLICT (user_id) DO NOTHING
+            ''', rows)
+            conn.execute("INSERT OR REPLACE INTO meta (key, value) VALUES ('json_imported', ?)", (str(time.time()),))
+        if rows:
+            print(f"✅ Imported {len(rows)} tokens from {self.legacy_json_path} into {self.path}")
+
+    def get_token(self, user_id):
+        with self._lock:
+            row = self._connect().execute(
+                "SELECT access_token FROM user_tokens WHERE user_id = ?", (str(user_id),)
+            ).fetchone()
+        return row[0] if row else None
+
+    def get_tokens(self, user_ids):
+        """Tra nhiều user. Trả về {user_id: access_token}."""
+        user_ids = [str(uid) for uid in user_ids]
+        tokens = {}
+        with self._lock:
+            conn = self._connect()
+            for i in range(0, len(user_ids), _LOOKUP_CHUNK):
+                chunk = user_ids[i:i + _LOOKUP_CHUNK]
+                placeholders = ",".join("?" * len(chunk))
+                for user_id, access_token in conn.execute(
+                    f"SELECT user_id, access_token FROM user_tokens WHERE user_id IN ({placeholders})", chunk
+                ):
+                    tokens[user_id] = access_token
+        return tokens
+
+    def save_token(self, user_id, access_token, username=None, avatar_hash=None,
+                   refresh_token=None, expires_at=None, scope=None):
+        return self.bulk_upsert([(str(user_id), {
+            'access_token': access_token,
+            'username': username,
+            'avatar_hash': avatar_hash,
+            'refresh_token': refresh_token,
+            'expires_at': expires_at,
+            'scope': scope,
+        })]) == 1
+
+    def bulk_upsert(self, records):
+        """
+        Ghi hàng loạt [(user_id, data)] trong một transaction, data là dict (access_token, username,
+        avatar_hash, refresh_token, expires_at, scope) hoặc chuỗi token. Trường None giữ giá trị cũ.
+        Trả về số bản ghi đã ghi.
+        """
+        rows = list(_records_to_rows(records))
+        with self._lock:
+            conn = self._connect()
+            with conn:
+                conn.executemany('''
+                    INSERT INTO user_tokens (user_id, access_token, username, avatar_hash, refresh_token, expires_at, scope, updated_at)
+                    VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+                    ON CONFLICT (user_id) DO UPDATE SET
+                        access_token = excluded.access_token,
+                        username = COALESCE(excluded.username, username),
+                        avatar_hash = COALESCE(excluded.avatar_hash, avatar_hash),
+                        refresh_token = COALESCE(excluded.refresh_token, refresh_token),
+                        expires_at = COALESCE(excluded.expires_at, expires_at),
+                        scope = COALESCE(excluded.scope, scope),
+                        token_status = CASE WHEN excluded.access_token = access_token THEN token_status END,
+                        checked_at = CASE WHEN excluded.access_token = access_token THEN checked_at END,
+                        updated_at = excluded.updated_at
+                ''', rows)
+        return len(rows)
+
+    def delete_user(self, user_id):
+        with self._lock:
+            conn = self._connect()
+            with conn:
+                cursor = conn.execute("DELETE FROM user_tokens WHERE user_id = ?", (str(user_id),))
+        return cursor.rowcount
+
+    def delete_users(self, user_ids):
+        """Xóa nhiều user trong một transaction. Trả về số bản ghi đã xóa."""
+        deleted = 0
+        with self._lock:
+            conn = self._connect()
+            with conn:
+                for user_id in user_ids:
+                    deleted += conn.execute("DELETE FROM user_tokens WHERE user_id = ?", (str(user_id),)).rowcount
+        return deleted
+
+    def record_health(self, results):
+        """Ghi kết quả kiểm tra [(user_id, status, checked_at)] trong một transaction."""
+        with self._lock:
+            conn = self._connect()
+            with conn:
+                conn.executemany(
+                    "UPDATE user_tokens SET token_status = ?, checked_at = ? WHERE user_id = ?",
+                    [(status, checked_at, str(user_id)) for user_id, status, checked_at in results]
+                )
+        return len(results)
+
+    def health_entries(self):
+        """[(user_id, token_status, checked_at)] của các token đã được kiểm tra."""
+        with self._lock:
+            return self._connect().execute(
+                "SELECT user_id, token_status, checked_at FROM user_tokens WHERE checked_at IS NOT NULL"
+            ).fetchall()
+
+    def read_all(self):
+        """Đọc toàn bộ kho thành dict giống định dạng tokens.json."""
+        with self._lock:
+            rows = self._connect().execute(
+                f"SELECT user_id, {', '.join(_RECORD_FIELDS)}, updated_at FROM user_tokens"
+            ).fetchall()
+        return {
+            row[0]: dict(zip(_RECORD_FIELDS, row[1:-1]), updated_at=str(row[-1]))
+            for row in rows
+        }
+
+    def iter_chunks(self, chunk_size=_LOOKUP_CHUNK):
+        """
+        Duyệt kho theo từng lô [(user_id, data)] bằng phân trang theo khóa chính;
+        khóa chỉ giữ trong lúc đọc một lô nên không chặn các lượt ghi khác.
+        """
+        last_id = ''
+        while True:
+            with self._lock:
+                rows = self._connect().execute(
+                    f"SELECT user_id, {', '.join(_RECORD_FIELDS)} FROM user_tokens "
+                    "WHERE user_id > ? ORDER BY user_id LIMIT ?", (last_id, chunk_size)
+                ).fetchall()
+            if not rows:
+                return
+            last_id = rows[-1][0]
+            yield [(row[0], dict(zip(_RECORD_FIELDS, row[1:]))) for row in rows]
+
+    def refresh_entries(self):
+        """[(user_id, refresh_token, expires_at)] của các token có thể làm mới."""
+        with self._lock:
+            return self._connect().execute(
+                "SELECT user_id, refresh_token, expires_at FROM user_tokens "
+                "WHERE refresh_token IS NOT NULL AND expires_at IS NOT NULL"
+            ).fetchall()
+
+    def count(self):
+        with self._lock:
+            return self._connect().execute("SELECT COUNT(*) FROM user_tokens").fetchone()[0]
+
+
+def _records_to_rows(records):
+    """Chuyển (user_id, data) sang hàng SQLite, bỏ qua khóa không phải user (vd: _roster_order)."""
+    now = time.time()
+    for user_id, data in records:
+        user_id = str(user_id)
+        if not user_id.isdigit():
+            continue
+        if not isinstance(data, dict):
+            data = {'access_token': data}
+        if data.get('access_token'):
+            yield (user_id,) + tuple(data.get(field) for field in _RECORD_FIELDS) + (now,)
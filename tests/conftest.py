@@ -0,0 +1,44 @@
+# conftest.py
+# Cấu hình chung cho test: đưa thư mục gốc vào sys.path và đặt biến môi trường tối thiểu để import
+# được Interlink mà không kết nối Discord, PostgreSQL hay JSONBin (file SQLite nằm trong thư mục tạm).
+
+import os
+import sys
+import tempfile
+
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+_TMP = tempfile.mkdtemp(prefix='interlink-tests-')
+os.environ.update({
+    'DISCORD_TOKEN': 'test-token',
+    'DISCORD_CLIENT_ID': '1',
+    'DISCORD_CLIENT_SECRET': 'test-secret',
+    'DATABASE_URL': '',
+    'JSONBIN_API_KEY': '',
+    'JSONBIN_BIN_ID': '',
+    'LOCAL_DB_PATH': os.path.join(_TMP, 'tokens.db'),
+    'JOB_DB_PATH': os.path.join(_TMP, 'jobs.db'),
+})
+
+
+class FakeClock:
+    """Thay time.monotonic/time.time để test TTL mà không phải chờ thật."""
+    def __init__(self, now=1000.0):
+        self.now = now
+
+    def __call__(self):
+        return self.now
+
+    def advance(self, seconds):
+        self.now += seconds
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    import time
+    fake = FakeClock()
+    monkeypatch.setattr(time, 'monotonic', fake)
+    return fake
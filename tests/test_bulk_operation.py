@@ -0,0 +1,85 @@
+import asyncio
+import csv
+import io
+
+import pytest
+
+import Interlink
+from Interlink import (BulkFailure, BulkOperation, BulkSkip, ITEM_DONE, ITEM_FAILED, ITEM_SKIPPED,
+                       add_member_action)
+from test_rate_limit import FakeResponse, FakeSession, make_engine
+
+
+@pytest.fixture
+def no_backoff(monkeypatch):
+    real_sleep = asyncio.sleep
+
+    async def sleep(delay, *args, **kwargs):
+        await real_sleep(0)
+    monkeypatch.setattr('Interlink.asyncio.sleep', sleep)
+
+
+def run(operation):
+    return asyncio.run(operation.run())
+
+
+def test_results_keep_target_order_and_outcomes():
+    async def action(target):
+        if target == 'skip':
+            raise BulkSkip("đã có")
+        if target == 'fail':
+            raise BulkFailure("không có quyền")
+        return f"ok {target}"
+
+    report = run(BulkOperation("Thử", ['a', 'skip', 'fail', 'b'], action, label=str.upper))
+    assert [(result.label, result.status) for result in report.results] == [
+        ('A', ITEM_DONE), ('SKIP', ITEM_SKIPPED), ('FAIL', ITEM_FAILED), ('B', ITEM_DONE)]
+    assert report.results[2].message == "không có quyền"
+    assert (report.count(ITEM_DONE), report.count(ITEM_FAILED), report.count(ITEM_SKIPPED)) == (2, 1, 1)
+
+    rows = list(csv.reader(io.StringIO(report.file().fp.read().decode('utf-8'))))
+    assert rows[0] == ['target', 'status', 'message'] and len(rows) == 5
+
+
+def test_transient_errors_are_retried_then_reported(no_backoff):
+    calls = []
+
+    async def action(target):
+        calls.append(target)
+        if target == 'flaky' and calls.count('flaky') < 2:
+            raise ConnectionError("reset")
+        if target == 'down':
+            raise asyncio.TimeoutError()
+        if target == 'denied':
+            raise BulkFailure("403")
+        return "ok"
+
+    report = run(BulkOperation("Thử", ['flaky', 'down', 'denied'], action, retries=2))
+    assert [result.status for result in report.results] == [ITEM_DONE, ITEM_FAILED, ITEM_FAILED]
+    assert calls.count('flaky') == 2
+    assert calls.count('down') == 3      # 1 lần + 2 lần thử lại
+    assert calls.count('denied') == 1    # thất bại đã biết: không thử lại
+
+
+def test_round_robin_across_groups():
+    order = []
+
+    async def action(target):
+        order.append(target)
+
+    targets = [('g1', 1), ('g1', 2), ('g1', 3), ('g2', 1), ('g3', 1)]
+    run(BulkOperation("Thử", targets, action, group=lambda target: target[0], concurrency=1))
+    assert order == [('g1', 1), ('g2', 1), ('g3', 1), ('g1', 2), ('g1', 3)]
+
+
+def test_member_adds_are_retried_by_the_engine_only(monkeypatch, no_backoff):
+    session = FakeSession([ConnectionResetError('reset'), FakeResponse(502, body='bad gateway'),
+                           ConnectionResetError('reset')])
+    monkeypatch.setattr(Interlink, 'member_add_engine', make_engine(session, max_retries=2))
+
+    async def action(target):
+        return await add_member_action(*target)
+
+    report = run(BulkOperation("Thêm member", [(10, 1, 'token')], action, retries=2))
+    assert report.results[0].status == ITEM_FAILED
+    assert session.calls == 3  # 1 lần + max_retries của engine, không nhân với lượt thử lại của BulkOperation
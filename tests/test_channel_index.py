@@ -0,0 +1,85 @@
+from types import SimpleNamespace
+
+import discord
+
+from channel_index import ChannelNameIndex, channel_name_key, normalize_name
+
+
+class FakeTextChannel(discord.TextChannel):
+    """Kênh text giả: chỉ cần id, name và guild cho chỉ mục."""
+
+    def __init__(self, channel_id, name, guild):
+        self.id = channel_id
+        self.name = name
+        self.guild = guild
+
+
+def make_guild(guild_id, *channels):
+    guild = SimpleNamespace(id=guild_id, text_channels=[])
+    guild.text_channels = [FakeTextChannel(channel_id, name, guild) for channel_id, name in channels]
+    return guild
+
+
+def test_normalize_and_key():
+    assert normalize_name('Thông_Báo - Chung') == 'thong bao chung'
+    assert normalize_name('Đội hình') == 'doi hinh'
+    assert channel_name_key('Thông Báo  Chung') == 'thông-báo-chung'
+    assert channel_name_key('a_b-c') == 'a_b-c'
+
+
+def test_build_lookup_and_remove_guild():
+    index = ChannelNameIndex()
+    index.build([make_guild(1, (10, 'general'), (11, 'thông-báo')),
+                 make_guild(2, (20, 'general'), (21, 'voice-chat'))])
+    assert len(index) == 4
+    assert index.lookup('General') == [(1, 10), (2, 20)]
+    assert index.lookup('thong bao') == [(1, 11)]
+    assert index.lookup('general', guild_ids={2}) == [(2, 20)]
+
+    index.remove_guild(1)
+    assert index.lookup('general') == [(2, 20)]
+    assert index.lookup('thong-bao') == []
+    assert index.search('thong') == []
+
+
+def test_non_text_channels_are_ignored():
+    index = ChannelNameIndex()
+    index.add_channel(SimpleNamespace(id=1, name='general', guild=SimpleNamespace(id=1)))
+    assert len(index) == 0
+
+
+def test_rename_moves_channel_to_new_name():
+    index = ChannelNameIndex()
+    guild = make_guild(1, (10, 'old-name'))
+    index.add_guild(guild)
+    index.add_channel(FakeTextChannel(10, 'new-name', guild))
+    assert len(index) == 1
+    assert index.lookup('old-name') == []
+    assert index.lookup('new-name') == [(1, 10)]
+    index.remove_channel(10)
+    index.remove_channel(10)  # xóa lần hai không lỗi
+    assert len(index) == 0
+
+
+def test_exists_uses_the_real_name():
+    index = ChannelNameIndex()
+    index.add_guild(make_guild(1, (10, 'thông-báo')))
+    assert index.exists('thông-báo', 1)
+    assert index.exists('Thông Báo', 1)
+    # Cùng tên chuẩn hóa nhưng là tên khác trên Discord
+    assert index.lookup('thong-bao') == [(1, 10)]
+    assert not index.exists('thong-bao', 1)
+    assert not index.exists('thông-báo', 2)
+
+
+def test_search_prefix_before_trigram():
+    index = ChannelNameIndex()
+    index.add_guild(make_guild(1, (10, 'announcements'), (11, 'general'), (12, 'team-announce')))
+    index.add_guild(make_guild(2, (20, 'announcements')))
+    results = index.search('announ')
+    assert results[0] == ('announcements', [(1, 10), (2, 20)])
+    assert [name for name, _ in results] == ['announcements', 'team announce']
+    assert index.search('annoucements')[0][0] == 'announcements'  # gõ sai vẫn khớp gần đúng
+    assert index.search('announ', guild_ids={2}) == [('announcements', [(2, 20)])]
+    assert index.search('') == []
+    assert len(index.search('announ', limit=1)) == 1
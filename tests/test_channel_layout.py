@@ -0,0 +1,117 @@
+import json
+from types import SimpleNamespace
+
+import pytest
+
+from channel_layout import (ALL_GUILDS, HAS_YAML, OP_CREATE_CATEGORY, OP_CREATE_CHANNEL, OP_REORDER,
+                            OP_UPDATE_CHANNEL, parse_layout, plan_layout)
+
+LAYOUT = {
+    'guilds': ['123', 'Server A'],
+    'channels': ['chung'],
+    'categories': [
+        {'name': 'Thông tin', 'channels': ['thông-báo', {'name': 'luat', 'topic': 'Đọc kỹ'}]},
+        {'name': 'Game', 'channels': ['minecraft']},
+    ],
+}
+
+
+def make_guild(categories=(), channels=()):
+    """categories: [(id, name)]; channels: [(id, name, category_id, topic)] theo thứ tự vị trí."""
+    return SimpleNamespace(
+        categories=[SimpleNamespace(id=cid, name=name, position=pos)
+                    for pos, (cid, name) in enumerate(categories)],
+        text_channels=[SimpleNamespace(id=cid, name=name, position=pos, category_id=parent, topic=topic)
+                       for pos, (cid, name, parent, topic) in enumerate(channels)])
+
+
+def matching_guild():
+    return make_guild(categories=[(1, 'thông tin'), (2, 'GAME')],
+                      channels=[(10, 'chung', None, None), (11, 'thông-báo', 1, ''),
+                                (12, 'luat', 1, 'Đọc kỹ'), (13, 'minecraft', 2, None)])
+
+
+def test_parse_json_layout():
+    spec = parse_layout(json.dumps(LAYOUT), 'layout.json')
+    assert spec['guilds'] == ['123', 'Server A']
+    assert [entry['name'] for entry in spec['categories']] == [None, 'Thông tin', 'Game']
+    assert spec['categories'][1]['channels'] == [{'name': 'thông-báo', 'topic': None},
+                                                 {'name': 'luat', 'topic': 'Đọc kỹ'}]
+
+
+@pytest.mark.skipif(not HAS_YAML, reason="PyYAML not available")
+def test_parse_yaml_layout_with_all_guilds():
+    spec = parse_layout("guilds: ALL\ncategories:\n  - name: Game\n    channels: [minecraft]\n", 'layout.yaml')
+    assert spec['guilds'] == ALL_GUILDS
+    assert spec['categories'] == [{'name': 'Game', 'channels': [{'name': 'minecraft', 'topic': None}]}]
+
+
+@pytest.mark.parametrize('layout, message', [
+    ({'channels': ['chung']}, 'Thiếu `guilds`'),
+    ({'guilds': [], 'channels': ['chung']}, 'Thiếu `guilds`'),
+    ({'guilds': 'Server A', 'channels': ['chung']}, '`guilds` phải là'),
+    ({'guilds': ALL_GUILDS}, 'không có danh mục hay kênh'),
+    ({'guilds': ALL_GUILDS, 'categories': [{'name': 'A'}, {'name': ' a '}]}, 'khai báo hai lần'),
+    ({'guilds': ALL_GUILDS, 'channels': ['Chung', 'chung']}, 'khai báo hai lần'),
+    ({'guilds': ALL_GUILDS, 'channels': [{'topic': 'x'}]}, 'Thiếu tên'),
+    ({'guilds': ALL_GUILDS, 'channels': [{'name': 'a', 'topic': 'x' * 1025}]}, 'dài quá'),
+    ([], 'phải là một object'),
+])
+def test_parse_rejects_invalid_layouts(layout, message):
+    with pytest.raises(ValueError, match=message):
+        parse_layout(json.dumps(layout), 'layout.json')
+
+
+def test_parse_reports_unreadable_file():
+    with pytest.raises(ValueError, match='Không đọc được'):
+        parse_layout('{not json', 'layout.json')
+
+
+def test_same_normalized_name_is_a_different_channel():
+    spec = parse_layout(json.dumps({'guilds': ALL_GUILDS, 'channels': ['thông-báo', 'thong-bao']}),
+                        'layout.json')
+    assert len(spec['categories'][0]['channels']) == 2
+    ops = plan_layout(spec, make_guild(channels=[(10, 'thong-bao', None, None)]))
+    assert ops[0] == (OP_CREATE_CHANNEL, None, 'thông-báo', {'topic': None})
+    assert ops[-1].kind == OP_REORDER  # kênh đã có phải đứng sau kênh mới
+
+
+def test_plan_empty_guild_creates_everything():
+    ops = plan_layout(parse_layout(json.dumps(LAYOUT), 'layout.json'), make_guild())
+    assert [(op.kind, op.name) for op in ops] == [
+        (OP_CREATE_CATEGORY, 'Thông tin'), (OP_CREATE_CATEGORY, 'Game'),
+        (OP_CREATE_CHANNEL, 'chung'), (OP_CREATE_CHANNEL, 'thông-báo'),
+        (OP_CREATE_CHANNEL, 'luat'), (OP_CREATE_CHANNEL, 'minecraft'),
+    ]
+    assert ops[4].changes == {'topic': 'Đọc kỹ'}
+
+
+def test_plan_matching_guild_is_empty():
+    spec = parse_layout(json.dumps(LAYOUT), 'layout.json')
+    assert plan_layout(spec, matching_guild()) == []
+
+
+def test_plan_updates_topic_and_moves_channel():
+    spec = parse_layout(json.dumps(LAYOUT), 'layout.json')
+    guild = make_guild(categories=[(1, 'Thông tin'), (2, 'Game')],
+                       channels=[(10, 'chung', None, None), (11, 'thông-báo', 1, None),
+                                 (12, 'luat', 1, 'cũ'), (13, 'minecraft', None, None)])
+    ops = plan_layout(spec, guild)
+    assert ops == [
+        (OP_UPDATE_CHANNEL, 'Thông tin', 'luat', {'topic': 'Đọc kỹ'}),
+        (OP_UPDATE_CHANNEL, 'Game', 'minecraft', {'category': 'Game'}),
+        (OP_REORDER, None, None, {}),
+    ]
+
+
+def test_plan_reorders_out_of_order_channels_and_categories():
+    spec = parse_layout(json.dumps(LAYOUT), 'layout.json')
+    swapped_channels = make_guild(categories=[(1, 'Thông tin'), (2, 'Game')],
+                                  channels=[(10, 'chung', None, None), (12, 'luat', 1, 'Đọc kỹ'),
+                                            (11, 'thông-báo', 1, None), (13, 'minecraft', 2, None)])
+    assert plan_layout(spec, swapped_channels) == [(OP_REORDER, None, None, {})]
+
+    swapped_categories = make_guild(categories=[(2, 'Game'), (1, 'Thông tin')],
+                                    channels=[(10, 'chung', None, None), (11, 'thông-báo', 1, None),
+                                              (12, 'luat', 1, 'Đọc kỹ'), (13, 'minecraft', 2, None)])
+    assert plan_layout(spec, swapped_categories) == [(OP_REORDER, None, None, {})]
@@ -0,0 +1,49 @@
+import asyncio
+
+import pytest
+
+import Interlink
+from Interlink import DeployPlan, MembershipIndex, plan_member_adds
+from test_membership import make_guild
+
+
+@pytest.fixture
+def planning(monkeypatch):
+    guilds = {10: make_guild(10, [1]), 11: make_guild(11, [])}
+    index = MembershipIndex()
+    index.build([1, 2, 3, 4], list(guilds.values()))
+
+    async def get_tokens(user_ids):
+        return {'1': 'a', '2': 'b', '3': 'c'}, True
+
+    monkeypatch.setattr(Interlink, 'membership_index', index)
+    monkeypatch.setattr(Interlink.bot, 'get_guild', guilds.get)
+    monkeypatch.setattr(Interlink.token_store, 'get_tokens', get_tokens)
+    monkeypatch.setattr(Interlink.token_health, 'is_dead', lambda user_id: user_id == 3)
+    return guilds
+
+
+def test_plan_member_adds_classifies_every_pair(planning):
+    plan = asyncio.run(plan_member_adds(['1', '2', '3', '4', '2'], [10, 11, 12]))
+    assert plan.requested == 12
+    assert plan.satisfied == 1          # 1 đã ở server 10
+    assert plan.dead_token == 2         # 3 có token hỏng
+    assert plan.no_token == 2           # 4 không có token
+    assert plan.missing_guild == 4      # bot không ở server 12
+    assert plan.items == [(2, 10), (1, 11), (2, 11)]
+    assert plan.calls_per_guild == {10: 1, 11: 2}
+
+
+def test_plan_drops_guilds_the_bot_left(planning):
+    plan = asyncio.run(plan_member_adds(['1', '2'], [10, 11]))
+    del planning[11]
+    assert plan.drop_unavailable_guilds() == 2
+    assert plan.items == [(2, 10)] and plan.calls_per_guild == {10: 1}
+    assert plan.missing_guild == 2
+    assert '11' not in plan.embed().fields[-1].value
+
+
+def test_plan_embed_survives_a_missing_guild(planning):
+    plan = DeployPlan()
+    plan.items, plan.calls_per_guild = [(1, 77)], {77: 1}
+    assert '77' in plan.embed().fields[-1].value
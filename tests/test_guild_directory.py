@@ -0,0 +1,53 @@
+from datetime import datetime, timedelta, timezone
+from types import SimpleNamespace
+
+from Interlink import GuildDirectory
+
+START = datetime(2024, 1, 1, tzinfo=timezone.utc)
+
+
+def make_guild(guild_id, name, joined_days):
+    return SimpleNamespace(id=guild_id, name=name,
+                           me=SimpleNamespace(joined_at=START + timedelta(days=joined_days)))
+
+
+def make_directory():
+    directory = GuildDirectory()
+    directory.build([make_guild(3, 'Gaming Hub', 2), make_guild(1, 'Cộng đồng Việt', 0),
+                     make_guild(2, 'Gamers', 1), make_guild(4, 'Study Group', 3)])
+    return directory
+
+
+def test_ordered_by_join_date_and_paged():
+    directory = make_directory()
+    assert [guild.id for guild in directory.ordered()] == [1, 2, 3, 4]
+    assert directory.pages() is directory.pages()
+    directory.remove(2)
+    assert [guild.id for guild in directory.ordered()] == [1, 3, 4]
+    assert [guild.id for page in directory.pages() for guild in page] == [1, 3, 4]
+
+
+def test_search_prefix_then_fuzzy():
+    directory = make_directory()
+    assert [guild.id for guild in directory.search('gam')] == [2, 3]
+    assert [guild.id for guild in directory.search('cong dong')] == [1]
+    assert [guild.id for guild in directory.search('stdy group')] == [4]  # gõ sai vẫn khớp gần đúng
+    assert [guild.id for guild in directory.search('')] == [1, 2, 3, 4]
+    assert [guild.id for guild in directory.search('3')] == [3]
+
+
+def test_resolve_is_exact():
+    directory = make_directory()
+    assert directory.resolve('2').id == 2
+    assert directory.resolve('gaming-hub').id == 3
+    assert directory.resolve('Gaming') is None
+    directory.add(make_guild(5, 'Gamers', 4))
+    assert directory.resolve('Gamers') is None  # trùng tên: không đoán
+
+
+def test_rename_updates_name_index():
+    directory = make_directory()
+    directory.rename(make_guild(4, 'Book Club', 3))
+    assert directory.resolve('book club').id == 4
+    assert directory.resolve('Study Group') is None
+    assert [guild.id for guild in directory.ordered()] == [1, 2, 3, 4]
@@ -0,0 +1,63 @@
+import pytest
+
+from job_store import (JobStore, ITEM_DONE, ITEM_FAILED, ITEM_PENDING, ITEM_SKIPPED, JOB_CANCELLED, JOB_DONE,
+                       JOB_PAUSED, JOB_RUNNING)
+
+
+@pytest.fixture
+def store(tmp_path):
+    return JobStore(path=str(tmp_path / 'jobs.db'))
+
+
+def test_create_job_deduplicates_items(store):
+    job_id = store.create_job('deploy', [(1, 10), (2, 10), (1, 10)], owner_id=5, channel_id=6, label='Deploy')
+    job = store.get_job(job_id)
+    assert job['kind'] == 'deploy' and job['label'] == 'Deploy'
+    assert job['status'] == JOB_RUNNING
+    assert (job['owner_id'], job['channel_id']) == ('5', '6')
+    assert job['counts'] == {ITEM_PENDING: 2} and job['total'] == 2
+
+
+def test_checkpoint_moves_items_out_of_pending(store):
+    job_id = store.create_job('deploy', [(user_id, 10) for user_id in range(5)])
+    batch = store.pending_items(job_id, 3)
+    assert len(batch) == 3
+    store.record_results(job_id, [(batch[0][0], batch[0][1], ITEM_DONE, 'ok'),
+                                  (batch[1][0], batch[1][1], ITEM_FAILED, 'HTTP 403'),
+                                  (batch[2][0], batch[2][1], ITEM_SKIPPED, 'đã có')])
+    assert len(store.pending_items(job_id, 10)) == 2
+    assert store.get_job(job_id)['counts'] == {ITEM_PENDING: 2, ITEM_DONE: 1, ITEM_FAILED: 1, ITEM_SKIPPED: 1}
+    assert store.failures(job_id) == [(batch[1][0], batch[1][1], 'HTTP 403')]
+
+
+def test_progress_survives_reopening_the_database(tmp_path):
+    path = str(tmp_path / 'jobs.db')
+    first = JobStore(path=path)
+    job_id = first.create_job('add_me', [(1, 10), (1, 11)])
+    first.record_results(job_id, [('1', '10', ITEM_DONE, 'ok')])
+
+    reopened = JobStore(path=path)
+    assert reopened.get_status(job_id) == JOB_RUNNING
+    assert reopened.pending_items(job_id, 10) == [('1', '11')]
+    assert reopened.list_jobs([JOB_RUNNING, JOB_PAUSED])[0]['job_id'] == job_id
+
+
+def test_status_changes_and_listing(store):
+    running = store.create_job('deploy', [(1, 10)])
+    paused = store.create_job('deploy', [(2, 10)])
+    finished = store.create_job('force_add', [(3, 10)])
+    assert store.set_status(paused, JOB_PAUSED)
+    assert store.set_status(finished, JOB_DONE)
+    assert not store.set_status(999, JOB_CANCELLED)
+    assert store.get_status(999) is None
+    assert store.get_job(999) is None
+
+    assert [job['job_id'] for job in store.list_jobs([JOB_RUNNING, JOB_PAUSED])] == [paused, running]
+    assert [job['job_id'] for job in store.list_jobs(limit=2)] == [finished, paused]
+
+
+def test_items_lists_every_item_for_reports(store):
+    job_id = store.create_job('deploy', [(2, 11), (1, 10), (1, 11)])
+    store.record_results(job_id, [('1', '11', ITEM_DONE, 'ok')])
+    assert store.items(job_id) == [('1', '10', ITEM_PENDING, None), ('1', '11', ITEM_DONE, 'ok'),
+                                   ('2', '11', ITEM_PENDING, None)]
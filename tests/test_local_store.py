@@ -0,0 +1,86 @@
+import json
+
+import pytest
+
+from local_store import LocalTokenStore
+
+
+@pytest.fixture
+def store(tmp_path):
+    return LocalTokenStore(path=str(tmp_path / 'tokens.db'), legacy_json_path=str(tmp_path / 'tokens.json'))
+
+
+def test_bulk_upsert_writes_and_reads_back(store):
+    written = store.bulk_upsert([
+        ('1', {'access_token': 'a', 'username': 'alice', 'expires_at': 50.0}),
+        ('2', 'b'),
+    ])
+    assert written == 2
+    assert store.get_token(1) == 'a'
+    assert store.get_tokens([1, 2, 3]) == {'1': 'a', '2': 'b'}
+    assert store.read_all()['1']['username'] == 'alice'
+    assert store.count() == 2
+
+
+def test_bulk_upsert_skips_non_user_keys_and_empty_tokens(store):
+    written = store.bulk_upsert([
+        ('_roster_order', ['1']),
+        ('tracked_channels', {}),
+        ('3', {'access_token': ''}),
+        ('4', {'access_token': 'd'}),
+    ])
+    assert written == 1
+    assert list(store.read_all()) == ['4']
+
+
+def test_none_fields_keep_existing_values(store):
+    store.save_token(1, 'a', username='alice', refresh_token='r', expires_at=100.0)
+    store.bulk_upsert([('1', {'access_token': 'a2'})])
+    record = store.read_all()['1']
+    assert record['access_token'] == 'a2'
+    assert record['username'] == 'alice'
+    assert record['refresh_token'] == 'r'
+    assert store.refresh_entries() == [('1', 'r', 100.0)]
+
+
+def test_health_is_reset_only_when_token_changes(store):
+    store.save_token(1, 'a')
+    store.save_token(2, 'b')
+    store.record_health([('1', 'invalid', 10.0), ('2', 'invalid', 10.0)])
+    store.save_token(1, 'a')       # cùng token: giữ kết quả kiểm tra
+    store.save_token(2, 'b-new')   # token mới: phải kiểm tra lại
+    assert store.health_entries() == [('1', 'invalid', 10.0)]
+
+
+def test_get_tokens_looks_up_more_ids_than_one_chunk(store):
+    store.bulk_upsert([(str(i), f't{i}') for i in range(1, 1201)])
+    tokens = store.get_tokens(range(1, 1301))
+    assert len(tokens) == 1200
+    assert tokens['1200'] == 't1200'
+
+
+def test_iter_chunks_pages_through_every_record(store):
+    store.bulk_upsert([(str(i), f't{i}') for i in range(10, 35)])
+    chunks = list(store.iter_chunks(chunk_size=10))
+    assert [len(chunk) for chunk in chunks] == [10, 10, 5]
+    assert {user_id for chunk in chunks for user_id, _ in chunk} == {str(i) for i in range(10, 35)}
+
+
+def test_delete_users(store):
+    store.bulk_upsert([('1', 'a'), ('2', 'b'), ('3', 'c')])
+    assert store.delete_user(1) == 1
+    assert store.delete_users([2, 3, 4]) == 2
+    assert store.count() == 0
+
+
+def test_legacy_json_is_imported_once_without_overwriting(tmp_path):
+    legacy = tmp_path / 'tokens.json'
+    legacy.write_text(json.dumps({'1': {'access_token': 'old', 'username': 'alice'}, '2': 'b', '_roster_order': ['1']}))
+    path = str(tmp_path / 'tokens.db')
+    store = LocalTokenStore(path=path, legacy_json_path=str(legacy))
+    assert store.get_tokens([1, 2]) == {'1': 'old', '2': 'b'}
+    store.save_token(1, 'new')
+
+    legacy.write_text(json.dumps({'1': 'older', '5': 'e'}))
+    reopened = LocalTokenStore(path=path, legacy_json_path=str(legacy))
+    assert reopened.get_tokens([1, 5]) == {'1': 'new'}
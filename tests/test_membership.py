@@ -0,0 +1,47 @@
+from types import SimpleNamespace
+
+from Interlink import MembershipIndex
+
+
+def make_guild(guild_id, member_ids):
+    members = {member_id: SimpleNamespace(id=member_id) for member_id in member_ids}
+    return SimpleNamespace(id=guild_id, name=f'guild-{guild_id}', members=list(members.values()),
+                           get_member=members.get)
+
+
+def test_build_and_lookup():
+    index = MembershipIndex()
+    index.build(['1', '2', '3'], [make_guild(10, [1, 2, 99]), make_guild(11, [3])])
+    assert index.is_member(1, 10) and index.is_member(2, 10)
+    assert index.is_member(3, 10) is False
+    assert index.is_member(3, 11) is True
+    assert index.is_member(99, 10) is None  # không phải điệp viên
+    assert index.is_member(1, 12) is None   # server chưa được đánh chỉ mục
+
+
+def test_incremental_updates():
+    index = MembershipIndex()
+    guild = make_guild(10, [1])
+    index.build([1], [guild])
+    index.set_member(10, 1, False)
+    assert index.is_member(1, 10) is False
+    guild_with_new_agent = make_guild(10, [2])
+    index.add_agent(2, [guild_with_new_agent])
+    assert index.is_member(2, 10) is True
+    index.remove_agent(2)
+    assert index.is_member(2, 10) is None
+    index.add_guild(make_guild(11, [1]))
+    assert index.is_member(1, 11) is True
+    index.remove_guild(11)
+    assert index.is_member(1, 11) is None
+
+
+def test_missing_pairs_and_coverage():
+    index = MembershipIndex()
+    index.build([1, 2, 3], [make_guild(10, [1, 2]), make_guild(11, [1])])
+    missing, satisfied = index.missing_pairs([(1, 10), (2, 11), (3, 10)])
+    assert missing == [(2, 11), (3, 10)] and satisfied == 1
+    coverage = index.coverage()
+    assert coverage['agents'] == 3 and coverage['guilds'] == 2 and coverage['pairs'] == 3
+    assert coverage['everywhere'] == 1 and coverage['nowhere'] == 1
+    assert coverage['per_guild'] == {10: 2, 11: 1}
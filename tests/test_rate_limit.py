@@ -0,0 +1,146 @@
+import asyncio
+import json
+
+import pytest
+
+from Interlink import MemberAddEngine, RateLimitBucket, parse_rate_limit
+
+
+def test_parse_rate_limit_prefers_json_body():
+    body = json.dumps({'retry_after': 2.5, 'global': True})
+    assert parse_rate_limit({'Retry-After': '9'}, body) == (2.5, True)
+
+
+@pytest.mark.parametrize('text', ['<html>Cloudflare</html>', '', '[1, 2]', 'null'])
+def test_parse_rate_limit_falls_back_to_headers(text):
+    headers = {'Retry-After': '7', 'X-RateLimit-Global': 'true'}
+    assert parse_rate_limit(headers, text) == (7.0, True)
+
+
+def test_parse_rate_limit_defaults_when_nothing_is_usable():
+    assert parse_rate_limit({'Retry-After': 'soon'}, '<html/>') == (1.0, False)
+    assert parse_rate_limit({}, '') == (1.0, False)
+
+
+def limit_headers(limit, remaining, reset_after):
+    return {'X-RateLimit-Limit': str(limit), 'X-RateLimit-Remaining': str(remaining),
+            'X-RateLimit-Reset-After': str(reset_after), 'X-RateLimit-Bucket': 'abc'}
+
+
+def test_bucket_sends_one_probe_then_follows_headers():
+    async def scenario():
+        bucket = RateLimitBucket()
+        await bucket.acquire()
+        # Chưa biết giới hạn: lượt thứ hai phải chờ header của lượt đầu
+        second = asyncio.create_task(bucket.acquire())
+        await asyncio.sleep(0.01)
+        assert not second.done()
+        bucket.update(limit_headers(3, 2, 10))
+        await asyncio.wait_for(second, 1)
+        await asyncio.wait_for(bucket.acquire(), 1)
+        assert bucket.remaining == 0
+        assert (bucket.limit, bucket.window, bucket.bucket_hash) == (3, 10.0, 'abc')
+    asyncio.run(scenario())
+
+
+def test_bucket_waits_for_reset_after_429():
+    async def scenario():
+        bucket = RateLimitBucket()
+        await bucket.acquire()
+        bucket.update(limit_headers(1, 0, 0.05))
+        bucket.defer(0.05)
+        loop = asyncio.get_running_loop()
+        started = loop.time()
+        await asyncio.wait_for(bucket.acquire(), 1)
+        assert loop.time() - started >= 0.04
+    asyncio.run(scenario())
+
+
+def test_network_error_without_headers_releases_the_probe():
+    async def scenario():
+        bucket = RateLimitBucket()
+        await bucket.acquire()
+        bucket.update({})
+        await asyncio.wait_for(bucket.acquire(), 1)
+    asyncio.run(scenario())
+
+
+class FakeResponse:
+    def __init__(self, status, headers=None, body=''):
+        self.status = status
+        self.headers = headers or {}
+        self.body = body
+
+    async def text(self):
+        return self.body
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc):
+        return False
+
+
+class FakeSession:
+    """Trả lần lượt các response (hoặc raise exception) đã định sẵn cho mỗi lượt PUT."""
+    def __init__(self, outcomes):
+        self.outcomes = list(outcomes)
+        self.calls = 0
+
+    def put(self, url, json=None):
+        self.calls += 1
+        outcome = self.outcomes.pop(0)
+        if isinstance(outcome, BaseException):
+            raise outcome
+        return outcome
+
+
+def make_engine(session, max_retries=3):
+    engine = MemberAddEngine(concurrency=4, max_retries=max_retries)
+    engine._semaphore = asyncio.Semaphore(4)
+    engine._get_session = lambda: session
+    return engine
+
+
+def test_429_is_requeued_until_success():
+    async def scenario():
+        session = FakeSession([
+            FakeResponse(429, {'Retry-After': '0.01'}, '<html>slow down</html>'),
+            FakeResponse(201, limit_headers(5, 4, 1)),
+        ])
+        engine = make_engine(session)
+        result = await engine.add(1, 2, 'token')
+        assert result.success and result.status == 201
+        assert (result.attempts, session.calls, engine.rate_limited) == (2, 2, 1)
+    asyncio.run(scenario())
+
+
+def test_client_errors_are_not_retried():
+    async def scenario():
+        session = FakeSession([FakeResponse(403, body='Missing Access')])
+        result = await make_engine(session).add(1, 2, 'token')
+        assert (result.success, result.status, session.calls) == (False, 403, 1)
+        assert 'Missing Access' in result.message
+    asyncio.run(scenario())
+
+
+def test_cancelled_request_returns_its_slot():
+    class HangingSession:
+        def put(self, url, json=None):
+            return self
+
+        async def __aenter__(self):
+            await asyncio.sleep(60)
+
+        async def __aexit__(self, *exc):
+            return False
+
+    async def scenario():
+        engine = make_engine(HangingSession())
+        task = asyncio.create_task(engine.add(1, 2, 'token'))
+        await asyncio.sleep(0.01)
+        task.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await task
+        await asyncio.wait_for(engine._bucket(1).acquire(), 1)
+    asyncio.run(scenario())
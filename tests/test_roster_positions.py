@@ -0,0 +1,105 @@
+import copy
+
+import pytest
+
+from Interlink import (JSONBinStorage, ROSTER_POSITION_GAP, jsonbin_shard_index, order_roster_from_jsonbin,
+                       roster_position_between)
+
+
+def test_position_between_neighbours():
+    assert roster_position_between(None, None) == ROSTER_POSITION_GAP
+    assert roster_position_between(None, 1024.0) == 0.0
+    assert roster_position_between(1024.0, None) == 2048.0
+    assert roster_position_between(1024.0, 2048.0) == 1536.0
+
+
+def test_position_between_reports_exhausted_precision():
+    before = 1.0
+    after = before + 2 ** -52  # không còn số thực nào nằm giữa
+    assert roster_position_between(before, after) is None
+
+
+def test_order_uses_positions_then_legacy_order_for_the_rest():
+    data = {
+        '_roster_order': ['3', '1'],
+        '1': {'access_token': 'a', 'username': 'one'},
+        '2': {'access_token': 'b', 'roster_position': 2048.0},
+        '3': {'access_token': 'c'},
+        '4': {'access_token': 'd', 'roster_position': 1024.0},
+        'tracked_channels': {},
+    }
+    agents = order_roster_from_jsonbin(data)
+    assert [agent['id'] for agent in agents] == ['4', '2', '3', '1']
+    assert agents[3]['username'] == 'one'
+
+
+class MemoryJSONBin(JSONBinStorage):
+    """JSONBinStorage trên các bin trong bộ nhớ, ghi lại mọi lượt đọc bin."""
+    def __init__(self, bins, layout=None):
+        super().__init__(flush_interval=3600)
+        self.bin_id = 'manifest'
+        self.layout = layout
+        self._layout_loaded = True
+        self.bins = bins
+        self.reads = []
+
+    def _read_bin(self, bin_id, strict=False):
+        self.reads.append(bin_id)
+        return copy.deepcopy(self.bins.get(bin_id, {}))
+
+    def _write_bin(self, bin_id, data):
+        self.bins[bin_id] = copy.deepcopy(data)
+        return True
+
+
+@pytest.fixture
+def sharded():
+    shards = ['s0', 's1', 's2', 's3']
+    bins = {bin_id: {} for bin_id in shards + ['roster', 'tracker']}
+    for user_id in range(100, 120):
+        shard = shards[jsonbin_shard_index(str(user_id), len(shards))]
+        bins[shard][str(user_id)] = {'access_token': f't{user_id}'}
+    bins['roster']['_roster_order'] = [str(user_id) for user_id in range(119, 99, -1)]
+    return MemoryJSONBin(bins, {'shards': shards, 'roster_bin': 'roster', 'tracker_bin': 'tracker'})
+
+
+def roster_ids(storage):
+    return [agent['id'] for agent in order_roster_from_jsonbin(storage.read_data())]
+
+
+def test_first_move_assigns_positions_from_legacy_order(sharded):
+    assert sharded.move_roster_position('100', 1)
+    expected = ['100'] + [str(user_id) for user_id in range(119, 100, -1)]
+    assert roster_ids(sharded) == expected
+    assert '_roster_order' not in sharded.bins['roster']
+
+
+def test_later_moves_read_only_the_moved_agents_shard(sharded):
+    sharded.move_roster_position('100', 1)
+    sharded.reads.clear()
+    assert sharded.move_roster_position('110', 2)
+    assert sharded.reads == [sharded._bin_for_key('110')]
+    assert roster_ids(sharded)[:3] == ['100', '110', '119']
+
+
+def test_cached_order_follows_saves_and_deletes(sharded):
+    sharded.move_roster_position('100', 1)
+    sharded._enqueue('200', {'access_token': 'new'})
+    sharded._enqueue('119', None)
+    sharded.move_roster_position('200', 2)
+    ids = roster_ids(sharded)
+    assert ids[:2] == ['100', '200']
+    assert '119' not in ids
+    assert len(ids) == 20
+
+
+def test_reorder_writes_only_agents_whose_position_changed(sharded):
+    order = [str(user_id) for user_id in range(119, 99, -1)]
+    sharded.reorder_roster(order)
+    sharded.reads.clear()
+    assert sharded.reorder_roster(order)
+    assert sharded.reads == []  # thứ tự không đổi: không đọc, không ghi bin nào
+
+    positions = sharded.reorder_roster(['101', '119'])
+    assert list(positions)[:3] == ['101', '119', '118']
+    assert roster_ids(sharded)[:3] == ['101', '119', '118']
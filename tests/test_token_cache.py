@@ -0,0 +1,82 @@
+import threading
+
+from Interlink import TokenCache
+
+
+def test_get_returns_token_until_ttl_expires(clock):
+    cache = TokenCache(ttl=60, max_size=10, negative_ttl=5)
+    cache.set(1, 'token-1')
+    assert cache.get(1) == 'token-1'
+    assert cache.get('1') == 'token-1'
+    clock.advance(61)
+    assert cache.get(1) is None
+    assert cache.stats()['size'] == 0
+
+
+def test_least_recently_used_entry_is_evicted(clock):
+    cache = TokenCache(ttl=60, max_size=2, negative_ttl=5)
+    cache.set(1, 'a')
+    cache.set(2, 'b')
+    assert cache.get(1) == 'a'  # 1 trở thành mới dùng gần nhất
+    cache.set(3, 'c')
+    assert cache.get(2) is None
+    assert cache.get(1) == 'a'
+    assert cache.get(3) == 'c'
+
+
+def test_empty_token_is_not_cached(clock):
+    cache = TokenCache(ttl=60, max_size=10, negative_ttl=5)
+    cache.set(1, None)
+    cache.load_many({2: '', 3: 'c'})
+    assert cache.stats()['size'] == 1
+
+
+def test_negative_entry_expires_and_is_cleared_by_set(clock):
+    cache = TokenCache(ttl=60, max_size=10, negative_ttl=5)
+    cache.set_negative([1, 2])
+    assert cache.is_negative(1) and cache.is_negative(2)
+    cache.set(1, 'token-1')
+    assert not cache.is_negative(1)
+    clock.advance(6)
+    assert not cache.is_negative(2)
+
+
+def test_get_or_load_remembers_missing_user_only_when_complete(clock):
+    cache = TokenCache(ttl=60, max_size=10, negative_ttl=5)
+    calls = []
+
+    def loader(user_id):
+        calls.append(user_id)
+        return None, user_id == '1'
+
+    assert cache.get_or_load(1, loader) is None
+    assert cache.get_or_load(1, loader) is None  # negative hit, không gọi lại loader
+    assert cache.get_or_load(2, loader) is None
+    assert cache.get_or_load(2, loader) is None  # một tầng lỗi: không nhớ, hỏi lại
+    assert calls == ['1', '2', '2']
+    assert cache.stats()['negative_hits'] == 1
+
+
+def test_concurrent_misses_run_loader_once():
+    cache = TokenCache(ttl=60, max_size=10, negative_ttl=5)
+    started, release = threading.Event(), threading.Event()
+    calls = []
+
+    def loader(user_id):
+        calls.append(user_id)
+        started.set()
+        release.wait(5)
+        return 'token', True
+
+    results = []
+    leader = threading.Thread(target=lambda: results.append(cache.get_or_load(7, loader)))
+    leader.start()
+    started.wait(5)
+    followers = [threading.Thread(target=lambda: results.append(cache.get_or_load(7, loader))) for _ in range(3)]
+    for thread in followers:
+        thread.start()
+    release.set()
+    for thread in [leader] + followers:
+        thread.join(5)
+    assert calls == ['7']
+    assert results == ['token'] * 4